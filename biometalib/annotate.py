@@ -0,0 +1,252 @@
+"""Apply attribute_selector decisions to the Biometa collection.
+
+A BioAttribute mapping says which selected attribute each sample attribute
+name belongs to, or that it is ignored. Applying a mapping stores the values
+of the mapped sample attributes of each BioSample under
+`user_annotation.<name>`, keyed by the selected attribute::
+
+    {'sample_attributes': [{'name': 'gender', 'value': 'female'}, ...],
+     'user_annotation': {'fear': {'sex': 'female', ...}}}
+
+When several sample attributes of a BioSample map to the same selected
+attribute their distinct values are joined with `; `. Only selected
+attributes in `cleaned_fields.yaml` are stored.
+
+The mapping applied last is kept in the `biometa_annotations` collection, so
+re-applying only needs to touch BioSamples using an attribute whose decision
+changed, or that were never annotated.
+"""
+from datetime import datetime
+
+ANNOTATIONS_COLLECTION = 'biometa_annotations'
+SEPARATOR = '; '
+
+
+def check_name(name):
+    """Annotation names become part of a field path."""
+    if (not name) or ('.' in name) or name.startswith('$'):
+        raise ValueError('Invalid annotation name: {!r}'.format(name))
+    return name
+
+
+def get_mapping(bioattr, fields=None):
+    """Sample attribute names mapped to their selected attribute.
+
+    Parameters:
+    -----------
+    bioattr: BioAttribute or dict
+        Sample attribute names mapped to a selected attribute or `ignore`.
+    fields: iterable of str
+        Selected attributes that can be stored. If None every selected
+        attribute is kept.
+
+    Returns:
+    --------
+    tuple of (dict, set)
+        The mapping without ignored names and the selected attributes that
+        were dropped because they are not in fields.
+
+    """
+    fields = None if fields is None else set(fields)
+    mapping = {}
+    dropped = set()
+    for attr, selected in bioattr.items():
+        if selected == 'ignore':
+            continue
+        if (fields is not None) and (selected not in fields):
+            dropped.add(selected)
+            continue
+        mapping[attr] = selected
+    return mapping, dropped
+
+
+def annotate(sample_attributes, mapping):
+    """Values of a BioSample's sample attributes keyed by selected attribute.
+
+    Parameters:
+    -----------
+    sample_attributes: list of dict
+        Sample attributes with a name and value.
+    mapping: dict
+        See `get_mapping`.
+
+    """
+    annotation = {}
+    for attr in sample_attributes or []:
+        selected = mapping.get(attr.get('name'))
+        value = attr.get('value')
+        if (selected is None) or (value is None) or (value == ''):
+            continue
+
+        current = annotation.get(selected)
+        if current is None:
+            annotation[selected] = value
+        elif value not in current.split(SEPARATOR):
+            annotation[selected] = current + SEPARATOR + value
+    return annotation
+
+
+def changed_attributes(old, new):
+    """Sample attribute names whose selected attribute differs between mappings."""
+    return set(
+        attr for attr in set(old).union(new)
+        if old.get(attr) != new.get(attr)
+    )
+
+
+def get_query(name, changed=None):
+    """Raw query for BioSamples that need to be (re-)annotated.
+
+    Parameters:
+    -----------
+    name: str
+        Annotation name.
+    changed: iterable of str
+        Sample attribute names whose decision changed. If None every
+        BioSample is selected.
+
+    """
+    if changed is None:
+        return {}
+    return {'$or': [
+        {'user_annotation.{}'.format(name): {'$exists': False}},
+        {'sample_attributes.name': {'$in': sorted(changed)}},
+    ]}
+
+
+def id_range_query(lower, upper):
+    """Raw query selecting BioSamples with IDs in [lower, upper)."""
+    bounds = {}
+    if lower is not None:
+        bounds['$gte'] = lower
+    if upper is not None:
+        bounds['$lt'] = upper
+    return {'_id': bounds} if bounds else {}
+
+
+def get_id_ranges(collection, query, n, sample_size=10000):
+    """Split the BioSamples matching a query into n disjoint ID ranges.
+
+    Returns:
+    --------
+    list of tuple
+        Lower and upper bounds of each range, where None means unbounded.
+
+    """
+    splits = []
+    if n > 1:
+        buckets = collection.aggregate([
+            {'$match': query},
+            {'$project': {'_id': 1}},
+            {'$sample': {'size': sample_size}},
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': n}},
+        ])
+        splits = [x['_id']['min'] for x in buckets][1:]
+    return list(zip([None] + splits, splits + [None]))
+
+
+def annotation_pipeline(query, name, mapping, into='biometa'):
+    """Aggregation pipeline applying a mapping on the server (MongoDB 4.2+).
+
+    Builds the same annotation as `annotate` for every BioSample matching the
+    query, with values trimmed like string fields of the python engine, and
+    $merges it into `user_annotation.<name>`, keeping annotations stored
+    under other names.
+
+    Sample attribute names can contain dots, so the mapping is sent as two
+    arrays instead of a document, and the annotation is built as a list of
+    `{k, v}` pairs until the end.
+    """
+    names = sorted(mapping)
+    selected = {
+        '$let': {
+            'vars': {'i': {'$indexOfArray': [{'$literal': names}, '$$attr.name']}},
+            'in': {'$cond': [
+                {'$lt': ['$$i', 0]},
+                None,
+                {'$arrayElemAt': [{'$literal': [mapping[x] for x in names]}, '$$i']},
+            ]},
+        }
+    }
+    pairs = {
+        '$filter': {
+            'input': {
+                '$map': {
+                    'input': {'$ifNull': ['$sample_attributes', []]},
+                    'as': 'attr',
+                    'in': {'k': selected, 'v': '$$attr.value'},
+                }
+            },
+            'as': 'pair',
+            'cond': {'$and': [
+                {'$ne': [{'$ifNull': ['$$pair.k', None]}, None]},
+                {'$ne': [{'$ifNull': ['$$pair.v', '']}, '']},
+            ]},
+        }
+    }
+    join = {
+        '$cond': [
+            {'$in': ['$$this.v', {'$split': ['$$pair.v', SEPARATOR]}]},
+            '$$pair.v',
+            {'$concat': ['$$pair.v', SEPARATOR, '$$this.v']},
+        ]
+    }
+    add = {
+        '$cond': [
+            {'$in': ['$$this.k', '$$value.k']},
+            {'$map': {
+                'input': '$$value',
+                'as': 'pair',
+                'in': {'$cond': [
+                    {'$eq': ['$$pair.k', '$$this.k']},
+                    {'k': '$$pair.k', 'v': join},
+                    '$$pair',
+                ]},
+            }},
+            {'$concatArrays': ['$$value', ['$$this']]},
+        ]
+    }
+    # Values are trimmed once joined and dropped if blank, as string values
+    # are by `biometalib.coerce.Coercer` in the python engine.
+    trimmed = {
+        '$map': {
+            'input': {'$reduce': {'input': pairs, 'initialValue': [], 'in': add}},
+            'as': 'pair',
+            'in': {'k': '$$pair.k', 'v': {'$trim': {'input': '$$pair.v'}}},
+        }
+    }
+    annotation = {'$arrayToObject': {'$filter': {'input': trimmed, 'as': 'pair', 'cond': {'$ne': ['$$pair.v', '']}}}}
+
+    return [
+        {'$match': query},
+        {'$project': {'_id': 1, 'annotation': annotation}},
+        {'$merge': {
+            'into': into,
+            'on': '_id',
+            'whenMatched': [
+                {'$set': {'user_annotation': {'$mergeObjects': [
+                    {'$ifNull': ['$user_annotation', {}]},
+                    {name: '$$new.annotation'},
+                ]}}},
+            ],
+            'whenNotMatched': 'discard',
+        }},
+    ]
+
+
+def load_state(db, name):
+    """The mapping last applied under an annotation name, or None."""
+    state = db[ANNOTATIONS_COLLECTION].find_one({'_id': name})
+    if state is None:
+        return None
+    # Stored as pairs because attribute names can contain dots.
+    return dict(state['mapping'])
+
+
+def save_state(db, name, mapping):
+    """Record the mapping applied under an annotation name."""
+    db[ANNOTATIONS_COLLECTION].replace_one({'_id': name}, {
+        '_id': name,
+        'applied': datetime.now(),
+        'mapping': sorted(mapping.items()),
+    }, upsert=True)
@@ -0,0 +1,154 @@
+"""Precomputed statistics for sample attributes.
+
+The `attribute_stats` collection has one document per sample attribute name
+with the number of samples and BioProjects using it and its most common
+values::
+
+    {
+        '_id': 'sex',
+        'samples': 1000,
+        'projects': 20,
+        'distinct_values': 4,
+        'values': [{'value': 'female', 'count': 600}, ...],
+    }
+
+Statistics are built on the server with aggregation pipelines and can be
+refreshed for only a few attribute names. Refreshing needs `$merge`
+(MongoDB 4.2+); statistics of a single name are computed on the fly with
+plain `$group`/`$sort` stages.
+"""
+import uuid
+
+from biometalib.logger import logger
+
+STATS_COLLECTION = 'attribute_stats'
+
+
+def _unwind(names=None):
+    """Pipeline stages with one document per sample attribute."""
+    stages = []
+    if names is not None:
+        stages.append({'$match': {'sample_attributes.name': {'$in': list(names)}}})
+    stages.extend([
+        {'$project': {'_id': 0, 'bioproject': 1, 'sample_attributes': 1}},
+        {'$unwind': '$sample_attributes'},
+    ])
+    if names is not None:
+        stages.append({'$match': {'sample_attributes.name': {'$in': list(names)}}})
+    return stages
+
+
+def _count_values(names=None):
+    return _unwind(names) + [
+        {'$group': {
+            '_id': {'name': '$sample_attributes.name', 'value': '$sample_attributes.value'},
+            'count': {'$sum': 1},
+        }},
+    ]
+
+
+def values_pipeline(names=None, top=40):
+    """Pipeline counting samples and values for each attribute name."""
+    return _count_values(names) + [
+        # $push keeps the order of its input, so values are pushed most common first.
+        {'$sort': {'count': -1, '_id.value': 1}},
+        {'$group': {
+            '_id': '$_id.name',
+            'samples': {'$sum': '$count'},
+            'distinct_values': {'$sum': 1},
+            'values': {'$push': {'value': '$_id.value', 'count': '$count'}},
+        }},
+        {'$addFields': {'values': {'$slice': ['$values', top]}}},
+    ]
+
+
+def name_values_pipeline(name, top=40):
+    """Pipeline counting samples and the most common values of a single attribute name."""
+    return _count_values([name]) + [
+        {'$facet': {
+            'values': [
+                {'$sort': {'count': -1, '_id.value': 1}},
+                {'$limit': top},
+                {'$project': {'_id': 0, 'value': '$_id.value', 'count': 1}},
+            ],
+            'totals': [
+                {'$group': {'_id': None, 'samples': {'$sum': '$count'}, 'distinct_values': {'$sum': 1}}},
+            ],
+        }},
+    ]
+
+
+def projects_pipeline(names=None):
+    """Pipeline counting BioProjects for each attribute name."""
+    return _unwind(names) + [
+        {'$group': {'_id': {'name': '$sample_attributes.name', 'bioproject': '$bioproject'}}},
+        {'$group': {'_id': '$_id.name', 'projects': {'$sum': 1}}},
+    ]
+
+
+def refresh_attribute_stats(biometa, names=None, top=40):
+    """Rebuild attribute statistics.
+
+    Statistics are built in a temporary collection first, so readers never
+    see an empty or partial `attribute_stats` collection. A full rebuild
+    renames the temporary collection over it, a refresh of a few names
+    replaces their documents.
+
+    Parameters:
+    -----------
+    biometa: pymongo.collection.Collection
+        The Biometa collection.
+    names: list of str
+        Only refresh these attribute names. If None all statistics are
+        rebuilt.
+    top: int
+        Number of the most common values to keep.
+
+    """
+    db = biometa.database
+    names = None if names is None else list(names)
+    temp = db['{}_tmp_{}'.format(STATS_COLLECTION, uuid.uuid4().hex[:8])]
+    try:
+        merge = {'$merge': {'into': temp.name, 'whenMatched': 'merge', 'whenNotMatched': 'insert'}}
+        biometa.aggregate(values_pipeline(names, top) + [merge], allowDiskUse=True)
+        biometa.aggregate(projects_pipeline(names) + [merge], allowDiskUse=True)
+        built = temp.name in db.list_collection_names()
+
+        if names is None:
+            if built:
+                temp.rename(STATS_COLLECTION, dropTarget=True)
+            else:
+                db[STATS_COLLECTION].drop()
+        else:
+            present = set(temp.distinct('_id')) if built else set()
+            if built:
+                temp.aggregate([{'$merge': {'into': STATS_COLLECTION, 'whenMatched': 'replace',
+                                            'whenNotMatched': 'insert'}}])
+            # Names no BioSample uses any more.
+            db[STATS_COLLECTION].delete_many({'_id': {'$in': [x for x in names if x not in present]}})
+    finally:
+        temp.drop()
+
+    logger.info('Refreshed attribute statistics for {} names'.format(
+        'all' if names is None else '{:,}'.format(len(names))))
+
+
+def get_attribute_stats(biometa, name, top=40):
+    """Get statistics for an attribute name.
+
+    Uses the precomputed statistics if they exist, otherwise computes them
+    on the fly.
+    """
+    stats = biometa.database[STATS_COLLECTION].find_one({'_id': name})
+    if stats is not None:
+        return stats
+
+    stats = {'_id': name, 'samples': 0, 'projects': 0, 'distinct_values': 0, 'values': []}
+    for x in biometa.aggregate(name_values_pipeline(name, top), allowDiskUse=True):
+        stats['values'] = x['values']
+        for totals in x['totals']:
+            stats['samples'] = totals['samples']
+            stats['distinct_values'] = totals['distinct_values']
+    for x in biometa.aggregate(projects_pipeline([name]), allowDiskUse=True):
+        stats['projects'] = x['projects']
+    return stats
@@ -0,0 +1,208 @@
+"""Coerce free text attribute values to the CleanedAttributes schema.
+
+`cleaned_fields.yaml` declares each cleaned attribute as `string`, `int`,
+`float` or `bool`, while sample attribute values are free text like
+`3 days`, `25C`, `Male` or `N/A`. Values are coerced a column (cleaned
+attribute) at a time: each distinct value is parsed once and the result is
+cached, since the same values repeat across millions of BioSamples.
+
+Missing values (`N/A`, `none`, `unknown`, ...) of int, float and bool fields
+become None. String fields keep them as written, since `none` may be a
+real answer and the aggregate engine of `apply_attributes` stores string
+values unchanged. Values that are not missing but cannot be parsed as the
+field's type are dropped and counted per field.
+"""
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+NA_VALUES = frozenset([
+    '', '-', '--', '.', '?', 'n/a', 'na', 'n.a.', 'nan', 'none', 'null', 'missing', 'unknown', 'not applicable',
+    'not available', 'not collected', 'not determined', 'not provided', 'not recorded', 'unspecified',
+])
+
+TRUE_VALUES = frozenset(['true', 't', 'yes', 'y', '1'])
+FALSE_VALUES = frozenset(['false', 'f', 'no', 'n', '0'])
+
+# A number, optionally followed by a unit like `days`, `C` or `%`.
+NUMBER = re.compile(r'^([-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)\s*(?:[a-z%°µ][a-z%°µ ./]*)?$')
+
+# Returned by parsers for values they cannot parse.
+UNPARSED = object()
+
+
+def parse_string(value):
+    return value
+
+
+def parse_float(value):
+    match = NUMBER.match(value)
+    if match is None:
+        return UNPARSED
+    return float(match.group(1))
+
+
+# Range of a BSON long, larger ints can not be stored.
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def parse_int(value):
+    number = parse_float(value)
+    if (number is UNPARSED) or (not number.is_integer()):
+        return UNPARSED
+    number = int(number)
+    if not (INT_MIN <= number <= INT_MAX):
+        return UNPARSED
+    return number
+
+
+def parse_bool(value):
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    return UNPARSED
+
+
+PARSERS = {
+    'string': parse_string,
+    'int': parse_int,
+    'float': parse_float,
+    'bool': parse_bool,
+}
+
+
+class Coercer(object):
+    def __init__(self, schema, separator='; '):
+        """Coerce attribute values to the types of a schema.
+
+        Parameters:
+        -----------
+        schema: dict
+            Cleaned attribute names mapped to a dict with their `type`, as in
+            `cleaned_fields.yaml`.
+        separator: str
+            Values joined with this separator (see `biometalib.annotate`) are
+            parsed separately for non-string fields, and kept if they agree.
+
+        Attributes:
+        -----------
+        unparsed: collections.Counter
+            Number of values of each field that could not be parsed.
+        examples: dict
+            A few of the distinct values of each field that could not be
+            parsed.
+
+        Methods:
+        --------
+        coerce_column: method
+            Coerce the values of a single field.
+        coerce_records: method
+            Coerce a batch of annotations, a field at a time.
+
+        """
+        self.types = {k: v['type'] for k, v in schema.items()}
+        self.separator = separator
+        self.unparsed = Counter()
+        self.examples = defaultdict(list)
+        self._cache = defaultdict(dict)
+
+    def _parse(self, kind, raw, normalized):
+        """Parse a single distinct value, which may be several joined values."""
+        if kind == 'string':
+            return raw.strip() or None
+        if normalized in NA_VALUES:
+            return None
+
+        parser = PARSERS[kind]
+        parsed = set()
+        for part in normalized.split(self.separator.strip()):
+            part = part.strip()
+            if part in NA_VALUES:
+                continue
+            value = parser(part)
+            if value is UNPARSED:
+                return UNPARSED
+            parsed.add(value)
+
+        if len(parsed) > 1:
+            return UNPARSED
+        return parsed.pop() if parsed else None
+
+    def coerce_column(self, field, values):
+        """Coerce the values of a field.
+
+        Parameters:
+        -----------
+        field: str
+            Cleaned attribute name.
+        values: list of str
+            Raw values.
+
+        Returns:
+        --------
+        numpy.ndarray
+            Object array of coerced values, where blank values, missing
+            values of non-string fields and values that could not be parsed
+            are None.
+
+        """
+        kind = self.types.get(field, 'string')
+        values = np.asarray(values, dtype=object)
+        if values.size == 0:
+            return values
+
+        distinct, inverse = np.unique(values.astype(str), return_inverse=True)
+        normalized = np.char.strip(np.char.lower(distinct))
+
+        cache = self._cache[kind]
+        parsed = np.empty(len(distinct), dtype=object)
+        failed = np.zeros(len(distinct), dtype=bool)
+        for i, (raw, norm) in enumerate(zip(distinct.tolist(), normalized.tolist())):
+            try:
+                value = cache[raw]
+            except KeyError:
+                value = cache[raw] = self._parse(kind, raw, norm)
+            if value is UNPARSED:
+                failed[i] = True
+                value = None
+                if len(self.examples[field]) < 5:
+                    self.examples[field].append(raw)
+            parsed[i] = value
+
+        n_failed = int(np.bincount(inverse.ravel(), minlength=len(distinct))[failed].sum())
+        if n_failed:
+            self.unparsed[field] += n_failed
+        return parsed[inverse.ravel()]
+
+    def coerce_records(self, records):
+        """Coerce a batch of annotations in place.
+
+        Parameters:
+        -----------
+        records: list of dict
+            Annotations mapping cleaned attribute names to raw values. Values
+            that are missing or could not be parsed are removed.
+
+        """
+        columns = defaultdict(list)
+        for i, record in enumerate(records):
+            for field, value in record.items():
+                columns[field].append((i, value))
+
+        for field, column in columns.items():
+            rows, values = zip(*column)
+            for i, value in zip(rows, self.coerce_column(field, values)):
+                if value is None:
+                    del records[i][field]
+                else:
+                    records[i][field] = value
+        return records
+
+    def summary(self):
+        """Fields with unparsed values, most unparsed first."""
+        return [
+            (field, count, self.examples[field])
+            for field, count in self.unparsed.most_common()
+        ]
@@ -0,0 +1,72 @@
+"""Stream Ncbi documents from collection dumps.
+
+Dumps can be JSON-lines as written by `mongoexport` (extended JSON) or BSON
+as written by `mongodump`, optionally compressed with gzip, bzip2 or xz.
+Everything here is a generator, so memory use does not depend on the size of
+the dump.
+"""
+import bz2
+import gzip
+import lzma
+
+from bson import decode_file_iter
+from bson import json_util
+
+from biometalib.extract import get_record
+
+_OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+
+
+def open_dump(fn, mode='rb'):
+    """Open a file, decompressing based on its extension."""
+    for ext, opener in _OPENERS.items():
+        if fn.endswith(ext):
+            return opener(fn, mode)
+    return open(fn, mode)
+
+
+def is_bson(fn):
+    for ext in _OPENERS:
+        if fn.endswith(ext):
+            fn = fn[:-len(ext)]
+    return fn.endswith('.bson')
+
+
+def read_dump(fn):
+    """Iterate over the documents in a dump."""
+    with open_dump(fn, 'rb') as fh:
+        if is_bson(fn):
+            for doc in decode_file_iter(fh):
+                yield doc
+        else:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    yield json_util.loads(line.decode('utf-8'))
+
+
+def read_records(fns):
+    """Iterate over Biometa records from several dumps.
+
+    Yields None for documents without a BioSample.
+    """
+    for fn in fns:
+        for doc in read_dump(fn):
+            yield get_record(doc)
+
+
+def write_records(records, fn):
+    """Write Biometa records as JSON-lines.
+
+    Returns the number of records written.
+    """
+    n = 0
+    with open_dump(fn, 'wt') as fh:
+        for record in records:
+            fh.write(json_util.dumps(record) + '\n')
+            n += 1
+    return n
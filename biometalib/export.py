@@ -0,0 +1,249 @@
+"""Export Biometa as a table with one row per BioSample.
+
+Documents are streamed from the Biometa collection in chunks, so memory use
+depends on the chunk size and not on the number of BioSamples. Each chunk
+becomes a row group of a Parquet file or a record batch of an Arrow IPC
+stream, and/or rows of a sparse BioSample x attribute presence matrix.
+
+pyarrow is needed for Parquet and Arrow files and scipy for the matrix.
+"""
+from itertools import islice
+
+import numpy as np
+
+from biometalib import annotate
+from biometalib.coerce import Coercer
+
+# Biometa fields exported before the attribute columns.
+META_FIELDS = ['biosample', 'srs', 'gsm', 'srp', 'bioproject', 'taxon_id', 'sample_title']
+
+# Most attribute columns of a table. Exports of every sample attribute name,
+# tens of thousands of mostly empty columns, should use `MatrixWriter`.
+MAX_TABLE_COLUMNS = 1000
+
+PROJECTION = dict([(x, 1) for x in META_FIELDS[1:]] + [('sample_attributes', 1)])
+
+
+def iter_chunks(collection, query=None, chunk_size=10000):
+    """Iterate over lists of Biometa documents, sorted by BioSample."""
+    cursor = collection.find(query or {}, PROJECTION, batch_size=chunk_size).sort('_id', 1)
+    while True:
+        chunk = list(islice(cursor, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def get_columns(collection, mapping=None, names=None):
+    """Attribute columns of the export.
+
+    Selected attributes of the mapping, or every sample attribute name if
+    there is no mapping. Names that clash with a Biometa field get an
+    `_attr` suffix.
+
+    Parameters:
+    -----------
+    collection: pymongo.collection.Collection
+        The raw Biometa collection.
+    mapping: dict
+        Sample attribute names mapped to their selected attribute, see
+        `biometalib.annotate.get_mapping`.
+    names: list of str
+        Only export these selected attributes, or these sample attributes
+        if there is no mapping.
+
+    Returns:
+    --------
+    tuple of (dict, list)
+        Mapping from sample attribute names to their column and the sorted
+        column names.
+
+    """
+    if mapping is None:
+        if names is None:
+            names = collection.distinct('sample_attributes.name')
+        mapping = {x: x for x in names if x}
+    elif names is not None:
+        names = set(names)
+        mapping = {k: v for k, v in mapping.items() if v in names}
+
+    rename = {x: x + '_attr' if x in META_FIELDS else x for x in set(mapping.values())}
+    mapping = {k: rename[v] for k, v in mapping.items()}
+    return mapping, sorted(rename.values())
+
+
+def _arrow_type(pa, kind):
+    return {
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'bool': pa.bool_(),
+    }.get(kind, pa.dictionary(pa.int32(), pa.string()))
+
+
+class TableWriter(object):
+    def __init__(self, fn, columns, schema=None, fmt='parquet', compression='zstd', max_columns=MAX_TABLE_COLUMNS):
+        """Write chunks of BioSamples as a Parquet file or Arrow IPC stream.
+
+        Meta data and string columns are dictionary encoded. If a schema is
+        given attribute values are coerced to its types first, see
+        `biometalib.coerce.Coercer`.
+
+        Parameters:
+        -----------
+        fn: str
+            Output file.
+        columns: list of str
+            Attribute columns.
+        schema: dict
+            Cleaned attributes with their type.
+        fmt: str
+            `parquet` or `arrow`.
+        compression: str
+            Parquet compression codec.
+        max_columns: int
+            Raise a ValueError if there are more attribute columns.
+
+        """
+        if len(columns) > max_columns:
+            raise ValueError('{:,} attribute columns is more than the {:,} allowed in a table, select columns or '
+                             'write a presence matrix instead'.format(len(columns), max_columns))
+
+        import pyarrow as pa
+        self.pa = pa
+        self.columns = columns
+        self.coercer = Coercer(schema or {}, separator=annotate.SEPARATOR)
+
+        fields = [pa.field(x, _arrow_type(pa, 'string')) for x in META_FIELDS]
+        fields += [pa.field(x, _arrow_type(pa, self.coercer.types.get(x))) for x in columns]
+        self.schema = pa.schema(fields)
+
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(fn, self.schema, compression=compression)
+        else:
+            # The file format only allows one dictionary per column, so
+            # write a stream where each batch can carry its own.
+            self._writer = pa.ipc.new_stream(fn, self.schema)
+
+    def write(self, meta, annotations):
+        """Write a chunk.
+
+        Parameters:
+        -----------
+        meta: dict
+            Meta data columns as lists.
+        annotations: list of dict
+            Attribute columns mapped to raw values for each BioSample.
+
+        """
+        pa = self.pa
+        n = len(annotations)
+        annotations = self.coercer.coerce_records([dict(x) for x in annotations])
+
+        # Only build arrays for columns with values in this chunk.
+        values = {}
+        for i, annotation in enumerate(annotations):
+            for column, value in annotation.items():
+                values.setdefault(column, [None] * n)[i] = value
+
+        arrays = [pa.array(meta[x], type=self.schema.field(x).type) for x in META_FIELDS]
+        for column in self.columns:
+            kind = self.schema.field(column).type
+            if column in values:
+                arrays.append(pa.array(values[column], type=kind))
+            else:
+                arrays.append(pa.nulls(n, type=kind))
+
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+class MatrixWriter(object):
+    def __init__(self, prefix, columns):
+        """Write a sparse BioSample x attribute presence matrix.
+
+        Writes `<prefix>.npz`, a scipy CSR matrix with a 1 where a BioSample
+        has a value for an attribute, `<prefix>.rows.txt` with a BioSample
+        per row and `<prefix>.cols.txt` with an attribute per column. Only
+        the non-zero entries are kept in memory.
+
+        Parameters:
+        -----------
+        prefix: str
+            Prefix of the output files.
+        columns: list of str
+            Attribute columns.
+
+        """
+        from scipy import sparse
+        self._sparse = sparse
+        self.prefix = prefix
+        self.columns = columns
+        self._index = {x: i for i, x in enumerate(columns)}
+        self._indices = []
+        self._counts = []
+        self._rows = open(prefix + '.rows.txt', 'w')
+
+    def write(self, meta, annotations):
+        indices, counts = [], []
+        for biosample, annotation in zip(meta['biosample'], annotations):
+            self._rows.write(biosample + '\n')
+            indices.extend(sorted(self._index[x] for x in annotation))
+            counts.append(len(annotation))
+        self._indices.append(np.array(indices, dtype=np.int32))
+        self._counts.append(np.array(counts, dtype=np.int64))
+
+    def close(self):
+        sparse = self._sparse
+        self._rows.close()
+
+        with open(self.prefix + '.cols.txt', 'w') as fh:
+            for column in self.columns:
+                fh.write(column + '\n')
+
+        indices = np.concatenate([np.zeros(0, dtype=np.int32)] + self._indices)
+        counts = np.concatenate([np.zeros(0, dtype=np.int64)] + self._counts)
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        data = np.ones(len(indices), dtype=np.uint8)
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(counts), len(self.columns)))
+        sparse.save_npz(self.prefix + '.npz', matrix)
+        return matrix
+
+
+def export(collection, writers, mapping, query=None, chunk_size=10000):
+    """Stream Biometa into writers a chunk at a time.
+
+    Parameters:
+    -----------
+    collection: pymongo.collection.Collection
+        The raw Biometa collection.
+    writers: list
+        `TableWriter` and/or `MatrixWriter` instances.
+    mapping: dict
+        Sample attribute names mapped to their column, see `get_columns`.
+    query: dict
+        Raw query selecting BioSamples to export.
+    chunk_size: int
+        Number of BioSamples per chunk.
+
+    Returns:
+    --------
+    int
+        Number of BioSamples exported.
+
+    """
+    n = 0
+    for chunk in iter_chunks(collection, query, chunk_size):
+        meta = {x: [doc.get(x) for doc in chunk] for x in META_FIELDS[1:]}
+        meta['biosample'] = [doc['_id'] for doc in chunk]
+        annotations = [annotate.annotate(doc.get('sample_attributes'), mapping) for doc in chunk]
+        for writer in writers:
+            writer.write(meta, annotations)
+        n += len(chunk)
+
+    for writer in writers:
+        writer.close()
+    return n
@@ -0,0 +1,206 @@
+"""Extract Biometa fields from raw Ncbi documents.
+
+These functions mirror the helpers in `biometalib.utils.initialize_biometa`
+but work on plain dictionaries as returned by pymongo, so documents do not
+have to be hydrated into sramongo objects.
+"""
+from biometalib.logger import logger
+
+# Only the fields of an Ncbi document that are used to build Biometa.
+NCBI_PROJECTION = {
+    '_id': 1,
+    'sra.sample.BioSample': 1,
+    'sra.sample.sample_id': 1,
+    'sra.sample.GEO': 1,
+    'sra.sample.title': 1,
+    'sra.sample.taxon_id': 1,
+    'sra.sample.attributes': 1,
+    'sra.study.study_id': 1,
+    'sra.study.BioProject': 1,
+    'sra.study.title': 1,
+    'sra.study.abstract': 1,
+    'sra.run.run_id': 1,
+    'biosample.title': 1,
+    'biosample.description': 1,
+    'biosample.contacts': 1,
+    'biosample.attributes': 1,
+    'pubmed': 1,
+}
+
+
+def dict_uniqify(d):
+    return [dict(y) for y in set(tuple(x.items()) for x in d)]
+
+
+def get_field(doc, path):
+    """Get a value from nested dictionaries using a dotted path.
+
+    Returns None if any part of the path is missing.
+    """
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def get_contacts(doc):
+    contacts = []
+    for s in doc.get('biosample') or []:
+        for contact in s.get('contacts') or []:
+            contacts.append({
+                'first_name': contact.get('first_name'),
+                'last_name': contact.get('last_name'),
+                'email': contact.get('email'),
+            })
+    return dict_uniqify(contacts)
+
+
+def _clean_attributes(attrs):
+    attributes = []
+    for a in attrs or []:
+        a = {k: v for k, v in a.items() if v is not None}
+        if a.get('name'):
+            a['name'] = a['name'].lower().replace(' ', '_')
+            attributes.append(a)
+    return attributes
+
+
+def get_sample_attributes(doc):
+    attributes = _clean_attributes(get_field(doc, 'sra.sample.attributes'))
+    for bio in doc.get('biosample') or []:
+        attributes.extend(_clean_attributes(bio.get('attributes')))
+    return dict_uniqify(attributes)
+
+
+def get_sample_title(doc, stats=None):
+    titles = []
+    t1 = get_field(doc, 'sra.sample.title')
+    if t1:
+        titles.append(t1)
+
+    for bio in doc.get('biosample') or []:
+        t2 = bio.get('title')
+        if t2:
+            titles.append(t2)
+
+    titles = list(set(titles))
+    if len(titles) > 1:
+        logger.warning('{} had different titles from sra and biosample: {}'.format(
+            doc.get('_id'), titles)
+        )
+        if stats is not None:
+            stats['title_conflicts'] += 1
+    return '|'.join(titles)
+
+
+def papers_uniqify(pubmed):
+    """Remove papers with duplicate pubmed IDs, keeping the first one."""
+    ids = []
+    papers = []
+    for p in pubmed or []:
+        if (p is not None) and (p['pubmed_id'] not in ids):
+            papers.append(p)
+            ids.append(p['pubmed_id'])
+    return papers
+
+
+def get_papers(doc):
+    return papers_uniqify([p for p in doc.get('pubmed') or [] if (p is not None) and ('pubmed_id' in p)])
+
+
+def get_description(doc):
+    for s in doc.get('biosample') or []:
+        return s.get('description')
+
+
+def get_runs(doc):
+    runs = set(r.get('run_id') for r in get_field(doc, 'sra.run') or [])
+    return [x for x in runs if (x is not None) and (x != '')]
+
+
+def get_record(doc, stats=None):
+    """Build a Biometa record from a raw Ncbi document.
+
+    Returns None if the document has no BioSample.
+
+    Parameters:
+    -----------
+    doc: dict
+        An Ncbi document, which may be limited to `NCBI_PROJECTION`.
+    stats: collections.Counter
+        If given, SRX with conflicting sample titles are counted as
+        `title_conflicts`.
+
+    Returns:
+    --------
+    dict
+        With keys `srx`, `biosample`, `strings`, `contacts`, `experiments`,
+        `papers` and `sample_attributes`.
+
+    """
+    biosample = get_field(doc, 'sra.sample.BioSample')
+    if (biosample is None) or (biosample == ''):
+        return None
+
+    # General IDs
+    strings = {
+        'srs': get_field(doc, 'sra.sample.sample_id'),
+        'gsm': get_field(doc, 'sra.sample.GEO'),
+
+        'srp': get_field(doc, 'sra.study.study_id'),
+        'bioproject': get_field(doc, 'sra.study.BioProject'),
+        'study_title': get_field(doc, 'sra.study.title'),
+        'study_abstract': get_field(doc, 'sra.study.abstract'),
+        'description': get_description(doc),
+        'sample_title': get_sample_title(doc, stats),
+        'taxon_id': get_field(doc, 'sra.sample.taxon_id')
+    }
+    strings = {k: v for k, v in strings.items() if (v is not None) and (v != '')}
+
+    return {
+        'srx': doc['_id'],
+        'biosample': biosample,
+        'strings': strings,
+        'contacts': get_contacts(doc),
+        'experiments': [{'srx': doc['_id'], 'runs': get_runs(doc)}],
+        'papers': get_papers(doc),
+        'sample_attributes': get_sample_attributes(doc),
+    }
+
+
+def merge_records(records):
+    """Merge records of the same BioSample into a single record.
+
+    String fields from later records take precedence, the same as writing
+    each record in turn. Lists are combined and de-duplicated, and `srx`
+    becomes the list of merged SRX. Fingerprints of the SRX, if any, are
+    kept.
+    """
+    records = list(records)
+    merged = {
+        'srx': [r['srx'] for r in records],
+        'biosample': records[0]['biosample'],
+        'strings': {},
+        'contacts': [],
+        'experiments': [],
+        'papers': [],
+        'sample_attributes': [],
+    }
+    for r in records:
+        merged['strings'].update(r['strings'])
+        merged['contacts'].extend(r['contacts'])
+        merged['experiments'].extend(r['experiments'])
+        merged['papers'].extend(r['papers'])
+        merged['sample_attributes'].extend(r['sample_attributes'])
+
+    fingerprints = {}
+    for r in records:
+        fingerprints.update(r.get('fingerprints', {}))
+    if fingerprints:
+        merged['fingerprints'] = fingerprints
+
+    merged['contacts'] = dict_uniqify(merged['contacts'])
+    merged['papers'] = papers_uniqify(merged['papers'])
+    merged['sample_attributes'] = dict_uniqify(merged['sample_attributes'])
+    return merged
@@ -0,0 +1,146 @@
+"""Skip Biometa writes for SRX that have not changed.
+
+Every SRX written by `initialize_biometa` stores a fingerprint of the record
+extracted from it under `fingerprints.<srx>` of its BioSample. When
+initialize_biometa runs again the stored fingerprints are looked up a batch
+of records at a time, only for the BioSamples in the batch, and an SRX
+whose record has the same fingerprint is not written at all. Biometa
+upserts only add to the document, so skipping an SRX that was already
+written leaves it the same.
+
+Papers and contacts are sramongo documents unless `--raw` is used. Both are
+reduced to the same plain form, without empty fields, so switching between
+the two does not change fingerprints.
+
+Fingerprints are 64 bit hashes stored as integers. Changing how records are
+extracted should bump `VERSION` so every SRX is written again.
+"""
+import json
+import hashlib
+from itertools import islice
+
+from biometalib.logger import logger
+
+VERSION = 2
+
+
+def _plain(value):
+    # sramongo documents, e.g. Pubmed objects when not reading raw documents.
+    if hasattr(value, 'to_mongo'):
+        return _compact(value.to_mongo().to_dict())
+    return str(value)
+
+
+def _compact(value):
+    """Value without empty fields, which raw documents leave out."""
+    if hasattr(value, 'to_mongo'):
+        return _plain(value)
+    if isinstance(value, dict):
+        value = ((k, _compact(v)) for k, v in value.items())
+        return {k: v for k, v in value if (v is not None) and (v != '') and (v != []) and (v != {})}
+    if isinstance(value, list):
+        return [_compact(x) for x in value]
+    return value
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, default=_plain)
+
+
+def _unordered(values):
+    # Extraction de-duplicates with sets, so order changes between processes.
+    return sorted(_dumps(x) for x in values)
+
+
+def fingerprint(record, normalized=False):
+    """Fingerprint of a single SRX record.
+
+    Parameters:
+    -----------
+    record: dict
+        A record from `extract.get_record` or `get_record`.
+    normalized: bool
+        If papers and contacts are stored in their own collections, so
+        changing the layout writes every SRX again.
+
+    Returns:
+    --------
+    int
+        Signed 64 bit hash, which fits in a BSON long.
+
+    """
+    strings = dict(record['strings'])
+    if 'sample_title' in strings:
+        strings['sample_title'] = sorted(strings['sample_title'].split('|'))
+    experiments = [dict(x, runs=sorted(x['runs'])) for x in record['experiments']]
+
+    payload = [
+        VERSION, normalized, record['biosample'], strings, _unordered(_compact(record['contacts'])),
+        _unordered(_compact(record['papers'])), _unordered(experiments), _unordered(record['sample_attributes']),
+    ]
+    data = _dumps(payload).encode('utf-8')
+    return int.from_bytes(hashlib.sha1(data).digest()[:8], 'big', signed=True)
+
+
+def load_fingerprints(collection, query=None, batch_size=10000):
+    """Fingerprints stored in the Biometa collection.
+
+    Parameters:
+    -----------
+    collection: pymongo.collection.Collection
+        The raw Biometa collection.
+    query: dict
+        Only load fingerprints of matching BioSamples.
+
+    Returns:
+    --------
+    dict
+        SRX mapped to their fingerprint.
+
+    """
+    query = dict(query or {})
+    query['fingerprints'] = {'$exists': True}
+    fingerprints = {}
+    for doc in collection.find(query, projection={'_id': 0, 'fingerprints': 1}, batch_size=batch_size):
+        fingerprints.update(doc['fingerprints'])
+    logger.debug('Loaded {:,} fingerprints'.format(len(fingerprints)))
+    return fingerprints
+
+
+def skip_unchanged(records, collection, stats, normalized=False, batch_size=1000):
+    """Drop records whose fingerprint is unchanged.
+
+    Records are read `batch_size` at a time, and the fingerprints of their
+    BioSamples are loaded with a single query per batch. Records that are
+    kept get a `fingerprints` entry, which `get_update` stores with the
+    record. The order of records is kept.
+
+    Parameters:
+    -----------
+    records: iterable of dict
+        SRX records, before they are merged by BioSample.
+    collection: pymongo.collection.Collection
+        The raw Biometa collection.
+    stats: collections.Counter
+        Counts the records skipped as `unchanged`.
+    normalized: bool
+        See `fingerprint`.
+    batch_size: int
+        Number of records per fingerprint lookup.
+
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, max(batch_size, 1)))
+        if not batch:
+            return
+        biosamples = sorted(set(r['biosample'] for r in batch))
+        fingerprints = load_fingerprints(collection, {'_id': {'$in': biosamples}}, batch_size=len(biosamples))
+
+        for record in batch:
+            value = fingerprint(record, normalized)
+            if fingerprints.get(record['srx']) == value:
+                stats['unchanged'] += 1
+                continue
+            record['fingerprints'] = {record['srx']: value}
+            yield record
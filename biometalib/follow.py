@@ -0,0 +1,182 @@
+"""Follow changes to the Ncbi collection.
+
+sramongo adds and updates SRX in the Ncbi collection, which are missing from
+Biometa until `initialize_biometa` runs again. `initialize_biometa --follow`
+instead tails the Ncbi collection's change stream. Changes are read in
+batches, so a burst of imported SRX becomes a few bulk writes, and the
+resume token of each batch is stored once it has been written. A restarted
+follower continues after the last batch written. Batches are at least once,
+which is fine as Biometa upserts can be repeated.
+
+Change streams need a replica set, a single node one is enough::
+
+    mongod --replSet rs0 --dbpath /data/rs0
+    mongosh --eval 'rs.initiate()'
+"""
+import time
+from datetime import datetime
+from collections import OrderedDict
+
+from biometalib import extract
+
+CHANGE_TYPES = ['insert', 'update', 'replace']
+
+# Error codes of a resume token that is no longer in the oplog.
+HISTORY_LOST = (280, 286)
+
+
+class ResumeTokens(object):
+    def __init__(self, collection, name='initialize_biometa_follow'):
+        """Persisted change stream position of a follower.
+
+        Parameters:
+        -----------
+        collection: pymongo.collection.Collection
+            Collection used to store the token, shared with checkpoints.
+        name: str
+            ID of the token document.
+
+        """
+        self.collection = collection
+        self.name = name
+
+    def load(self):
+        state = self.collection.find_one({'_id': self.name})
+        return None if state is None else state['token']
+
+    def save(self, token):
+        self.collection.replace_one({'_id': self.name}, {
+            '_id': self.name,
+            'token': token,
+            'updated': datetime.now(),
+        }, upsert=True)
+
+    def reset(self):
+        self.collection.delete_one({'_id': self.name})
+
+
+def get_pipeline():
+    """Change stream pipeline keeping inserted, updated and replaced SRX.
+
+    Only the fields of the full document used by `extract.get_record` are
+    sent by the server.
+    """
+    project = {'operationType': 1, 'documentKey': 1}
+    project.update({'fullDocument.' + k: 1 for k in extract.NCBI_PROJECTION if k != '_id'})
+    return [
+        {'$match': {'operationType': {'$in': CHANGE_TYPES}}},
+        {'$project': project},
+    ]
+
+
+def watch(collection, resume_after=None, max_await=1.0):
+    """Open a change stream on the Ncbi collection.
+
+    Updates are sent with the current version of the document.
+
+    Parameters:
+    -----------
+    collection: pymongo.collection.Collection
+        The raw Ncbi collection.
+    resume_after: dict
+        Resume token to continue after, or None to start now.
+    max_await: float
+        Seconds the server waits for changes before returning an empty batch.
+
+    """
+    return collection.watch(get_pipeline(), full_document='updateLookup', resume_after=resume_after,
+                            max_await_time_ms=int(max_await * 1000))
+
+
+def iter_batches(stream, batch_size=1000, window=1.0, idle_timeout=None):
+    """Group changes from a change stream into batches.
+
+    A batch is yielded once it has `batch_size` changes, once the stream has
+    no more changes waiting, or `window` seconds after its first change.
+
+    Parameters:
+    -----------
+    stream: pymongo.change_stream.ChangeStream
+        An open change stream.
+    batch_size: int
+        Largest number of changes in a batch.
+    window: float
+        Most seconds a change waits for its batch to be yielded.
+    idle_timeout: float
+        Stop after this many seconds without a change. If None follow the
+        stream until it is closed.
+
+    Yields:
+    -------
+    tuple of (list, dict)
+        Change events and the resume token to store once they are written.
+
+    """
+    batch = []
+    first = last = time.time()
+    while stream.alive:
+        change = stream.try_next()
+        now = time.time()
+        if change is not None:
+            if not batch:
+                first = now
+            batch.append(change)
+            last = now
+
+        if batch and ((len(batch) >= batch_size) or (change is None) or (now - first >= window)):
+            yield batch, stream.resume_token
+            batch = []
+        elif (change is None) and (idle_timeout is not None) and (now - last >= idle_timeout):
+            return
+
+    if batch:
+        yield batch, stream.resume_token
+
+
+def get_records(changes, stats):
+    """Biometa records for a batch of changes.
+
+    Only the last change of each Ncbi document is used, and records of the
+    same BioSample are merged with `extract.merge_records`.
+
+    Parameters:
+    -----------
+    changes: list of dict
+        Change events with their full document.
+    stats: collections.Counter
+        Counts `srx`, `no_biosample`, `deleted` (documents removed before
+        their update was read) and `title_conflicts`.
+
+    Returns:
+    --------
+    list of dict
+        One record per BioSample.
+
+    """
+    latest = OrderedDict()
+    for change in changes:
+        key = change['documentKey']['_id']
+        latest.pop(key, None)
+        latest[key] = change
+
+    biosamples = OrderedDict()
+    for change in latest.values():
+        doc = change.get('fullDocument')
+        if doc is None:
+            stats['deleted'] += 1
+            continue
+        doc.setdefault('_id', change['documentKey']['_id'])
+
+        stats['srx'] += 1
+        record = extract.get_record(doc, stats)
+        if record is None:
+            stats['no_biosample'] += 1
+            continue
+        biosamples.setdefault(record['biosample'], []).append(record)
+
+    return [extract.merge_records(records) for records in biosamples.values()]
+
+
+def is_history_lost(err):
+    """True if a change stream cannot resume because its token left the oplog."""
+    return getattr(err, 'code', None) in HISTORY_LOST
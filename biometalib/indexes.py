@@ -0,0 +1,113 @@
+"""Build and report on the indexes used by biometalib.
+
+Biometa indexes are declared on the model (see `biometalib.models`). The
+Ncbi collection belongs to sramongo, so the indexes biometalib needs on it
+are listed here. `QUERIES` are representative queries run by the biometalib
+tools, which are explained to show the index each one uses.
+"""
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+
+from biometalib.logger import logger
+
+# Indexes needed on the Ncbi collection by initialize_biometa.
+NCBI_INDEXES = [
+    # Partitioning, --coalesce and resuming sort and filter on BioSample.
+    [('sra.sample.BioSample', 1), ('_id', 1)],
+    # --since and --resume filter on the import date.
+    [('sra.db_imported', 1)],
+]
+
+# (description, collection, filter, sort)
+QUERIES = [
+    ('attribute_selector: values of an attribute', 'biometa', {'sample_attributes.name': 'sex'}, None),
+    ('apply_attributes: BioSamples using changed attributes', 'biometa',
+     {'sample_attributes.name': {'$in': ['sex', 'dev_stage']}}, None),
+    ('BioSamples with an attribute value', 'biometa',
+     {'sample_attributes.name': 'sex', 'sample_attributes.value': 'female'}, None),
+    ('BioSamples of a BioProject', 'biometa', {'bioproject': 'PRJNA0'}, None),
+    ('BioSamples of a study', 'biometa', {'srp': 'SRP000000'}, None),
+    ('BioSample of a GEO sample', 'biometa', {'gsm': 'GSM0'}, None),
+    ('BioSamples of a taxon', 'biometa', {'taxon_id': '7227'}, None),
+    ('BioSample of an SRX', 'biometa', {'experiments.srx': 'SRX000000'}, None),
+    ('initialize_biometa: BioSample partition', 'ncbi',
+     {'sra.sample.BioSample': {'$gte': 'SAMN0', '$lt': 'SAMN1'}}, [('sra.sample.BioSample', 1), ('_id', 1)]),
+    ('initialize_biometa --since', 'ncbi', {'sra.db_imported': {'$gte': datetime(2000, 1, 1)}}, None),
+]
+
+
+def create_indexes(collection, indexes):
+    """Create indexes in the background, logging any that fail."""
+    for keys in indexes:
+        try:
+            name = collection.create_index(keys, background=True)
+            logger.info('Index {}.{} is ready'.format(collection.name, name))
+        except OperationFailure as err:
+            logger.error('Could not create index {} on {}: {}'.format(keys, collection.name, err))
+
+
+def index_sizes(collection):
+    """Size in bytes of each index of a collection."""
+    try:
+        return collection.database.command('collStats', collection.name).get('indexSizes', {})
+    except OperationFailure:
+        return {}
+
+
+def index_usage(collection):
+    """Number of operations that used each index since the server started."""
+    try:
+        return {x['name']: x['accesses']['ops'] for x in collection.aggregate([{'$indexStats': {}}])}
+    except OperationFailure:
+        return {}
+
+
+def _plan_indexes(plan):
+    """Names of the indexes in a query plan, or COLLSCAN."""
+    names = []
+    stages = [plan]
+    while stages:
+        stage = stages.pop()
+        if stage.get('stage') == 'COLLSCAN':
+            names.append('COLLSCAN')
+        if 'indexName' in stage:
+            names.append(stage['indexName'])
+        if 'inputStage' in stage:
+            stages.append(stage['inputStage'])
+        stages.extend(stage.get('inputStages', []))
+    return names
+
+
+def explain_query(collection, query, sort=None):
+    """Indexes used by the winning plan of a query."""
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    plan = cursor.explain()['queryPlanner']['winningPlan']
+    # Plans from the slot based engine wrap the classic plan.
+    return _plan_indexes(plan.get('queryPlan', plan))
+
+
+def report(collections):
+    """Log index sizes, usage and the indexes used by `QUERIES`.
+
+    Parameters:
+    -----------
+    collections: dict
+        `biometa` and `ncbi` mapped to their pymongo collections.
+
+    """
+    for _, collection in sorted(collections.items()):
+        sizes = index_sizes(collection)
+        usage = index_usage(collection)
+        for name in sorted(collection.index_information()):
+            logger.info('{}.{}: {:,.1f} MB, used {:,} times'.format(
+                collection.name, name, sizes.get(name, 0) / 2 ** 20, usage.get(name, 0)))
+
+    for description, key, query, sort in QUERIES:
+        try:
+            used = explain_query(collections[key], query, sort)
+        except (OperationFailure, KeyError) as err:
+            used = ['could not explain: {}'.format(err)]
+        logger.info('{}: {}'.format(description, ', '.join(used)))
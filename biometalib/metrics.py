@@ -0,0 +1,202 @@
+"""Throughput and latency metrics for long running jobs.
+
+`Metrics` counts documents and skipped records, splits wall time between
+stages (reading, extraction and writing), keeps write latencies and
+periodically logs progress with a rate and an ETA. Metrics from several
+worker processes can be merged, logged as a summary or written as JSON.
+"""
+import json
+import time
+import cProfile
+import pstats
+from io import StringIO
+from logging import DEBUG
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+
+from biometalib.logger import logger
+
+PERCENTILES = (50, 90, 99)
+
+
+def format_eta(seconds):
+    return str(timedelta(seconds=int(seconds)))
+
+
+class Metrics(object):
+    def __init__(self, total=None, interval=30, unit='SRX'):
+        """Metrics of a run.
+
+        Parameters:
+        -----------
+        total: int
+            Number of documents expected, used for the ETA.
+        interval: float
+            Seconds between progress messages.
+        unit: str
+            Name of the documents being counted.
+
+        Attributes:
+        -----------
+        counts: collections.Counter
+            Documents processed (`srx`) and skipped.
+        times: collections.Counter
+            Seconds spent in each stage.
+        latencies: list of float
+            Seconds taken by each bulk write.
+
+        """
+        self.total = total
+        self.interval = interval
+        self.unit = unit
+        self.counts = Counter()
+        self.times = Counter()
+        self.latencies = []
+        self.start = time.time()
+        self.elapsed = 0.0
+        self._last = self.start
+
+    def __getstate__(self):
+        # Sent back from worker processes, so freeze the elapsed time.
+        state = self.__dict__.copy()
+        state['elapsed'] = self.wall()
+        return state
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] += time.time() - start
+
+    def timed(self, iterable, stage):
+        """Iterate, counting the time taken to get each item towards stage."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.times[stage] += time.time() - start
+                return
+            self.times[stage] += time.time() - start
+            yield item
+
+    def wall(self):
+        return max(self.elapsed, time.time() - self.start)
+
+    def rate(self):
+        wall = self.wall()
+        return self.counts['srx'] / wall if wall > 0 else 0.0
+
+    def split(self):
+        """Fraction of the measured time spent in each stage."""
+        total = sum(self.times.values())
+        if total == 0:
+            return {}
+        return {k: v / total for k, v in self.times.items()}
+
+    def percentiles(self):
+        if not self.latencies:
+            return {}
+        values = np.percentile(self.latencies, PERCENTILES)
+        stats = {'p{}'.format(p): float(v) for p, v in zip(PERCENTILES, values)}
+        stats['max'] = float(max(self.latencies))
+        return stats
+
+    def eta(self):
+        """Seconds left, or None if the total or rate is unknown."""
+        rate = self.rate()
+        if (self.total is None) or (rate == 0):
+            return None
+        return max(self.total - self.counts['srx'], 0) / rate
+
+    def progress(self):
+        """Progress message with rate, ETA and time split."""
+        msg = 'Processed {:,}'.format(self.counts['srx'])
+        if self.total is not None:
+            msg += ' of {:,}'.format(self.total)
+        msg += ' {} ({:,.0f}/s)'.format(self.unit, self.rate())
+
+        eta = self.eta()
+        if eta is not None:
+            msg += ', ETA {}'.format(format_eta(eta))
+
+        split = self.split()
+        if split:
+            msg += '; ' + ' '.join('{} {:.0%}'.format(k, v) for k, v in sorted(split.items()))
+        return msg
+
+    def tick(self):
+        """Log progress if more than `interval` seconds passed since the last message."""
+        now = time.time()
+        if now - self._last >= self.interval:
+            self._last = now
+            logger.info(self.progress())
+
+    def merge(self, other):
+        """Add the metrics of a worker, whose wall time overlaps with ours."""
+        self.counts.update(other.counts)
+        self.times.update(other.times)
+        self.latencies.extend(other.latencies)
+        return self
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'wall_seconds': self.wall(),
+            'docs_per_second': self.rate(),
+            'counts': dict(self.counts),
+            'stage_seconds': dict(self.times),
+            'stage_split': self.split(),
+            'write_latency': self.percentiles(),
+            'batches': len(self.latencies),
+        }
+
+    def write_json(self, fn):
+        with open(fn, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=2, sort_keys=True)
+
+    def summary(self):
+        """Log a summary of the run."""
+        logger.info('Processed {:,} {} in {} ({:,.0f}/s)'.format(
+            self.counts['srx'], self.unit, format_eta(self.wall()), self.rate()))
+
+        if self.times:
+            logger.info('Time spent: ' + ', '.join('{} {:.1f}s ({:.0%})'.format(k, self.times[k], v)
+                                                   for k, v in sorted(self.split().items())))
+
+        latency = self.percentiles()
+        if latency:
+            logger.info('Write latency over {:,} batches: '.format(len(self.latencies)) + ' '.join(
+                '{} {:.3f}s'.format(k, latency[k]) for k in ['p{}'.format(p) for p in PERCENTILES] + ['max']))
+
+
+@contextmanager
+def profile(fn=None, top=25):
+    """Profile the enclosed code with cProfile.
+
+    Stats are written to fn, and the functions with the most cumulative
+    time are logged at debug level. Does nothing if fn is None.
+    """
+    if fn is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(fn)
+        logger.info('Wrote profile to {}'.format(fn))
+
+        if logger.isEnabledFor(DEBUG):
+            out = StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+            logger.debug(out.getvalue())
@@ -1,30 +1,79 @@
+import os
+import sys
+import types
 from collections import OrderedDict
-from pkg_resources import resource_filename
-from ruamel import yaml
+from functools import lru_cache
 
-from mongoengine import Document, EmbeddedDocument
+from mongoengine import Document, EmbeddedDocument, signals
 from mongoengine import StringField, IntField, FloatField, BooleanField, \
     ListField, DictField, MapField, DateTimeField, EmbeddedDocumentField
 from mongoengine.errors import ValidationError, FieldDoesNotExist
 
 from sramongo.mongo_schema import Pubmed
 
-# Import Cleaned Attributes and make model
-with open(resource_filename('biometalib', 'data/cleaned_fields.yaml'), 'r') as fh:
-    CLEANED_ATTRIBUTES = yaml.load(fh, Loader=yaml.RoundTripLoader)
+CLEANED_FIELDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cleaned_fields.yaml')
 
-_cleanedAttributesDocument = OrderedDict()
-for k, v in CLEANED_ATTRIBUTES.items():
-    if v['type'] == 'string':
-        _cleanedAttributesDocument[k] = StringField(help_text=v['description'])
-    elif v['type'] == 'int':
-        _cleanedAttributesDocument[k] = IntField(help_text=v['description'])
-    elif v['type'] == 'float':
-        _cleanedAttributesDocument[k] = FloatField(help_text=v['description'])
-    elif v['type'] == 'bool':
-        _cleanedAttributesDocument[k] = BooleanField(help_text=v['description'])
+_FIELD_TYPES = {
+    'string': StringField,
+    'int': IntField,
+    'float': FloatField,
+    'bool': BooleanField,
+}
 
-CleanedAttributes = type('CleanedAttributes', (EmbeddedDocument, ), _cleanedAttributesDocument)
+
+@lru_cache(maxsize=None)
+def get_cleaned_attributes():
+    """Cleaned attribute names and their type and description.
+
+    Parsed from `data/cleaned_fields.yaml` on first use.
+    """
+    from biometalib.yaml_cache import load_yaml
+    return load_yaml(CLEANED_FIELDS)
+
+
+@lru_cache(maxsize=None)
+def get_cleaned_attributes_model():
+    """Build the CleanedAttributes document from the cleaned attributes.
+
+    The model is built on first use so importing this module does not parse
+    the YAML.
+    """
+    _cleanedAttributesDocument = OrderedDict()
+    for k, v in get_cleaned_attributes().items():
+        if v['type'] in _FIELD_TYPES:
+            _cleanedAttributesDocument[k] = _FIELD_TYPES[v['type']](help_text=v['description'])
+
+    return type('CleanedAttributes', (EmbeddedDocument, ), _cleanedAttributesDocument)
+
+
+class _LazyModule(types.ModuleType):
+    """Keep `models.CleanedAttributes` and `models.CLEANED_ATTRIBUTES` working.
+
+    A module level `__getattr__` needs Python 3.7, so this module's class is
+    swapped for one with properties instead.
+    """
+    @property
+    def CleanedAttributes(self):
+        return get_cleaned_attributes_model()
+
+    @property
+    def CLEANED_ATTRIBUTES(self):
+        return get_cleaned_attributes()
+
+
+sys.modules[__name__].__class__ = _LazyModule
+
+
+class CleanedAttributesField(EmbeddedDocumentField):
+    """EmbeddedDocumentField of CleanedAttributes, resolved on first use."""
+    def __init__(self, **kwargs):
+        super().__init__('CleanedAttributes', **kwargs)
+
+    @property
+    def document_type(self):
+        if isinstance(self.document_type_obj, str):
+            self.document_type_obj = get_cleaned_attributes_model()
+        return self.document_type_obj
 
 
 class Contacts(EmbeddedDocument):
@@ -54,6 +103,12 @@ class BiometaFields(Document):
     description = StringField()
 
     contacts = ListField(EmbeddedDocumentField(Contacts), default=list)
+    # References into the papers and contacts collections when they are
+    # normalized, see `biometalib.normalize`.
+    contact_ids = ListField(StringField(), default=list)
+    paper_ids = ListField(StringField(), default=list)
+    # Fingerprint of the record extracted from each SRX, see `biometalib.fingerprint`.
+    fingerprints = MapField(IntField())
     papers = ListField(EmbeddedDocumentField(Pubmed), default=list)
     experiments = ListField(EmbeddedDocumentField(Experiment), default=list)
 
@@ -67,11 +122,36 @@ class BiometaFields(Document):
     oliver = ListField(EmbeddedDocumentField(Annotation))
     nlm = ListField(EmbeddedDocumentField(Annotation))
     fear = ListField(EmbeddedDocumentField(Annotation))
-    user_annotation = MapField(EmbeddedDocumentField(CleanedAttributes))
-
-    meta = {'abstract': True}
+    user_annotation = MapField(CleanedAttributesField())
+
+    # Indexes are built by `biometa_indexes` instead of on first use, since
+    # building them on a large collection takes a while.
+    meta = {
+        'abstract': True,
+        'indexes': [
+            'bioproject',
+            'srp',
+            'gsm',
+            'taxon_id',
+            'experiments.srx',
+            ('sample_attributes.name', 'sample_attributes.value'),
+        ],
+        'index_background': True,
+        'auto_create_index': False,
+    }
 
 
 class Biometa(BiometaFields):
     pass
 
+
+def _biometa_written(sender, document, **kwargs):
+    # Imported here as the query module needs numpy.
+    from biometalib.query import record_write
+    record_write(document._get_db())
+
+
+# Clear cached lookups (`biometalib.query`) when a Biometa document changes.
+if signals.signals_available:
+    signals.post_save.connect(_biometa_written, sender=Biometa)
+    signals.post_delete.connect(_biometa_written, sender=Biometa)
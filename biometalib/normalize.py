@@ -0,0 +1,198 @@
+"""Normalized storage of papers and contacts.
+
+By default every Biometa document embeds its papers and contacts, so a paper
+describing a 500 sample study is stored 500 times. In the normalized layout
+papers are stored once in the `papers` collection keyed by their PubMed ID,
+and contacts once in the `contacts` collection keyed by a hash of their
+content. Biometa documents only keep `paper_ids` and `contact_ids`, which
+`dereference` resolves for a page of BioSamples with one `$in` query per
+collection.
+"""
+import json
+import hashlib
+from collections import OrderedDict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from biometalib.logger import logger
+
+PAPERS_COLLECTION = 'papers'
+CONTACTS_COLLECTION = 'contacts'
+
+
+def paper_doc(paper):
+    """A paper as a plain dictionary keyed by its PubMed ID."""
+    if not isinstance(paper, dict):
+        paper = paper.to_mongo().to_dict()
+    doc = dict(paper)
+    doc['_id'] = doc['pubmed_id']
+    return doc
+
+
+def contact_id(contact):
+    """Hash of a contact's name and email."""
+    key = json.dumps([contact.get('first_name'), contact.get('last_name'), contact.get('email')])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def contact_doc(contact):
+    doc = dict(contact)
+    doc['_id'] = contact_id(contact)
+    return doc
+
+
+def normalize_record(record):
+    """Replace a record's papers and contacts with references.
+
+    Returns:
+    --------
+    tuple of (dict, list, list)
+        The record with `paper_ids` and `contact_ids` instead of `papers`
+        and `contacts`, and the paper and contact documents to store.
+
+    """
+    papers = [paper_doc(x) for x in record['papers']]
+    contacts = [contact_doc(x) for x in record['contacts']]
+
+    record = dict(record)
+    del record['papers'], record['contacts']
+    record['paper_ids'] = [x['_id'] for x in papers]
+    record['contact_ids'] = [x['_id'] for x in contacts]
+    return record, papers, contacts
+
+
+class SharedWriter(object):
+    def __init__(self, db, batch_size=1000, cache_size=100000):
+        """Batched inserts of papers and contacts.
+
+        Documents are only inserted if their ID does not exist yet. IDs
+        written recently are remembered, so a paper shared by many
+        BioSamples is only sent to the server once.
+
+        Parameters:
+        -----------
+        db: pymongo.database.Database
+            Database with the papers and contacts collections.
+        batch_size: int
+            Number of inserts to send per bulk write.
+        cache_size: int
+            Number of recently written IDs to remember.
+
+        Methods:
+        --------
+        add: method
+            Queue a paper or contact.
+        flush: method
+            Send all queued documents to the server.
+
+        """
+        self.collections = {
+            'papers': db[PAPERS_COLLECTION],
+            'contacts': db[CONTACTS_COLLECTION],
+        }
+        self.batch_size = max(batch_size, 1)
+        self.cache_size = cache_size
+        self.written = 0
+        # Queued documents by ID, only remembered once they are written.
+        self._pending = {k: OrderedDict() for k in self.collections}
+        self._seen = OrderedDict()
+
+    def _remember(self, key):
+        self._seen[key] = True
+        while len(self._seen) > self.cache_size:
+            self._seen.popitem(last=False)
+
+    def add(self, kind, doc):
+        key = (kind, doc['_id'])
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return
+        pending = self._pending[kind]
+        if doc['_id'] in pending:
+            return
+
+        fields = {k: v for k, v in doc.items() if k != '_id'}
+        pending[doc['_id']] = UpdateOne({'_id': doc['_id']}, {'$setOnInsert': fields}, upsert=True)
+        if len(pending) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, papers, contacts):
+        for doc in papers:
+            self.add('papers', doc)
+        for doc in contacts:
+            self.add('contacts', doc)
+
+    def flush(self):
+        for kind, pending in self._pending.items():
+            if not pending:
+                continue
+            ids, ops = list(pending.keys()), list(pending.values())
+            self._pending[kind] = OrderedDict()
+            failed = set()
+            try:
+                result = self.collections[kind].bulk_write(ops, ordered=False)
+                self.written += result.upserted_count
+            except BulkWriteError as err:
+                failed = set(e['index'] for e in err.details['writeErrors'])
+                logger.error('Could not write {:,} {}'.format(len(failed), kind))
+                self.written += err.details['nUpserted']
+
+            # Documents that failed are sent again the next time they are added.
+            for i, pk in enumerate(ids):
+                if i not in failed:
+                    self._remember((kind, pk))
+
+
+def _get(doc, field):
+    if isinstance(doc, dict):
+        return doc.get(field) or []
+    return getattr(doc, field) or []
+
+
+def dereference(docs, db):
+    """Resolve the papers and contacts of a page of BioSamples.
+
+    All referenced papers and contacts are fetched with a single `$in` query
+    per collection. Documents get `papers` and `contacts` in the same form as
+    the embedded layout: dictionaries for raw documents, and sramongo
+    `Pubmed` and `Contacts` documents for Biometa objects. Biometa objects
+    should not be saved afterwards, as that would embed them again.
+
+    Parameters:
+    -----------
+    docs: list
+        Biometa documents as dictionaries or Biometa objects.
+    db: pymongo.database.Database
+        Database with the papers and contacts collections.
+
+    Returns:
+    --------
+    list
+        The same documents.
+
+    """
+    from sramongo.mongo_schema import Pubmed
+    from biometalib.models import Contacts
+
+    found = {}
+    for kind, field in (('papers', 'paper_ids'), ('contacts', 'contact_ids')):
+        ids = set()
+        for doc in docs:
+            ids.update(_get(doc, field))
+        collection = db[PAPERS_COLLECTION if kind == 'papers' else CONTACTS_COLLECTION]
+        found[kind] = {}
+        if ids:
+            for x in collection.find({'_id': {'$in': sorted(ids)}}):
+                found[kind][x.pop('_id')] = x
+
+    for doc in docs:
+        papers = [found['papers'][x] for x in _get(doc, 'paper_ids') if x in found['papers']]
+        contacts = [found['contacts'][x] for x in _get(doc, 'contact_ids') if x in found['contacts']]
+        if isinstance(doc, dict):
+            doc['papers'] = papers
+            doc['contacts'] = contacts
+        else:
+            doc.papers = [Pubmed._from_son(x) for x in papers]
+            doc.contacts = [Contacts(**x) for x in contacts]
+    return docs
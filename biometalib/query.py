@@ -0,0 +1,292 @@
+"""Look up BioSamples by attribute.
+
+`BiometaQuery` answers questions like "BioSamples where sex is female in
+BioProject X" without hydrating mongoengine documents::
+
+    query = BiometaQuery(Biometa._get_collection())
+    ids = query.ids(attributes={'sex': 'female'}, bioproject='PRJNA0')
+    for doc in query.find(attributes={'sex': 'female'}, bioproject='PRJNA0', fields=['srp']):
+        ...
+
+Each filter, a sample attribute value or a value of a Biometa field, selects
+a set of BioSample IDs. The sets are cached as sorted NumPy arrays, so several
+filters are combined by intersecting arrays. Documents are then read a page at
+a time as plain dictionaries with only the requested fields.
+
+The cache of each process is bounded by size and age, and can be shared by
+threads. `initialize_biometa` (after each partition, or each batch when
+following), `apply_attributes` (once a run) and `Biometa.save` (when blinker
+is installed) clear the caches of the writing process and bump a version
+number in the `biometa_version` collection, which other processes check at
+most every `check_interval` seconds.
+"""
+import time
+import weakref
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from biometalib.logger import logger
+from biometalib import normalize
+
+VERSION_COLLECTION = 'biometa_version'
+
+# Biometa fields that can be used as filters.
+FILTER_FIELDS = ['bioproject', 'srp', 'srs', 'gsm', 'taxon_id', 'experiments.srx']
+
+DEFAULT_FIELDS = ['srs', 'gsm', 'srp', 'bioproject', 'taxon_id', 'sample_title', 'sample_attributes']
+
+# Caches of this process, cleared when it writes to Biometa.
+_caches = weakref.WeakSet()
+
+
+class IdCache(object):
+    def __init__(self, max_bytes=256 * 2 ** 20, ttl=600):
+        """LRU cache of BioSample ID arrays bounded by size and age.
+
+        The cache is guarded by a lock, so queries in several threads can
+        share it.
+
+        Parameters:
+        -----------
+        max_bytes: int
+            Largest total size of the cached arrays.
+        ttl: float
+            Seconds an array is kept.
+
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if (item is not None) and (time.time() - item[0] > self.ttl):
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, ids):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if ids.nbytes > self.max_bytes:
+                return
+            self._data[key] = (time.time(), ids)
+            self.nbytes += ids.nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        _, ids = self._data.pop(key)
+        self.nbytes -= ids.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+def invalidate():
+    """Clear the ID caches of this process."""
+    for cache in list(_caches):
+        cache.clear()
+
+
+def get_version(db):
+    doc = db[VERSION_COLLECTION].find_one({'_id': 'biometa'})
+    return None if doc is None else doc['version']
+
+
+def record_write(db):
+    """Invalidate cached lookups after writing to Biometa.
+
+    Parameters:
+    -----------
+    db: pymongo.database.Database
+        Database with the Biometa collection.
+
+    """
+    invalidate()
+    db[VERSION_COLLECTION].update_one({'_id': 'biometa'},
+                                      {'$inc': {'version': 1}, '$set': {'updated': datetime.now()}}, upsert=True)
+
+
+def to_ids(values):
+    """Sorted unique NumPy array of BioSample IDs."""
+    values = list(values)
+    if not values:
+        return np.array([], dtype='U1')
+    return np.unique(np.array(values, dtype=str))
+
+
+def intersect(arrays):
+    """IDs in every array, starting with the smallest."""
+    arrays = sorted(arrays, key=len)
+    result = arrays[0]
+    for ids in arrays[1:]:
+        if not len(result):
+            break
+        result = np.intersect1d(result, ids, assume_unique=True)
+    return result
+
+
+def filter_query(field, value):
+    """Raw query for a filter.
+
+    field is a Biometa field in `FILTER_FIELDS`, or `sample_attributes.<name>`.
+    """
+    if field.startswith('sample_attributes.'):
+        name = field[len('sample_attributes.'):]
+        return {'sample_attributes': {'$elemMatch': {'name': name, 'value': value}}}
+    if field not in FILTER_FIELDS:
+        raise ValueError('Can not filter on {!r}, use one of {} or an attribute'.format(
+            field, ', '.join(FILTER_FIELDS)))
+    return {field: value}
+
+
+class PagedCursor(object):
+    def __init__(self, collection, ids, fields=None, page_size=1000, dereference=False):
+        """BioSample documents as plain dictionaries, read a page at a time.
+
+        Parameters:
+        -----------
+        collection: pymongo.collection.Collection
+            The raw Biometa collection.
+        ids: numpy.ndarray
+            Sorted BioSample IDs.
+        fields: list of str
+            Fields to return, all fields if None.
+        page_size: int
+            Number of documents read per query.
+        dereference: bool
+            Resolve normalized papers and contacts, see
+            `biometalib.normalize.dereference`.
+
+        """
+        self.collection = collection
+        self.ids = ids
+        self.page_size = max(page_size, 1)
+        self.dereference = dereference
+        self.projection = None
+        if fields is not None:
+            self.projection = dict((x, 1) for x in fields)
+            if dereference:
+                self.projection.update({'paper_ids': 1, 'contact_ids': 1})
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def pages(self):
+        return (len(self.ids) + self.page_size - 1) // self.page_size
+
+    def page(self, n):
+        """Documents of the nth page, in BioSample order."""
+        ids = self.ids[n * self.page_size:(n + 1) * self.page_size].tolist()
+        if not ids:
+            return []
+        docs = {x['_id']: x for x in self.collection.find({'_id': {'$in': ids}}, self.projection)}
+        docs = [docs[x] for x in ids if x in docs]
+        if self.dereference:
+            normalize.dereference(docs, self.collection.database)
+        return docs
+
+    def __iter__(self):
+        for n in range(self.pages):
+            for doc in self.page(n):
+                yield doc
+
+
+class BiometaQuery(object):
+    def __init__(self, collection, cache=None, check_interval=5):
+        """Cached lookups of BioSamples by attribute.
+
+        Parameters:
+        -----------
+        collection: pymongo.collection.Collection
+            The raw Biometa collection.
+        cache: IdCache
+            Cache of ID arrays, a new one by default.
+        check_interval: float
+            Seconds between checks for writes made by other processes.
+
+        Methods:
+        --------
+        ids: method
+            Sorted BioSample IDs matching filters.
+        find: method
+            Documents matching filters.
+
+        """
+        self.collection = collection
+        self.cache = IdCache() if cache is None else cache
+        self.check_interval = check_interval
+        self._version = get_version(collection.database)
+        self._checked = time.time()
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        version = get_version(self.collection.database)
+        if version != self._version:
+            logger.debug('Biometa changed, clearing cached lookups')
+            self.cache.clear()
+            self._version = version
+
+    def lookup(self, field, value):
+        """Sorted BioSample IDs for a single filter."""
+        key = (field, value)
+        ids = self.cache.get(key)
+        if ids is None:
+            cursor = self.collection.find(filter_query(field, value), {'_id': 1})
+            ids = to_ids(x['_id'] for x in cursor)
+            self.cache.put(key, ids)
+        return ids
+
+    def ids(self, attributes=None, **fields):
+        """Sorted BioSample IDs matching every filter.
+
+        Parameters:
+        -----------
+        attributes: dict
+            Sample attribute names mapped to a value.
+        fields:
+            Biometa fields in `FILTER_FIELDS` mapped to a value. Use
+            `experiments__srx` for `experiments.srx`.
+
+        Returns:
+        --------
+        numpy.ndarray
+
+        """
+        filters = [('sample_attributes.' + k, v) for k, v in sorted((attributes or {}).items())]
+        filters += [(k.replace('__', '.'), v) for k, v in sorted(fields.items())]
+        if not filters:
+            raise ValueError('At least one filter is needed')
+
+        self._check_version()
+        return intersect([self.lookup(field, value) for field, value in filters])
+
+    def find(self, attributes=None, fields=DEFAULT_FIELDS, page_size=1000, dereference=False, **filters):
+        """Documents matching every filter, see `ids` and `PagedCursor`."""
+        return PagedCursor(self.collection, self.ids(attributes, **filters), fields=fields,
+                           page_size=page_size, dereference=dereference)
@@ -0,0 +1,144 @@
+"""Fast fuzzy matching of attribute names.
+
+Scoring every attribute name with fuzzywuzzy is too slow to do on each
+keypress, or for every pair of names. `SimilarityIndex` keeps a character
+n-gram inverted index of the names, so only names sharing the most n-grams
+with the query are scored.
+"""
+import re
+from collections import Counter, defaultdict
+from threading import Lock
+
+from fuzzywuzzy import fuzz
+
+
+def normalize(name):
+    """Lowercase words of a name joined by underscores.
+
+    Splits on punctuation, white space and camelCase, so `Dev Stage`,
+    `dev-stage` and `devStage` are all `dev_stage`.
+    """
+    name = re.sub(r'([a-z])([A-Z])', r'\1_\2', name)
+    return '_'.join(re.findall(r'[a-z]+|[0-9]+', name.lower()))
+
+
+def ngrams(name, n=3):
+    """Set of character n-grams of a name, padded so short names have one."""
+    name = ' {} '.format(name.lower())
+    return set(name[i:i + n] for i in range(max(len(name) - n + 1, 1)))
+
+
+class SimilarityIndex(object):
+    def __init__(self, names=(), n=3, candidates=200):
+        """N-gram index for finding similar attribute names.
+
+        Parameters:
+        -----------
+        names: iterable of str
+            Names to add to the index.
+        n: int
+            Length of the character n-grams.
+        candidates: int
+            Number of names sharing the most n-grams with the query that are
+            scored with fuzzywuzzy.
+
+        Methods:
+        --------
+        add: method
+            Add a name to the index.
+        similar: method
+            Get the names most similar to a query.
+
+        """
+        self.n = n
+        self.candidates = candidates
+        self._names = set()
+        self._index = defaultdict(set)
+        self._lock = Lock()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        with self._lock:
+            if name in self._names:
+                return
+            self._names.add(name)
+            for gram in ngrams(name, self.n):
+                self._index[gram].add(name)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def _candidates(self, query):
+        hits = Counter()
+        with self._lock:
+            for gram in ngrams(query, self.n):
+                hits.update(self._index.get(gram, ()))
+        return [x[0] for x in hits.most_common(self.candidates)]
+
+    def scores(self, query, limit=20):
+        """Most similar names and their scores (0-100), best match first."""
+        scores = [(x, fuzz.WRatio(query, x)) for x in self._candidates(query)]
+        scores.sort(key=lambda x: (-x[1], x[0]))
+        return scores[:limit]
+
+    def similar(self, query, limit=20):
+        """Names most similar to query, best match first."""
+        return [x[0] for x in self.scores(query, limit)]
+
+
+def suggest(names, mapping, min_score=80, candidates=50):
+    """Propose a selected attribute for each name.
+
+    Names are matched on their normalized form first and then by fuzzy
+    matching against every name already in the mapping. Names that match
+    nothing are grouped by normalized form, and groups of more than one
+    name are proposed as a new selected attribute.
+
+    Parameters:
+    -----------
+    names: iterable of str
+        Attribute names without a decision.
+    mapping: dict
+        Known attribute names mapped to their selected attribute, which may
+        be `ignore`.
+    min_score: int
+        Lowest fuzzy matching score to propose.
+    candidates: int
+        Number of names scored for each name, see `SimilarityIndex`.
+
+    Returns:
+    --------
+    dict
+        Name mapped to a tuple of the proposed selected attribute and a
+        score (0-100).
+
+    """
+    known = {}
+    for k, v in mapping.items():
+        known.setdefault(normalize(k), v)
+    index = SimilarityIndex(known, candidates=candidates)
+
+    proposals = {}
+    unmatched = defaultdict(list)
+    for name in names:
+        key = normalize(name)
+        if key in known:
+            proposals[name] = (known[key], 100)
+            continue
+
+        best = index.scores(key, limit=1)
+        if best and (best[0][1] >= min_score):
+            proposals[name] = (known[best[0][0]], best[0][1])
+        elif key:
+            unmatched[key].append(name)
+
+    for key, group in unmatched.items():
+        if len(group) > 1:
+            for name in group:
+                proposals[name] = (key, 100)
+
+    return proposals
@@ -0,0 +1,174 @@
+"""Local SQLite snapshot of the attribute catalog.
+
+A snapshot holds what attribute_selector needs from MongoDB: every sample
+attribute name with its number of samples, BioProjects and distinct values,
+and the most common values of each name. Curators can run attribute_selector
+against a snapshot file, so the database is not queried while curating and
+each lookup is an indexed read of a local file.
+"""
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from threading import Lock
+
+from biometalib.logger import logger
+from biometalib.attribute_stats import STATS_COLLECTION, values_pipeline, projects_pipeline
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE attributes (
+    name TEXT PRIMARY KEY,
+    samples INTEGER NOT NULL DEFAULT 0,
+    projects INTEGER NOT NULL DEFAULT 0,
+    distinct_values INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE attribute_values (
+    name TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    value TEXT,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (name, rank)
+) WITHOUT ROWID;
+"""
+
+
+def _iter_stats(biometa, top=40):
+    """Attribute statistics from the attribute_stats collection, or computed on the fly."""
+    stats = biometa.database[STATS_COLLECTION]
+    if stats.find_one() is not None:
+        logger.info('Reading statistics from {}'.format(STATS_COLLECTION))
+        for doc in stats.find({}):
+            doc['values'] = doc.get('values', [])[:top]
+            yield doc
+        return
+
+    logger.info('No {} collection, computing statistics'.format(STATS_COLLECTION))
+    for doc in biometa.aggregate(values_pipeline(top=top), allowDiskUse=True):
+        yield doc
+    for doc in biometa.aggregate(projects_pipeline(), allowDiskUse=True):
+        yield doc
+
+
+def create_snapshot(biometa, fn, top=40, batch_size=5000):
+    """Write a snapshot of the attribute catalog.
+
+    The snapshot is written to a temporary file that replaces fn once it is
+    complete.
+
+    Parameters:
+    -----------
+    biometa: pymongo.collection.Collection
+        The Biometa collection.
+    fn: str
+        SQLite file to write.
+    top: int
+        Number of the most common values to keep for each attribute.
+
+    Returns:
+    --------
+    int
+        Number of attribute names in the snapshot.
+
+    """
+    fh = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(fn)), suffix='.sqlite', delete=False)
+    fh.close()
+    db = sqlite3.connect(fh.name)
+    try:
+        db.executescript(SCHEMA)
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('created', datetime.now().isoformat()),
+            ('database', biometa.database.name),
+            ('top', str(top)),
+        ])
+
+        attrs, values = [], []
+        # Computed statistics come in two passes per name, so counts seen so
+        # far are merged here. UPSERT would need SQLite 3.24, newer than the
+        # one bundled with older Pythons.
+        counts = {}
+
+        def flush():
+            db.executemany('INSERT OR REPLACE INTO attributes VALUES (?, ?, ?, ?)', attrs)
+            db.executemany('INSERT OR REPLACE INTO attribute_values VALUES (?, ?, ?, ?)', values)
+            del attrs[:], values[:]
+
+        for doc in _iter_stats(biometa, top):
+            row = (doc.get('samples', 0), doc.get('projects', 0), doc.get('distinct_values', 0))
+            if doc['_id'] in counts:
+                row = tuple(max(x, y) for x, y in zip(row, counts[doc['_id']]))
+            counts[doc['_id']] = row
+            attrs.append((doc['_id'], ) + row)
+            for i, x in enumerate(doc.get('values', [])):
+                values.append((doc['_id'], i, x['value'], x['count']))
+            if len(attrs) >= batch_size:
+                flush()
+        flush()
+
+        n = db.execute('SELECT count(*) FROM attributes').fetchone()[0]
+        db.commit()
+    finally:
+        db.close()
+
+    os.replace(fh.name, fn)
+    return n
+
+
+class Snapshot(object):
+    def __init__(self, fn, mmap_size=2 ** 28):
+        """Read-only access to a snapshot file.
+
+        The file is opened read-only and memory mapped. Lookups may come from
+        several threads (see `Prefetcher`), so they share a single
+        connection behind a lock.
+
+        Parameters:
+        -----------
+        fn: str
+            SQLite file written by `create_snapshot`.
+        mmap_size: int
+            Number of bytes of the file to memory map.
+
+        Methods:
+        --------
+        get_list_sample_attrs: method
+            Get the names of sample attributes.
+        get_attribute_stats: method
+            Get statistics for an attribute name.
+
+        """
+        if not os.path.exists(fn):
+            raise IOError('Snapshot does not exist: {}'.format(fn))
+        self.fn = fn
+        self._db = sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(fn)), uri=True,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+        self._lock = Lock()
+        self.meta = dict(self._query('SELECT key, value FROM meta'))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def get_list_sample_attrs(self, counts=False):
+        """Names of sample attributes, with the number of samples if counts is True."""
+        rows = self._query('SELECT name, samples FROM attributes')
+        if counts:
+            return dict(rows)
+        return set(x[0] for x in rows)
+
+    def get_attribute_stats(self, name):
+        """Statistics for an attribute name, like `attribute_stats.get_attribute_stats`."""
+        stats = {'_id': name, 'samples': 0, 'projects': 0, 'distinct_values': 0, 'values': []}
+        row = self._query('SELECT samples, projects, distinct_values FROM attributes WHERE name = ?', (name, ))
+        if row:
+            stats['samples'], stats['projects'], stats['distinct_values'] = row[0]
+            stats['values'] = [
+                {'value': value, 'count': count}
+                for value, count in self._query(
+                    'SELECT value, count FROM attribute_values WHERE name = ? ORDER BY rank', (name, ))
+            ]
+        return stats
+
+    def close(self):
+        self._db.close()
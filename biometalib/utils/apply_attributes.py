@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Apply attribute_selector decisions to the Biometa collection.
+
+This program reads the YAML written by attribute_selector and stores the
+values of the selected attributes of each BioSample in
+`user_annotation.<name>`. Re-running it after the YAML changed only updates
+BioSamples affected by the changed decisions.
+"""
+import os
+import sys
+import time
+import argparse
+from argparse import RawDescriptionHelpFormatter as Raw
+from logging import INFO, DEBUG
+import multiprocessing
+from collections import Counter
+
+sys.path.insert(0, '../')
+from biometalib.logger import logger
+from biometalib.models import Biometa, get_cleaned_attributes
+from biometalib import annotate
+from biometalib.coerce import Coercer
+from biometalib.query import record_write
+from biometalib.utils.attribute_selector import BioAttribute
+from biometalib.utils.initialize_biometa import BiometaWriter, connect_mongo
+
+_DEBUG = False
+
+def arguments():
+    """Pulls in command line arguments."""
+
+    DESCRIPTION = """\
+    This program applies the attribute decisions in an attribute_selector
+    YAML to the Biometa collection. For each BioSample the values of sample
+    attributes are stored under user_annotation.<name>, keyed by their
+    selected attribute. Ignored attributes, and selected attributes that are
+    not in cleaned_fields.yaml, are left out.
+
+    The applied decisions are recorded, so later runs only update BioSamples
+    using an attribute whose decision changed, or that were never annotated.
+    """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=Raw)
+
+    db_args = parser.add_argument_group('Database Arguments')
+    config = parser.add_argument_group('Inputs')
+
+    db_args.add_argument("--host", dest="host", action='store', default='localhost', required=False,
+                         help="Host running a mongo database. [default: localhost]")
+
+    db_args.add_argument("--port", dest="port", action='store', type=int, required=False, default=27017,
+                         help="Mongo database port. [default: 27017]")
+
+    db_args.add_argument("--db", dest="db", action='store', required=True,
+                        help="Name of the mongo database containing the biometa collection.")
+
+    db_args.add_argument("--username", dest="username", action='store', required=False,
+                        help="MongoDB username to connect with.")
+
+    db_args.add_argument("--password", dest="password", action='store', required=False,
+                        help="MongoDB password.")
+
+    db_args.add_argument("--authenticationDatabase", dest="authDB", action='store', required=False,
+                        help="MongoDB database to authenticate against.")
+
+    db_args.add_argument("--batch-size", dest="batch_size", action='store', type=int, required=False, default=1000,
+                         help="Number of updates to send in a single bulk write. [default: 1000]")
+
+    db_args.add_argument("--unordered", dest="ordered", action='store_false', required=False,
+                         help="Use unordered bulk writes, allowing the server to apply a batch in parallel.")
+
+    config.add_argument("--config", dest="config", action='store', required=True,
+                        help="YAML file with attribute decisions from attribute_selector.")
+
+    config.add_argument("--name", dest="name", action='store', required=False,
+                        help="Key to store the annotation under in user_annotation. "
+                             "[default: name of the YAML without its extension]")
+
+    parser.add_argument("--engine", dest="engine", action='store', choices=['python', 'aggregate'],
+                        required=False, default='python',
+                        help="Apply decisions in python with batched writes, or on the server with an "
+                             "aggregation pipeline that $merges into biometa (MongoDB 4.2+). [default: python]")
+
+    parser.add_argument("--workers", dest="workers", action='store', type=int, required=False, default=1,
+                        help="Number of worker processes. Each worker handles a disjoint range of "
+                             "BioSamples with its own database connection. [default: 1]")
+
+    parser.add_argument("--full", dest="full", action='store_true', required=False,
+                        help="Re-apply decisions to every BioSample instead of only those affected by "
+                             "changed decisions.")
+
+    parser.add_argument("--debug", dest="debug", action='store_true', required=False,
+                        help="Turn on debug output.")
+
+    args = parser.parse_args()
+
+    if args.name is None:
+        args.name = os.path.splitext(os.path.basename(args.config))[0]
+    try:
+        annotate.check_name(args.name)
+    except ValueError as err:
+        parser.error(str(err))
+
+    # Set logging level
+    if args.debug:
+        logger.setLevel(DEBUG)
+        global _DEBUG
+        _DEBUG = True
+        logger.debug('Debugging On')
+    else:
+        logger.setLevel(INFO)
+
+    return args
+
+
+def apply_mapping(collection, query, name, mapping, schema=None, batch_size=1000, ordered=True):
+    """Annotate the BioSamples matching a query in python.
+
+    Parameters:
+    -----------
+    collection: pymongo.collection.Collection
+        The raw Biometa collection.
+    query: dict
+        Raw query selecting the BioSamples to annotate.
+    name: str
+        Annotation name.
+    mapping: dict
+        Sample attribute names mapped to their selected attribute, see
+        `biometalib.annotate.get_mapping`.
+    schema: dict
+        Cleaned attributes with their type. Values are coerced to these
+        types a batch at a time, see `biometalib.coerce.Coercer`.
+
+    Returns:
+    --------
+    collections.Counter
+        Number of BioSamples read, annotated and written, and the number of
+        values of each field that could not be parsed.
+
+    """
+    stats = Counter()
+    writer = BiometaWriter(collection, batch_size=batch_size, ordered=ordered, upsert=False)
+    coercer = Coercer(schema or {}, separator=annotate.SEPARATOR)
+    field = 'set__user_annotation__{}'.format(name)
+
+    def write(ids, annotations):
+        coercer.coerce_records(annotations)
+        for pk, annotation in zip(ids, annotations):
+            stats['annotated'] += bool(annotation)
+            stats['values'] += len(annotation)
+            writer.add(pk, pk, **{field: annotation})
+
+    ids, annotations = [], []
+    cursor = collection.find(query, {'sample_attributes': 1}, batch_size=batch_size).sort('_id', 1)
+    for doc in cursor:
+        stats['biosamples'] += 1
+        ids.append(doc['_id'])
+        annotations.append(annotate.annotate(doc.get('sample_attributes'), mapping))
+        if len(ids) >= batch_size:
+            write(ids, annotations)
+            ids, annotations = [], []
+    write(ids, annotations)
+
+    writer.flush()
+    writer.summary()
+    stats['written'] += writer.written
+    stats['errors'] += writer.errors
+    for attr, count, examples in coercer.summary():
+        stats['unparsed'] += count
+        logger.debug('Could not parse {:,} values of {}, e.g. {}'.format(count, attr, examples))
+    stats.update({'unparsed.' + k: v for k, v in coercer.unparsed.items()})
+    return stats
+
+
+def aggregate_mapping(collection, query, name, mapping):
+    """Annotate the BioSamples matching a query on the server."""
+    start = time.time()
+    collection.aggregate(annotate.annotation_pipeline(query, name, mapping, into=collection.name),
+                         allowDiskUse=True)
+    logger.info('Aggregated into {} in {:.3f}s'.format(collection.name, time.time() - start))
+    return Counter()
+
+
+def apply_range(job):
+    """Annotate a single range of BioSamples."""
+    args, query, mapping, schema, lower, upper = job
+    collection = Biometa._get_collection()
+    bounds = annotate.id_range_query(lower, upper)
+    if bounds:
+        query = {'$and': [query, bounds]} if query else bounds
+
+    if args.engine == 'aggregate':
+        return aggregate_mapping(collection, query, args.name, mapping)
+    return apply_mapping(collection, query, args.name, mapping, schema=schema, batch_size=args.batch_size,
+                         ordered=args.ordered)
+
+
+def _apply_range(job):
+    """Worker process entry point for a single BioSample range."""
+    args, query, mapping, schema, lower, upper = job
+    connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+    logger.info('Worker {} processing BioSamples [{}, {})'.format(os.getpid(), lower or '', upper or ''))
+    return apply_range(job)
+
+
+def run_workers(args, jobs):
+    """Run each BioSample range in its own process and merge their stats."""
+    ctx = multiprocessing.get_context('spawn')
+    stats = Counter()
+    with ctx.Pool(args.workers) as pool:
+        for i, result in enumerate(pool.imap_unordered(_apply_range, jobs)):
+            stats.update(result)
+            logger.info('Finished {} of {} ranges'.format(i + 1, len(jobs)))
+    return stats
+
+
+def main():
+    # Import commandline arguments.
+    args = arguments()
+
+    # Connect to database
+    logger.info('Connecting to MongoDB at: {}:{}'.format(args.host, args.port))
+    client = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+    db = Biometa._get_db()
+
+    # Decisions that can be stored in CleanedAttributes
+    schema = get_cleaned_attributes()
+    fields = schema
+    if args.engine == 'aggregate':
+        # The server does not coerce values, so only string fields are kept.
+        fields = [k for k, v in schema.items() if v['type'] == 'string']
+    mapping, dropped = annotate.get_mapping(BioAttribute(args.config), fields=fields)
+    if dropped:
+        logger.warning('Skipping selected attributes that are not {}fields in cleaned_fields.yaml: {}'.format(
+            'string ' if args.engine == 'aggregate' else '', ', '.join(sorted(dropped))))
+
+    # Figure out which BioSamples need to be updated
+    previous = None if args.full else annotate.load_state(db, args.name)
+    if previous is None:
+        logger.info('Applying {:,} decisions to every BioSample'.format(len(mapping)))
+        query = annotate.get_query(args.name)
+    else:
+        changed = annotate.changed_attributes(previous, mapping)
+        logger.info('{:,} decisions changed since the last run'.format(len(changed)))
+        query = annotate.get_query(args.name, changed)
+
+    ranges = annotate.get_id_ranges(Biometa._get_collection(), query, args.workers)
+    jobs = [(args, query, mapping, schema, lower, upper) for lower, upper in ranges]
+
+    if (args.workers > 1) and (len(jobs) > 1):
+        logger.info('Processing {} BioSample ranges with {} workers'.format(len(jobs), args.workers))
+        stats = run_workers(args, jobs)
+    else:
+        stats = Counter()
+        for job in jobs:
+            stats.update(apply_range(job))
+
+    annotate.save_state(db, args.name, mapping)
+    record_write(db)
+
+    if args.engine == 'python':
+        logger.info('Annotated {:,} of {:,} BioSamples with {:,} values ({:,} unparsed, {:,} errors)'.format(
+            stats['annotated'], stats['biosamples'], stats['values'], stats['unparsed'], stats['errors']))
+        for key, count in sorted(stats.items()):
+            if key.startswith('unparsed.'):
+                logger.info('Could not parse {:,} values of {}'.format(count, key[len('unparsed.'):]))
+
+if __name__ == '__main__':
+    main()
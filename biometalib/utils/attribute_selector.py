@@ -1,21 +1,31 @@
 #!/usr/bin/env python
 import os
 import sys
+import json
+import shutil
+import tempfile
 import readline
 from textwrap import dedent
 import argparse
 from argparse import RawDescriptionHelpFormatter as Raw
 from logging import INFO, DEBUG
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from ruamel import yaml
 
 from pymongo import MongoClient
-from fuzzywuzzy import process
-
+from pymongo.errors import OperationFailure
 from biometalib.logger import logger
+from biometalib.similarity import SimilarityIndex, suggest
+from biometalib.yaml_cache import load_yaml, save_cache
+from biometalib.attribute_stats import STATS_COLLECTION, get_attribute_stats, refresh_attribute_stats
+from biometalib.snapshot import Snapshot
 
 _DEBUG = False
+prefetcher = None
+snapshot = None
 
 def arguments():
     """Pulls in command line arguments."""
@@ -34,9 +44,13 @@ def arguments():
     db_args.add_argument("--port", dest="port", action='store', type=int, required=False, default=27017,
                          help="Mongo database port. [default: 27017]")
 
-    db_args.add_argument("--db", dest="db", action='store', required=True,
+    db_args.add_argument("--db", dest="db", action='store', required=False,
                         help="Name of the mongo database containing the biometa collection.")
 
+    db_args.add_argument("--snapshot", dest="snapshot", action='store', required=False,
+                         help="Read attributes from a snapshot written by attribute_snapshot instead of "
+                              "from the database.")
+
     db_args.add_argument("--username", dest="username", action='store', required=False,
                         help="MongoDB username to connect with.")
 
@@ -49,11 +63,37 @@ def arguments():
     config.add_argument("--config", dest="config", action='store', required=True,
                         help="YAML file to store attribute decisions")
 
+    config.add_argument("--suggest", dest="suggest", action='store', required=False,
+                        help="Do not run interactively. Instead write proposed renames and ignores for every "
+                             "attribute not in the config to this YAML, with their confidence scores.")
+
+    config.add_argument("--min-score", dest="min_score", action='store', type=int, required=False, default=80,
+                        help="Lowest fuzzy matching score to propose with --suggest. [default: 80]")
+
+    config.add_argument("--confident-score", dest="confident_score", action='store', type=int, required=False,
+                        default=95, help="Proposals below this score are marked for review. [default: 95]")
+
+    parser.add_argument("--prefetch", dest="prefetch", action='store', type=int, required=False, default=3,
+                        help="Number of upcoming attributes to look up examples and similar attributes for "
+                             "in the background. Use 0 to turn off. [default: 3]")
+
+    parser.add_argument("--sort-by-count", dest="sort_by_count", action='store_true', required=False,
+                        help="Go through the most commonly used attributes first.")
+
+    parser.add_argument("--refresh-stats", dest="refresh_stats", action='store_true', required=False,
+                        help="Rebuild the attribute_stats collection before starting.")
+
     parser.add_argument("--debug", dest="debug", action='store_true', required=False,
                         help="Turn on debug output.")
 
     args = parser.parse_args()
 
+    if (args.db is None) == (args.snapshot is None):
+        parser.error('Give exactly one of --db or --snapshot.')
+
+    if (args.snapshot is not None) and args.refresh_stats:
+        parser.error('--refresh-stats needs --db.')
+
     # Set logging level
     if args.debug:
         logger.setLevel(DEBUG)
@@ -69,7 +109,10 @@ class BioAttribute(object):
     def __init__(self, fn):
         """Column attributes.
 
-        Uses YAMLs to store column attributes.
+        Uses YAMLs to store column attributes. Every change is also appended
+        to a journal next to the YAML (`<fn>.journal`), so decisions survive
+        a crash. The journal is replayed when the YAML is loaded and removed
+        once it has been written into the YAML.
 
         Parameters:
         -----------
@@ -83,26 +126,76 @@ class BioAttribute(object):
 
         """
         self.fn = fn
+        self.journal = fn + '.journal'
+        self._journal = None
         self._storage = self._load_attributes()
         self._reverse = self._make_reverse()
         self.current_attrs = [x for x in self._storage.keys() if x != 'ignore']
+        self._replay_journal()
 
     def _load_attributes(self):
         """Load YAML if it exists.
 
         Checks if the YAML config file exits, if it does returns a dictionary
-        version of the YAML.
+        version of the YAML. Comments are not kept, so the YAML is loaded
+        through the cache in `biometalib.yaml_cache`.
         """
         if os.path.exists(self.fn):
-            with open(self.fn, 'r') as fh:
-                return yaml.load(fh, Loader=yaml.RoundTripLoader)
+            return load_yaml(self.fn)
         else:
             return {}
 
+    def _replay_journal(self):
+        """Apply decisions from the journal that are not in the YAML yet.
+
+        The last line may be partially written after a crash. Replay stops
+        there and the journal is truncated after the last complete decision,
+        so decisions appended later are not lost behind the torn line.
+        """
+        if not os.path.exists(self.journal):
+            return
+
+        good = 0
+        with open(self.journal, 'rb') as fh:
+            for line in fh:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Incomplete line')
+                    decision = json.loads(line.decode('utf-8'))
+                    attr, selected = decision['attr'], decision['selected']
+                except (ValueError, KeyError, TypeError):
+                    break
+                good += len(line)
+
+                if selected is None:
+                    self._reverse.pop(attr, None)
+                    continue
+
+                self._reverse[attr] = selected
+                if (selected != 'ignore') and (selected not in self.current_attrs):
+                    self.current_attrs.append(selected)
+
+        if good < os.path.getsize(self.journal):
+            logger.warning('Dropping a partially written decision from {}'.format(self.journal))
+            with open(self.journal, 'r+b') as fh:
+                fh.truncate(good)
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def _log(self, attr, selected):
+        """Append a decision to the journal and flush it to disk."""
+        if self._journal is None:
+            self._journal = open(self.journal, 'a')
+        self._journal.write(json.dumps({'attr': attr, 'selected': selected}) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
     def write_attributes(self):
         """Writes current attribute.
 
-        Writes the current attributes to YAML.
+        Writes the current attributes to YAML. The YAML is written to a
+        temporary file which then replaces the original, so it is never left
+        half written. The journal is removed afterwards.
         """
         updated = OrderedDict()
         for k, v in self._reverse.items():
@@ -111,9 +204,22 @@ class BioAttribute(object):
             except:
                 updated[v] = [k, ]
 
-        updated = yaml.comments.CommentedMap(updated)
-        with open(self.fn, 'w') as fh:
-            yaml.dump(updated, fh, default_flow_style=False, block_seq_indent=2, Dumper=yaml.RoundTripDumper)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.fn)), delete=False) as fh:
+            yaml.dump(yaml.comments.CommentedMap(updated), fh, default_flow_style=False, block_seq_indent=2,
+                      Dumper=yaml.RoundTripDumper)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        if os.path.exists(self.fn):
+            shutil.copymode(self.fn, fh.name)
+        os.replace(fh.name, self.fn)
+        save_cache(self.fn, updated)
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
 
     def _make_reverse(self):
         """Create a reverse mapping dictionary.
@@ -132,9 +238,11 @@ class BioAttribute(object):
 
     def __setitem__(self, key, value):
         self._reverse[key] = value
+        self._log(key, value)
 
     def __delitem__(self, key):
         del(self._reverse[key])
+        self._log(key, None)
 
     def __iter__(self):
         return iter(self._reverse)
@@ -149,6 +257,96 @@ class BioAttribute(object):
         return self._reverse.items()
 
 
+def write_suggestions(proposals, fn, confident_score=95):
+    """Write proposed attribute decisions to YAML.
+
+    Uses the same layout as the config, so accepted proposals can be copied
+    over. Each attribute has its score as a comment, and proposals below
+    confident_score are marked for review.
+    """
+    grouped = defaultdict(list)
+    for attr, (selected, score) in proposals.items():
+        grouped[selected].append((attr, score))
+
+    updated = yaml.comments.CommentedMap()
+    for selected in sorted(grouped):
+        seq = yaml.comments.CommentedSeq()
+        for i, (attr, score) in enumerate(sorted(grouped[selected], key=lambda x: (-x[1], x[0]))):
+            seq.append(attr)
+            comment = 'score: {}'.format(score)
+            if score < confident_score:
+                comment += ' REVIEW'
+            seq.yaml_add_eol_comment(comment, i)
+        updated[selected] = seq
+
+    with open(fn, 'w') as fh:
+        yaml.dump(updated, fh, default_flow_style=False, block_seq_indent=2, Dumper=yaml.RoundTripDumper)
+
+
+class Prefetcher(object):
+    def __init__(self, workers=2, size=50):
+        """Compute and cache results in background threads.
+
+        Results are cached under a key of (kind, attribute), and the oldest
+        results are dropped once there are more than `size` of them.
+
+        Parameters:
+        -----------
+        workers: int
+            Number of background threads.
+        size: int
+            Maximum number of results to cache.
+
+        Methods:
+        --------
+        prefetch: method
+            Start computing a result in the background.
+        get: method
+            Get a result, waiting for it if needed. Results that raised
+            are not kept.
+        clear: method
+            Drop all cached results of a kind.
+        shutdown: method
+            Stop the background threads.
+
+        """
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def prefetch(self, key, fn, *args):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            future = self._executor.submit(fn, *args)
+            self._cache[key] = future
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+            return future
+
+    def get(self, key, fn, *args):
+        """Result for a key. A failed result is dropped so the next call retries."""
+        future = self.prefetch(key, fn, *args)
+        try:
+            return future.result()
+        except Exception:
+            with self._lock:
+                if self._cache.get(key) is future:
+                    del self._cache[key]
+            raise
+
+    def clear(self, kind):
+        with self._lock:
+            for key in [x for x in self._cache if x[0] == kind]:
+                del self._cache[key]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
 def connect_mongo(host, port, db, u, p, auth_db):
     client = MongoClient(host=host, port=port)
     if (u is not None) & (p is not None) & (auth_db is not None):
@@ -157,14 +355,68 @@ def connect_mongo(host, port, db, u, p, auth_db):
     return db['biometa']
 
 
-def get_list_sample_attrs(biometa):
-    cursor = biometa.aggregate([
-        {'$unwind': '$sample_attributes'},
-        {
-            '$project': {'_id': '$sample_attributes.name'}
-        }
-    ])
-    return set([x['_id'] for x in cursor])
+def check_indexes(biometa):
+    """Warn if the index used to look up sample attributes is missing.
+
+    Indexes are built by `biometa_indexes` instead of by the tools, since
+    building them on a large collection takes a while.
+
+    Returns:
+    --------
+    bool
+        True if sample attributes are indexed.
+
+    """
+    try:
+        indexes = biometa.index_information()
+    except OperationFailure:
+        return True
+    if any(x['key'][0][0] == 'sample_attributes.name' for x in indexes.values()):
+        return True
+    logger.warning('There is no index on sample_attributes.name, so looking up attributes scans every BioSample. '
+                   'Run biometa_indexes --db {} to build it.'.format(biometa.database.name))
+    return False
+
+
+def get_list_sample_attrs(biometa, counts=False, batch_size=5000):
+    """Get the names of sample attributes.
+
+    Parameters:
+    -----------
+    biometa: pymongo.collection.Collection
+        The Biometa collection.
+    counts: bool
+        If True return a dictionary with the number of samples using each
+        name.
+    batch_size: int
+        Number of names to get from the server at a time.
+
+    """
+    if not counts:
+        return set(biometa.distinct('sample_attributes.name'))
+
+    stats = biometa.database[STATS_COLLECTION]
+    if stats.find_one() is not None:
+        cursor = stats.find({}, {'samples': 1}, batch_size=batch_size)
+    else:
+        cursor = biometa.aggregate([
+            {'$project': {'_id': 0, 'sample_attributes.name': 1}},
+            {'$unwind': '$sample_attributes'},
+            {'$group': {'_id': '$sample_attributes.name', 'samples': {'$sum': 1}}},
+        ], allowDiskUse=True, batchSize=batch_size)
+    return {x['_id']: x['samples'] for x in cursor}
+
+
+def get_novel_attrs(sample_attrs, bioAttr, sort_by_count=False):
+    """Sample attributes not in the YAML yet.
+
+    Sorted by name, or by the number of samples using them (most used
+    first, ties by name) if sample_attrs has counts and sort_by_count is set.
+    """
+    attrs = sorted([x for x in sample_attrs if x not in bioAttr])
+    if sort_by_count:
+        attrs.sort(key=lambda x: sample_attrs[x], reverse=True)
+    return attrs
 
 
 def autocomplete(text, state):
@@ -200,35 +452,27 @@ def format_examples(examples):
     return exp
 
 
+def lookup_stats(attr):
+    """Get statistics for an attribute from the snapshot or the database."""
+    if snapshot is not None:
+        return snapshot.get_attribute_stats(attr)
+    return get_attribute_stats(biometa, attr)
+
+
 def get_examples(attr):
     """Get a list of values from the database."""
-    # Count the number of samples with that attribute
-    num_samples = len(list(biometa.aggregate([
-        {'$unwind': '$sample_attributes'},
-        {'$match': {'sample_attributes.name': attr}},
-    ])))
-
-    # Count the number of projects that used attribute
-    num_projects = len(list(biometa.aggregate([
-        {'$unwind': '$sample_attributes'},
-        {'$match': {'sample_attributes.name': attr}},
-        {'$group': {'_id': '$bioproject'}},
-    ])))
-
-    # Get a list of all values from the attribute
-    values = biometa.aggregate([
-        {'$unwind': '$sample_attributes'},
-        {'$match': {'sample_attributes.name': attr}},
-        {
-            '$project': {'_id': '$sample_attributes.value'}
-        }
-    ])
-
-    exp = format_examples(set([x['_id'] for x in values]))
+    if prefetcher is not None:
+        stats = prefetcher.get(('examples', attr), lookup_stats, attr)
+    else:
+        stats = lookup_stats(attr)
+    values = ['{} ({:,})'.format(x['value'], x['count']) for x in stats['values']]
+
+    exp = format_examples(values)
     print(dedent( """
         There were {0}{2:,}{1} BioSamples and {0}{3:,}{1} BioProjects that had this attribute.
-        Here are the values:\n\n{4}\n
-        """.format(bcolors.YELLOW, bcolors.ENDC, num_samples, num_projects, exp)))
+        Here are the {0}{4:,}{1} most common of {0}{5:,}{1} values:\n\n{6}\n
+        """.format(bcolors.YELLOW, bcolors.ENDC, stats['samples'], stats['projects'], len(values),
+                   stats['distinct_values'], exp)))
 
 
 def format_similar(attrs):
@@ -253,8 +497,10 @@ def format_similar(attrs):
 
 def get_similar(attr):
     """Print a list of similar attributes based on fuzzy string matching."""
-    choices = list(set(sample_attrs).union(set(bioAttr.current_attrs)))
-    similar = [x[0] for x in process.extract(attr, sample_attrs, limit=20)]
+    if prefetcher is not None:
+        similar = prefetcher.get(('similar', attr), similarity.similar, attr)
+    else:
+        similar = similarity.similar(attr)
     similar_fmt = format_similar(similar)
     print("Current similar attributes you have already selected include:\n\n{0}".format(similar_fmt))
 
@@ -266,11 +512,12 @@ def get_user_input(attr):
     ui = input(dedent("""
           Type "e" to get examples or "s" to get a list of similar attributes.
           Do you want to keep, rename, or ignore this attribute?
-          [k/r/i/e/s]: """))
+          [k/r/i/e/s/w]: """))
 
     if ui == 'k':   # Keep attribute
         bioAttr[attr] = attr
         bioAttr.current_attrs.append(attr)
+        similarity.add(attr)
         os.system('clear')
     elif ui == 'i':     # Ignore attribute
         bioAttr[attr] = 'ignore'
@@ -279,6 +526,10 @@ def get_user_input(attr):
         newName = input('Type in new name: ')
         bioAttr[attr] = newName
         bioAttr.current_attrs.append(newName)
+        if newName not in similarity:
+            similarity.add(newName)
+            if prefetcher is not None:
+                prefetcher.clear('similar')
         os.system('clear')
     elif ui == 'e':     # show example values
         get_examples(attr)
@@ -286,6 +537,10 @@ def get_user_input(attr):
     elif ui == 's':     # show similar attributes
         get_similar(attr)
         get_user_input(attr)
+    elif ui == 'w':     # save decisions to the YAML
+        bioAttr.write_attributes()
+        print('\nSaved decisions to {}'.format(bioAttr.fn))
+        get_user_input(attr)
     elif ui == 'n':      # skip
         os.system('clear')
         pass
@@ -308,16 +563,44 @@ def main():
     global bioAttr
     bioAttr = BioAttribute(args.config)
 
-    # connect to db
-    global biometa
-    biometa = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
-
-    # Get list of column attributes
+    # connect to db, or read everything from a snapshot
+    global biometa, snapshot
     global sample_attrs
-    sample_attrs = get_list_sample_attrs(biometa)
+    if args.snapshot is not None:
+        snapshot = Snapshot(args.snapshot)
+        logger.info('Using snapshot of {} from {}'.format(snapshot.meta.get('database'), snapshot.meta.get('created')))
+        sample_attrs = snapshot.get_list_sample_attrs(counts=args.sort_by_count)
+    else:
+        biometa = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+
+        check_indexes(biometa)
+
+        if args.refresh_stats:
+            refresh_attribute_stats(biometa)
+
+        # Get list of column attributes
+        sample_attrs = get_list_sample_attrs(biometa, counts=args.sort_by_count)
+
+    # Index attribute names for fuzzy matching
+    global similarity
+    similarity = SimilarityIndex(set(sample_attrs).union(bioAttr.current_attrs))
 
     # Only look at attributes not already in our YAML
-    filter_attrs = [x for x in sample_attrs if x not in bioAttr]
+    filter_attrs = get_novel_attrs(sample_attrs, bioAttr, sort_by_count=args.sort_by_count)
+
+    # Propose decisions for all novel attributes at once
+    if args.suggest is not None:
+        proposals = suggest(filter_attrs, dict(bioAttr.items()), min_score=args.min_score)
+        write_suggestions(proposals, args.suggest, confident_score=args.confident_score)
+        logger.info('Proposed decisions for {:,} of {:,} attributes ({:,} need review), written to {}'.format(
+            len(proposals), len(filter_attrs), sum(1 for x in proposals.values() if x[1] < args.confident_score),
+            args.suggest))
+        return
+
+    # Look up upcoming attributes while the curator is busy
+    global prefetcher
+    if args.prefetch > 0:
+        prefetcher = Prefetcher()
 
     # Iterate over novel attributes and figure out what to do with them
     os.system('clear')
@@ -330,12 +613,19 @@ def main():
                  """.format(bcolors.YELLOW, len(filter_attrs), bcolors.ENDC)))
 
     try:
-        for attr in sorted(filter_attrs):
+        for i, attr in enumerate(filter_attrs):
+            if prefetcher is not None:
+                for upcoming in filter_attrs[i:i + args.prefetch + 1]:
+                    prefetcher.prefetch(('examples', upcoming), lookup_stats, upcoming)
+                    prefetcher.prefetch(('similar', upcoming), similarity.similar, upcoming)
+
             if get_user_input(attr) is not None:
                 break
     finally:
         # Write results
         bioAttr.write_attributes()
+        if prefetcher is not None:
+            prefetcher.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Write a local snapshot of the attribute catalog for attribute_selector.
+
+This program copies sample attribute names, their counts and most common
+values from MongoDB into a SQLite file. Run attribute_selector with
+--snapshot to curate against the file instead of the database.
+"""
+import sys
+import argparse
+from argparse import RawDescriptionHelpFormatter as Raw
+from logging import INFO, DEBUG
+
+sys.path.insert(0, '../')
+from biometalib.logger import logger
+from biometalib.snapshot import create_snapshot
+from biometalib.attribute_stats import refresh_attribute_stats
+from biometalib.utils.attribute_selector import connect_mongo
+
+_DEBUG = False
+
+def arguments():
+    """Pulls in command line arguments."""
+
+    DESCRIPTION = """\
+    This program writes the sample attribute names, counts and most common
+    values of the biometa collection to a SQLite file that can be given to
+    attribute_selector with --snapshot. Statistics are read from the
+    attribute_stats collection when it exists, otherwise they are computed.
+    """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=Raw)
+
+    db_args = parser.add_argument_group('Database Arguments')
+    config = parser.add_argument_group('Outputs')
+
+    db_args.add_argument("--host", dest="host", action='store', default='localhost', required=False,
+                         help="Host running a mongo database. [default: localhost]")
+
+    db_args.add_argument("--port", dest="port", action='store', type=int, required=False, default=27017,
+                         help="Mongo database port. [default: 27017]")
+
+    db_args.add_argument("--db", dest="db", action='store', required=True,
+                        help="Name of the mongo database containing the biometa collection.")
+
+    db_args.add_argument("--username", dest="username", action='store', required=False,
+                        help="MongoDB username to connect with.")
+
+    db_args.add_argument("--password", dest="password", action='store', required=False,
+                        help="MongoDB password.")
+
+    db_args.add_argument("--authenticationDatabase", dest="authDB", action='store', required=False,
+                        help="MongoDB database to authenticate against.")
+
+    config.add_argument("--output", dest="output", action='store', required=True,
+                        help="SQLite file to write the snapshot to.")
+
+    config.add_argument("--top", dest="top", action='store', type=int, required=False, default=40,
+                        help="Number of the most common values to keep for each attribute. [default: 40]")
+
+    parser.add_argument("--refresh-stats", dest="refresh_stats", action='store_true', required=False,
+                        help="Rebuild the attribute_stats collection first.")
+
+    parser.add_argument("--debug", dest="debug", action='store_true', required=False,
+                        help="Turn on debug output.")
+
+    args = parser.parse_args()
+
+    # Set logging level
+    if args.debug:
+        logger.setLevel(DEBUG)
+        global _DEBUG
+        _DEBUG = True
+        logger.debug('Debugging On')
+    else:
+        logger.setLevel(INFO)
+
+    return args
+
+
+def main():
+    # Import commandline arguments.
+    args = arguments()
+
+    logger.info('Connecting to MongoDB at: {}:{}'.format(args.host, args.port))
+    biometa = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+
+    if args.refresh_stats:
+        refresh_attribute_stats(biometa, top=args.top)
+
+    n = create_snapshot(biometa, args.output, top=args.top)
+    logger.info('Wrote {:,} attributes to {}'.format(n, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Build the indexes of the Biometa and Ncbi collections.
+
+This program builds the indexes declared on the Biometa model and the
+indexes initialize_biometa needs on the Ncbi collection, then reports their
+sizes and which of the queries run by biometalib use them.
+"""
+import sys
+import argparse
+from argparse import RawDescriptionHelpFormatter as Raw
+from logging import INFO, DEBUG
+
+from sramongo.mongo_schema import Ncbi
+
+sys.path.insert(0, '../')
+from biometalib.logger import logger
+from biometalib.models import Biometa
+from biometalib.indexes import NCBI_INDEXES, create_indexes, report
+from biometalib.utils.initialize_biometa import connect_mongo
+
+_DEBUG = False
+
+def arguments():
+    """Pulls in command line arguments."""
+
+    DESCRIPTION = """\
+    This program builds the indexes of the Biometa collection (bioproject,
+    srp, gsm, taxon_id, experiments.srx and sample_attributes.name/value) and
+    of the Ncbi collection (sra.sample.BioSample and sra.db_imported) in the
+    background. It then reports the size and usage of every index and which
+    index each of the common biometalib queries uses.
+    """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=Raw)
+
+    db_args = parser.add_argument_group('Database Arguments')
+
+    db_args.add_argument("--host", dest="host", action='store', default='localhost', required=False,
+                         help="Host running a mongo database. [default: localhost]")
+
+    db_args.add_argument("--port", dest="port", action='store', type=int, required=False, default=27017,
+                         help="Mongo database port. [default: 27017]")
+
+    db_args.add_argument("--db", dest="db", action='store', required=True,
+                        help="Name of the mongo database containing the biometa collection.")
+
+    db_args.add_argument("--username", dest="username", action='store', required=False,
+                        help="MongoDB username to connect with.")
+
+    db_args.add_argument("--password", dest="password", action='store', required=False,
+                        help="MongoDB password.")
+
+    db_args.add_argument("--authenticationDatabase", dest="authDB", action='store', required=False,
+                        help="MongoDB database to authenticate against.")
+
+    parser.add_argument("--report-only", dest="report_only", action='store_true', required=False,
+                        help="Do not build indexes, only report on them.")
+
+    parser.add_argument("--skip-ncbi", dest="skip_ncbi", action='store_true', required=False,
+                        help="Do not build indexes on the Ncbi collection.")
+
+    parser.add_argument("--debug", dest="debug", action='store_true', required=False,
+                        help="Turn on debug output.")
+
+    args = parser.parse_args()
+
+    # Set logging level
+    if args.debug:
+        logger.setLevel(DEBUG)
+        global _DEBUG
+        _DEBUG = True
+        logger.debug('Debugging On')
+    else:
+        logger.setLevel(INFO)
+
+    return args
+
+
+def main():
+    # Import commandline arguments.
+    args = arguments()
+
+    logger.info('Connecting to MongoDB at: {}:{}'.format(args.host, args.port))
+    client = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+    collections = {'biometa': Biometa._get_collection(), 'ncbi': Ncbi._get_collection()}
+
+    if not args.report_only:
+        logger.info('Building indexes on {}'.format(collections['biometa'].name))
+        Biometa.ensure_indexes()
+        if not args.skip_ncbi:
+            logger.info('Building indexes on {}'.format(collections['ncbi'].name))
+            create_indexes(collections['ncbi'], NCBI_INDEXES)
+
+    report(collections)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Export Biometa as a table with one row per BioSample.
+
+This program streams the Biometa collection in chunks and writes Parquet or
+Arrow files with a column per attribute, and/or a sparse BioSample x
+attribute presence matrix.
+"""
+import sys
+import time
+import argparse
+from argparse import RawDescriptionHelpFormatter as Raw
+from logging import INFO, DEBUG
+
+sys.path.insert(0, '../')
+from biometalib.logger import logger
+from biometalib.models import Biometa, get_cleaned_attributes
+from biometalib import annotate
+from biometalib.export import get_columns, export, TableWriter, MatrixWriter
+from biometalib.utils.attribute_selector import BioAttribute
+from biometalib.utils.initialize_biometa import connect_mongo
+
+_DEBUG = False
+
+def arguments():
+    """Pulls in command line arguments."""
+
+    DESCRIPTION = """\
+    This program exports the Biometa collection with one row per BioSample
+    and one column per attribute. With --config sample attributes are grouped
+    into their selected attributes, ignored attributes are left out, and
+    values are converted to the types in cleaned_fields.yaml. --columns
+    limits the export to some selected attributes, or some sample attribute
+    names without --config.
+
+    Parquet and Arrow tables need --config or --columns, as there are tens of
+    thousands of sample attribute names. Use --matrix to export every one.
+
+    Parquet and Arrow output needs pyarrow, and --matrix needs scipy.
+    """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=Raw)
+
+    db_args = parser.add_argument_group('Database Arguments')
+    config = parser.add_argument_group('Inputs')
+    output = parser.add_argument_group('Outputs')
+
+    db_args.add_argument("--host", dest="host", action='store', default='localhost', required=False,
+                         help="Host running a mongo database. [default: localhost]")
+
+    db_args.add_argument("--port", dest="port", action='store', type=int, required=False, default=27017,
+                         help="Mongo database port. [default: 27017]")
+
+    db_args.add_argument("--db", dest="db", action='store', required=True,
+                        help="Name of the mongo database containing the biometa collection.")
+
+    db_args.add_argument("--username", dest="username", action='store', required=False,
+                        help="MongoDB username to connect with.")
+
+    db_args.add_argument("--password", dest="password", action='store', required=False,
+                        help="MongoDB password.")
+
+    db_args.add_argument("--authenticationDatabase", dest="authDB", action='store', required=False,
+                        help="MongoDB database to authenticate against.")
+
+    config.add_argument("--config", dest="config", action='store', required=False,
+                        help="YAML file with attribute decisions from attribute_selector.")
+
+    config.add_argument("--taxon-id", dest="taxon_id", action='store', required=False,
+                        help="Only export BioSamples of this taxon.")
+
+    config.add_argument("--columns", dest="columns", action='store', nargs='+', required=False,
+                        help="Only export these attributes.")
+
+    output.add_argument("--parquet", dest="parquet", action='store', required=False,
+                        help="Write a Parquet file.")
+
+    output.add_argument("--arrow", dest="arrow", action='store', required=False,
+                        help="Write an Arrow IPC stream.")
+
+    output.add_argument("--matrix", dest="matrix", action='store', required=False,
+                        help="Write a sparse presence matrix to <MATRIX>.npz with BioSamples in "
+                             "<MATRIX>.rows.txt and attributes in <MATRIX>.cols.txt.")
+
+    parser.add_argument("--chunk-size", dest="chunk_size", action='store', type=int, required=False,
+                        default=10000, help="Number of BioSamples to read and write at a time. [default: 10000]")
+
+    parser.add_argument("--debug", dest="debug", action='store_true', required=False,
+                        help="Turn on debug output.")
+
+    args = parser.parse_args()
+
+    if (args.parquet is None) and (args.arrow is None) and (args.matrix is None):
+        parser.error('Give at least one of --parquet, --arrow or --matrix.')
+
+    if ((args.parquet is not None) or (args.arrow is not None)) and (args.config is None) and (args.columns is None):
+        parser.error('--parquet and --arrow need --config or --columns. Use --matrix to export every attribute.')
+
+    # Set logging level
+    if args.debug:
+        logger.setLevel(DEBUG)
+        global _DEBUG
+        _DEBUG = True
+        logger.debug('Debugging On')
+    else:
+        logger.setLevel(INFO)
+
+    return args
+
+
+def main():
+    # Import commandline arguments.
+    args = arguments()
+
+    # Connect to database
+    logger.info('Connecting to MongoDB at: {}:{}'.format(args.host, args.port))
+    client = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+    collection = Biometa._get_collection()
+
+    schema = None
+    mapping = None
+    if args.config is not None:
+        schema = get_cleaned_attributes()
+        mapping, _ = annotate.get_mapping(BioAttribute(args.config))
+    mapping, columns = get_columns(collection, mapping, names=args.columns)
+    logger.info('Exporting {:,} attribute columns'.format(len(columns)))
+
+    writers = []
+    try:
+        if args.parquet is not None:
+            writers.append(TableWriter(args.parquet, columns, schema=schema, fmt='parquet'))
+        if args.arrow is not None:
+            writers.append(TableWriter(args.arrow, columns, schema=schema, fmt='arrow'))
+        if args.matrix is not None:
+            writers.append(MatrixWriter(args.matrix, columns))
+    except ImportError as err:
+        logger.error('Missing optional dependency: {}'.format(err))
+        sys.exit(1)
+    except ValueError as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+    query = None if args.taxon_id is None else {'taxon_id': args.taxon_id}
+    start = time.time()
+    n = export(collection, writers, mapping, query=query, chunk_size=args.chunk_size)
+    logger.info('Exported {:,} BioSamples in {:.1f}s'.format(n, time.time() - start))
+
+    for writer in writers:
+        if isinstance(writer, TableWriter):
+            for attr, count, examples in writer.coercer.summary():
+                logger.info('Could not parse {:,} values of {}, e.g. {}'.format(count, attr, examples))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Build Biometa records from dumps of the Ncbi collection.
+
+This program reads JSON-lines (mongoexport) or BSON (mongodump) dumps of the
+Ncbi collection as a stream, so the Ncbi collection does not need to be loaded
+into MongoDB. Records are written to a Biometa collection or to a JSON-lines
+file.
+"""
+import sys
+import argparse
+from argparse import RawDescriptionHelpFormatter as Raw
+from logging import INFO, DEBUG
+from collections import Counter
+
+sys.path.insert(0, '../')
+from biometalib.logger import logger
+from biometalib.models import Biometa
+from biometalib.dump import read_records, write_records
+from biometalib.utils.initialize_biometa import BiometaWriter, connect_mongo, count_records, get_update, \
+    log_stats
+
+_DEBUG = False
+
+def arguments():
+    """Pulls in command line arguments."""
+
+    DESCRIPTION = """\
+    This program builds Biometa records from JSON-lines or BSON dumps of the
+    Ncbi collection. Dumps can be compressed with gzip, bzip2 or xz. Records
+    are upserted into the Biometa collection when --db is given, or written
+    as JSON-lines to --output.
+    """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=Raw)
+
+    db_args = parser.add_argument_group('Database Arguments')
+    config = parser.add_argument_group('Inputs')
+
+    config.add_argument("dumps", action='store', nargs='+',
+                        help="Dumps of the Ncbi collection (.json, .bson, optionally .gz, .bz2 or .xz).")
+
+    config.add_argument("--output", dest="output", action='store', required=False,
+                        help="Write records as JSON-lines to this file instead of MongoDB.")
+
+    db_args.add_argument("--host", dest="host", action='store', default='localhost', required=False,
+                         help="Host running a mongo database. [default: localhost]")
+
+    db_args.add_argument("--port", dest="port", action='store', type=int, required=False, default=27017,
+                         help="Mongo database port. [default: 27017]")
+
+    db_args.add_argument("--db", dest="db", action='store', required=False,
+                        help="Name of the mongo database containing the biometa collection.")
+
+    db_args.add_argument("--username", dest="username", action='store', required=False,
+                        help="MongoDB username to connect with.")
+
+    db_args.add_argument("--password", dest="password", action='store', required=False,
+                        help="MongoDB password.")
+
+    db_args.add_argument("--authenticationDatabase", dest="authDB", action='store', required=False,
+                        help="MongoDB database to authenticate against.")
+
+    db_args.add_argument("--batch-size", dest="batch_size", action='store', type=int, required=False, default=1000,
+                         help="Number of upserts to send in a single bulk write. [default: 1000]")
+
+    db_args.add_argument("--unordered", dest="ordered", action='store_false', required=False,
+                         help="Use unordered bulk writes, allowing the server to apply a batch in parallel.")
+
+    parser.add_argument("--debug", dest="debug", action='store_true', required=False,
+                        help="Turn on debug output.")
+
+    args = parser.parse_args()
+
+    if (args.db is None) == (args.output is None):
+        parser.error('Give exactly one of --db or --output.')
+
+    # Set logging level
+    if args.debug:
+        logger.setLevel(DEBUG)
+        global _DEBUG
+        _DEBUG = True
+        logger.debug('Debugging On')
+    else:
+        logger.setLevel(INFO)
+
+    return args
+
+
+def main():
+    # Import commandline arguments.
+    args = arguments()
+
+    stats = Counter()
+    records = count_records(read_records(args.dumps), stats, step=args.batch_size)
+
+    if args.output is not None:
+        logger.info('Writing records to: {}'.format(args.output))
+        stats['written'] = write_records(records, args.output)
+    else:
+        logger.info('Connecting to MongoDB at: {}:{}'.format(args.host, args.port))
+        client = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+
+        writer = BiometaWriter(Biometa._get_collection(), batch_size=args.batch_size, ordered=args.ordered)
+        for record in records:
+            writer.add(record['srx'], record['biosample'], **get_update(record))
+        writer.flush()
+        writer.summary()
+        stats['written'] += writer.written
+        stats['errors'] += writer.errors
+
+    log_stats(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,35 @@
 This program initializes the Biometa mongoDB collection to include fields from
 the Ncbi collection. This new collection is indexed by BioSample ID.
 """
+import os
 import sys
 import argparse
 from argparse import RawDescriptionHelpFormatter as Raw
 from logging import INFO, DEBUG
 import json
+import time
+import multiprocessing
+from itertools import groupby
+from datetime import datetime
 import mongoengine as me
 from mongoengine.context_managers import switch_db
-from mongoengine.errors import ValidationError
+from mongoengine.errors import ValidationError, FieldDoesNotExist
+from mongoengine.queryset import transform
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from sramongo.mongo_schema import Ncbi
 
 sys.path.insert(0, '../')
 from biometalib.logger import logger
 from biometalib.models import Biometa
+from biometalib import extract
+from biometalib.extract import dict_uniqify, papers_uniqify
+from biometalib.attribute_stats import refresh_attribute_stats
+from biometalib.metrics import Metrics, profile
+from biometalib.normalize import SharedWriter, normalize_record
+from biometalib import follow
+from biometalib.fingerprint import skip_unchanged
+from biometalib.query import record_write
 
 _DEBUG = False
 
@@ -51,11 +67,88 @@ def arguments():
     db_args.add_argument("--authenticationDatabase", dest="authDB", action='store', required=False,
                         help="MongoDB database to authenticate against.")
 
+    db_args.add_argument("--batch-size", dest="batch_size", action='store', type=int, required=False, default=1000,
+                         help="Number of upserts to send in a single bulk write. [default: 1000]")
+
+    db_args.add_argument("--unordered", dest="ordered", action='store_false', required=False,
+                         help="Use unordered bulk writes, allowing the server to apply a batch in parallel.")
+
+    parser.add_argument("--raw", dest="raw", action='store_true', required=False,
+                        help="Read only the needed fields of each Ncbi document as raw dictionaries "
+                             "instead of full sramongo objects.")
+
+    parser.add_argument("--workers", dest="workers", action='store', type=int, required=False, default=1,
+                        help="Number of worker processes. Each worker handles a disjoint range of "
+                             "BioSamples with its own database connection. Run biometa_indexes first to build "
+                             "the index on sra.sample.BioSample and _id used to read each range. [default: 1]")
+
+    parser.add_argument("--engine", dest="engine", action='store', choices=['python', 'aggregate'],
+                        required=False, default='python',
+                        help="Build Biometa in python, or on the server with an aggregation pipeline that "
+                             "groups SRX by BioSample and $merges them into biometa (MongoDB 4.4+). "
+                             "[default: python]")
+
+    parser.add_argument("--coalesce", dest="coalesce", action='store_true', required=False,
+                        help="Read SRX sorted by BioSample and write each BioSample once with all of its "
+                             "SRX merged. Needs an index on sra.sample.BioSample in the Ncbi collection.")
+
+    parser.add_argument("--normalize", dest="normalize", action='store_true', required=False,
+                        help="Store papers and contacts once in the papers and contacts collections and only "
+                             "keep their IDs in biometa (paper_ids and contact_ids), instead of embedding them "
+                             "in every BioSample.")
+
+    parser.add_argument("--force", dest="force", action='store_true', required=False,
+                        help="Write every SRX. By default SRX whose extracted record has not changed since it "
+                             "was last written are skipped.")
+
+    parser.add_argument("--since", dest="since", action='store', type=parse_date, required=False,
+                        help="Only process SRX imported into the Ncbi collection on or after this date "
+                             "(YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS).")
+
+    parser.add_argument("--resume", dest="resume", action='store_true', required=False,
+                        help="Continue an interrupted run from its checkpoint. If the last run finished, "
+                             "only process SRX imported since that run started.")
+
+    parser.add_argument("--follow", dest="follow", action='store_true', required=False,
+                        help="Keep running and apply SRX inserted or updated in the Ncbi collection as they "
+                             "arrive, using its change stream (needs a replica set). The stream position is "
+                             "stored, so a restarted follower continues where it stopped. Run without "
+                             "--follow first to process SRX imported before the first follow.")
+
+    parser.add_argument("--follow-window", dest="follow_window", action='store', type=float, required=False,
+                        default=1.0,
+                        help="Most seconds a change waits to be batched with later changes. [default: 1]")
+
+    parser.add_argument("--follow-reset", dest="follow_reset", action='store_true', required=False,
+                        help="Forget the stored stream position and follow changes from now on.")
+
+    parser.add_argument("--refresh-stats", dest="refresh_stats", action='store_true', required=False,
+                        help="Refresh the attribute_stats collection used by attribute_selector for the "
+                             "attributes that were processed.")
+
+    parser.add_argument("--progress-interval", dest="progress_interval", action='store', type=float,
+                        required=False, default=30,
+                        help="Seconds between progress messages with the rate, ETA and time split. [default: 30]")
+
+    parser.add_argument("--metrics", dest="metrics", action='store', required=False,
+                        help="Write counts, timings and write latency percentiles of the run to this JSON file.")
+
+    parser.add_argument("--profile", dest="profile", action='store', required=False,
+                        help="Profile the run with cProfile and write the stats to this file. With --workers each "
+                             "partition is written to <PROFILE>.<partition>. Use --debug to also log the "
+                             "slowest functions.")
+
     parser.add_argument("--debug", dest="debug", action='store_true', required=False,
                         help="Turn on debug output.")
 
     args = parser.parse_args()
 
+    if args.normalize and (args.engine == 'aggregate'):
+        parser.error('--normalize is not supported by the aggregate engine.')
+
+    if args.follow and ((args.engine == 'aggregate') or args.since or args.resume):
+        parser.error('--follow can not be used with --engine aggregate, --since or --resume.')
+
     # Set logging level
     if args.debug:
         logger.setLevel(DEBUG)
@@ -68,6 +161,16 @@ def arguments():
     return args
 
 
+def parse_date(value):
+    """Parse a date given on the command line."""
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Could not parse date: {}'.format(value))
+
+
 def connect_mongo(host, port, db, u, p, auth_db):
     client = me.connect(db, host=host, port=port)
     if (u is not None) & (p is not None) & (auth_db is not None):
@@ -75,8 +178,174 @@ def connect_mongo(host, port, db, u, p, auth_db):
     return client
 
 
-def dict_uniqify(d):
-    return [dict(y) for y in set(tuple(x.items()) for x in d)]
+class BiometaWriter(object):
+    def __init__(self, collection, batch_size=1000, ordered=True, callback=None, before_flush=None, upsert=True):
+        """Batched upserts into the Biometa collection.
+
+        Collects per SRX upserts and sends them to the server as a single
+        `bulk_write` once `batch_size` of them have been queued.
+
+        Parameters:
+        -----------
+        collection: pymongo.collection.Collection
+            The raw Biometa collection.
+        batch_size: int
+            Number of upserts to send per bulk write.
+        ordered: bool
+            If False the server may apply a batch in any order.
+        callback: function
+            Called with the last SRX of each batch and its BioSample once the
+            batch has been written.
+        before_flush: function
+            Called before each batch is sent, e.g. to write documents the
+            batch refers to.
+        upsert: bool
+            If False only existing BioSamples are updated.
+
+        Methods:
+        --------
+        add: method
+            Queue an upsert for a BioSample.
+        flush: method
+            Send all queued upserts to the server.
+
+        """
+        self.collection = collection
+        self.batch_size = max(batch_size, 1)
+        self.ordered = ordered
+        self.callback = callback
+        self.before_flush = before_flush
+        self.upsert = upsert
+        self.batches = 0
+        self.written = 0
+        self.errors = 0
+        self.invalid = 0
+        self.latencies = []
+        self._ops = []
+        self._srxs = []
+
+    def add(self, srx, pk, **update):
+        """Queue an upsert using mongoengine update keywords.
+
+        The update is validated against the Biometa model here, so a
+        ValidationError or an unknown field only skips this SRX.
+        """
+        try:
+            update = transform.update(Biometa, **update)
+        except (ValidationError, FieldDoesNotExist) as err:
+            logger.error('{}: Skipping {}'.format(type(err).__name__, srx))
+            self.errors += 1
+            self.invalid += 1
+            return
+
+        self._ops.append(UpdateOne({'_id': pk}, update, upsert=self.upsert))
+        self._srxs.append((srx, pk))
+        if len(self._ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send queued upserts to the server and log the batch latency."""
+        ops, srxs = self._ops, self._srxs
+        self._ops, self._srxs = [], []
+        last = srxs[-1] if srxs else None
+        srxs = [x[0] for x in srxs]
+
+        if ops and (self.before_flush is not None):
+            self.before_flush()
+
+        while ops:
+            start = time.time()
+            try:
+                self.collection.bulk_write(ops, ordered=self.ordered)
+                self.written += len(ops)
+                remaining = []
+            except BulkWriteError as err:
+                failed = [e['index'] for e in err.details.get('writeErrors', [])]
+                for i in failed:
+                    logger.error('WriteError: Skipping {}'.format(srxs[i]))
+                for e in err.details.get('writeConcernErrors', []):
+                    logger.error('WriteConcernError: {}'.format(e.get('errmsg')))
+                self.errors += len(failed)
+                self.written += err.details['nUpserted'] + err.details['nMatched']
+
+                # An ordered batch stops at the first error, resend the rest.
+                # With only write concern errors the whole batch was sent.
+                remaining = []
+                if self.ordered and failed:
+                    remaining = list(range(max(failed) + 1, len(ops)))
+
+            elapsed = time.time() - start
+            self.batches += 1
+            self.latencies.append(elapsed)
+            logger.debug('Batch {:,}: wrote {:,} upserts in {:.3f}s'.format(self.batches, len(ops), elapsed))
+
+            ops = [ops[i] for i in remaining]
+            srxs = [srxs[i] for i in remaining]
+
+        if (last is not None) and (self.callback is not None):
+            self.callback(*last)
+
+    def summary(self):
+        """Log a summary of the batches written so far."""
+        if not self.latencies:
+            return
+        logger.info('Wrote {:,} upserts in {:,} batches ({:,} skipped). Batch latency mean: {:.3f}s max: {:.3f}s'.format(
+            self.written, self.batches, self.errors,
+            sum(self.latencies) / len(self.latencies), max(self.latencies))
+        )
+
+
+class Checkpoint(object):
+    def __init__(self, collection, name='initialize_biometa'):
+        """Persisted progress of an initialize_biometa run.
+
+        A single document stores the date filter and BioSample partitions of
+        the current run, along with the last key written for each partition.
+        SRX are processed in `_id` order, or BioSample order when coalescing,
+        so an interrupted run can continue after that key. Once every partition is done the run is marked as
+        completed and its start time becomes the watermark for the next
+        incremental run.
+
+        Parameters:
+        -----------
+        collection: pymongo.collection.Collection
+            Collection used to store checkpoints.
+        name: str
+            ID of the checkpoint document.
+
+        """
+        self.collection = collection
+        self.name = name
+
+    def load(self):
+        return self.collection.find_one({'_id': self.name})
+
+    def start(self, since, partitions, coalesce=False):
+        # sramongo stores db_imported as local time, so do the same here.
+        self.collection.replace_one({'_id': self.name}, {
+            '_id': self.name,
+            'started': datetime.now(),
+            'completed': None,
+            'since': since,
+            'coalesce': coalesce,
+            'partitions': partitions,
+        }, upsert=True)
+
+    def update(self, i, last_id, last_biosample=None):
+        self.collection.update_one({'_id': self.name}, {'$set': {
+            'partitions.{}.last_id'.format(i): last_id,
+            'partitions.{}.last_biosample'.format(i): last_biosample,
+        }})
+
+    def finish(self, i):
+        self.collection.update_one({'_id': self.name}, {'$set': {'partitions.{}.done'.format(i): True}})
+
+    def complete(self):
+        self.collection.update_one({'_id': self.name}, {'$set': {'completed': datetime.now()}})
+
+
+def get_checkpoint():
+    return Checkpoint(Biometa._get_db()['biometa_checkpoint'])
 
 
 def get_contacts(ncbi):
@@ -115,7 +384,7 @@ def get_sample_attributes(ncbi):
     return dict_uniqify(attributes)
 
 
-def get_sample_title(ncbi):
+def get_sample_title(ncbi, stats=None):
     titles = []
     t1 = ncbi.sra.sample.title
     if (t1 is not None) and (len(t1) > 0):
@@ -134,19 +403,13 @@ def get_sample_title(ncbi):
         logger.warn('{} had different titles from sra and biosample: {}'.format(
             ncbi.pk, titles)
         )
+        if stats is not None:
+            stats['title_conflicts'] += 1
     return '|'.join(titles)
 
 
 def get_papers(ncbi):
-    ids = []
-    papers = []
-    if ncbi.pubmed:
-        if (ncbi.pubmed is not None) and (len(ncbi.pubmed) > 0):
-            for p in ncbi.pubmed:
-                if (p is not None) and (p['pubmed_id'] not in ids):
-                    papers.append(p)
-                    ids.append(p['pubmed_id'])
-    return papers
+    return papers_uniqify(ncbi.pubmed)
 
 
 def get_descirption(ncbi):
@@ -157,6 +420,556 @@ def get_descirption(ncbi):
         pass
 
 
+def get_record(ncbi, stats=None):
+    """Build a Biometa record from an sramongo Ncbi document.
+
+    Returns None if the document has no BioSample. See
+    `biometalib.extract.get_record` for the record layout.
+    """
+    biosample = ncbi.sra.sample.BioSample
+
+    # Skip if there is no sample information
+    if (biosample is None) or (biosample == ''):
+        return None
+
+    # General IDs
+    strings = {
+        'srs': ncbi.sra.sample.sample_id,
+        'gsm': ncbi.sra.sample.GEO,
+
+        'srp': ncbi.sra.study.study_id,
+        'bioproject': ncbi.sra.study.BioProject,
+        'study_title': ncbi.sra.study.title,
+        'study_abstract': ncbi.sra.study.abstract,
+        'description': get_descirption(ncbi),
+        'sample_title': get_sample_title(ncbi, stats),
+        'taxon_id': ncbi.sra.sample.taxon_id
+    }
+    strings = {k: v for k, v in strings.items() if (v is not None) and (v != '')}
+
+    return {
+        'srx': ncbi.srx,
+        'biosample': biosample,
+        'strings': strings,
+        'contacts': get_contacts(ncbi),
+        'experiments': [{
+            'srx': ncbi.srx,
+            'runs': [x for x in set([r.run_id for r in ncbi.sra.run]) if (x is not None) and (x != '')]
+        }],
+        'papers': get_papers(ncbi),
+        'sample_attributes': get_sample_attributes(ncbi),
+    }
+
+
+def get_update(record):
+    """Mongoengine update keywords for a Biometa record.
+
+    Records normalized with `biometalib.normalize.normalize_record` add
+    references to their papers and contacts instead of embedding them.
+    Fingerprints added by `biometalib.fingerprint.skip_unchanged` are stored
+    for each SRX.
+    """
+    update = dict(
+        biosample=record['biosample'],
+        add_to_set__experiments=record['experiments'],
+        add_to_set__sample_attributes=record['sample_attributes'],
+        **record['strings']
+    )
+    if 'paper_ids' in record:
+        update['add_to_set__paper_ids'] = record['paper_ids']
+        update['add_to_set__contact_ids'] = record['contact_ids']
+    else:
+        update['add_to_set__papers'] = record['papers']
+        update['add_to_set__contacts'] = record['contacts']
+    for srx, value in record.get('fingerprints', {}).items():
+        update['set__fingerprints__' + srx] = value
+    return update
+
+
+def iter_records(queryset, raw=False, metrics=None):
+    """Iterate over Biometa records for the Ncbi documents in a queryset.
+
+    Documents are read in the order of the queryset and None is yielded for
+    documents without a BioSample. If raw is True only the fields in
+    `extract.NCBI_PROJECTION` are sent by the server and documents are used
+    as plain dictionaries. If metrics are given the time spent reading
+    documents and extracting records is recorded.
+    """
+    if raw:
+        docs = queryset._collection.find(queryset._query, projection=extract.NCBI_PROJECTION)
+        if queryset._ordering:
+            docs = docs.sort(queryset._ordering)
+        get = extract.get_record
+    else:
+        docs = queryset
+        get = get_record
+
+    if metrics is None:
+        return (get(doc) for doc in docs)
+    return _timed_records(docs, get, metrics)
+
+
+def _timed_records(docs, get, metrics):
+    for doc in metrics.timed(docs, 'read'):
+        with metrics.timer('extract'):
+            record = get(doc, metrics.counts)
+        yield record
+
+
+def get_queryset(since=None):
+    """Ncbi documents imported on or after since."""
+    if since is None:
+        return Ncbi.objects()
+    return Ncbi.objects(sra__db_imported__gte=since)
+
+
+def get_partitions(queryset, n, sample_size=10000):
+    """Split Ncbi documents into disjoint BioSample ranges.
+
+    Split points are taken from a random sample of BioSample IDs, so every
+    BioSample falls into exactly one range. Without a date filter $sample
+    runs first, so the server picks random documents instead of scanning
+    the collection, and documents without a BioSample are dropped
+    afterwards. A date filter is applied first, as it selects few
+    documents through its index.
+
+    Returns:
+    --------
+    list of dict
+        With the lower and upper BioSample bounds of each range, where None
+        means unbounded.
+
+    """
+    splits = []
+    if n > 1:
+        match = [{'$match': queryset._query}, {'$match': {'sra.sample.BioSample': {'$gt': ''}}}]
+        if set(queryset._query) <= {'_cls'}:
+            # Some sampled documents are dropped by the $match.
+            pipeline = [{'$sample': {'size': 2 * sample_size}}] + match
+        else:
+            pipeline = match + [{'$sample': {'size': sample_size}}]
+        pipeline.append({'$bucketAuto': {'groupBy': '$sra.sample.BioSample', 'buckets': n}})
+        buckets = queryset._collection.aggregate(pipeline)
+        splits = [x['_id']['min'] for x in buckets][1:]
+
+    return [
+        {'lower': lower, 'upper': upper, 'last_id': None, 'last_biosample': None, 'done': False}
+        for lower, upper in zip([None] + splits, splits + [None])
+    ]
+
+
+def partition_query(lower, upper):
+    """Raw query selecting BioSamples in [lower, upper)."""
+    bounds = {'$gt': ''}
+    if lower is not None:
+        bounds = {'$gte': lower}
+    if upper is not None:
+        bounds['$lt'] = upper
+    return {'sra.sample.BioSample': bounds}
+
+
+def partition_queryset(queryset, partition, coalesce=False):
+    """Restrict a queryset to a partition and skip documents already written.
+
+    Documents are sorted by BioSample and `_id`, so the BioSample range and
+    the sort are both served by the (sra.sample.BioSample, _id) index, and
+    the last key written is a valid point to resume from. When coalescing the
+    key is the last BioSample, otherwise the last BioSample and SRX.
+    """
+    if (partition['lower'] is not None) or (partition['upper'] is not None):
+        queryset = queryset.filter(__raw__=partition_query(partition['lower'], partition['upper']))
+
+    queryset = queryset.order_by('sra__sample__BioSample', 'pk')
+    if partition['last_id'] is None:
+        return queryset
+
+    if coalesce:
+        return queryset.filter(sra__sample__BioSample__gt=partition['last_id'])
+
+    biosample = partition.get('last_biosample')
+    if biosample is None:
+        # Checkpoint of a run that sorted by _id only.
+        return queryset.order_by('pk').filter(pk__gt=partition['last_id'])
+    return queryset.filter(__raw__={'$or': [
+        {'sra.sample.BioSample': {'$gt': biosample}},
+        {'sra.sample.BioSample': biosample, '_id': {'$gt': partition['last_id']}},
+    ]})
+
+
+def _nonempty(expr):
+    """Aggregation expression that drops null and empty strings."""
+    return {'$cond': [{'$in': [{'$ifNull': [expr, '']}, ['']]}, '$$REMOVE', expr]}
+
+
+def _flatten(expr):
+    """Aggregation expression that concatenates an array of arrays."""
+    return {'$reduce': {
+        'input': {'$ifNull': [expr, []]},
+        'initialValue': [],
+        'in': {'$concatArrays': ['$$value', {'$ifNull': ['$$this', []]}]},
+    }}
+
+
+def _union(expr):
+    """Aggregation expression for the set union of an array of arrays."""
+    return {'$reduce': {'input': expr, 'initialValue': [], 'in': {'$setUnion': ['$$value', '$$this']}}}
+
+
+def _clean_attributes(expr):
+    """Aggregation expression matching `get_sample_attributes` name cleaning."""
+    return {'$map': {
+        'input': {'$filter': {'input': {'$ifNull': [expr, []]}, 'as': 'a', 'cond': {'$gt': ['$$a.name', '']}}},
+        'as': 'a',
+        'in': {
+            'name': {'$replaceAll': {'input': {'$toLower': '$$a.name'}, 'find': ' ', 'replacement': '_'}},
+            'value': '$$a.value',
+        },
+    }}
+
+
+# Biometa string fields and where they come from in an Ncbi document.
+STRING_FIELDS = {
+    'srs': '$sra.sample.sample_id',
+    'gsm': '$sra.sample.GEO',
+    'srp': '$sra.study.study_id',
+    'bioproject': '$sra.study.BioProject',
+    'study_title': '$sra.study.title',
+    'study_abstract': '$sra.study.abstract',
+    'description': {'$arrayElemAt': ['$biosample.description', 0]},
+    'taxon_id': '$sra.sample.taxon_id',
+}
+
+
+def _titles():
+    """Aggregation expression for the distinct sra and biosample titles."""
+    titles = {'$concatArrays': [[{'$ifNull': ['$sra.sample.title', '']}], {'$ifNull': ['$biosample.title', []]}]}
+    return {'$setDifference': [titles, ['', None]]}
+
+
+def get_pipeline(query, into='biometa'):
+    """Aggregation pipeline that builds Biometa from the Ncbi collection.
+
+    Each SRX is reshaped like `get_record`, grouped by BioSample and merged
+    into the Biometa collection, taking the union with any lists already
+    there.
+    When the SRX of a BioSample disagree on a string field the largest
+    value is kept.
+    """
+    srx = {k: _nonempty(v) for k, v in STRING_FIELDS.items()}
+    srx.update({
+        '_id': 0,
+        'biosample': '$sra.sample.BioSample',
+        'sample_title': _nonempty({'$reduce': {
+            'input': _titles(),
+            'initialValue': '',
+            'in': {'$cond': [{'$eq': ['$$value', '']}, '$$this', {'$concat': ['$$value', '|', '$$this']}]},
+        }}),
+        'contacts': {'$setUnion': [{'$map': {
+            'input': _flatten('$biosample.contacts'),
+            'as': 'c',
+            'in': {'first_name': '$$c.first_name', 'last_name': '$$c.last_name', 'email': '$$c.email'},
+        }}]},
+        'experiment': {
+            'srx': '$_id',
+            'runs': {'$setDifference': [{'$ifNull': ['$sra.run.run_id', []]}, ['', None]]},
+        },
+        # Keep the first paper for each pubmed ID like `get_papers`
+        'papers': {'$reduce': {
+            'input': {'$filter': {'input': {'$ifNull': ['$pubmed', []]}, 'as': 'p', 'cond': '$$p.pubmed_id'}},
+            'initialValue': [],
+            'in': {'$cond': [
+                {'$in': ['$$this.pubmed_id', {'$map': {'input': '$$value', 'as': 'v', 'in': '$$v.pubmed_id'}}]},
+                '$$value',
+                {'$concatArrays': ['$$value', ['$$this']]},
+            ]},
+        }},
+        'sample_attributes': {'$setUnion': [{'$concatArrays': [
+            _clean_attributes('$sra.sample.attributes'),
+            _clean_attributes(_flatten('$biosample.attributes')),
+        ]}]},
+    })
+
+    group = {k: {'$max': '$' + k} for k in list(STRING_FIELDS) + ['sample_title']}
+    group.update({
+        '_id': '$biosample',
+        'contacts': {'$push': '$contacts'},
+        'papers': {'$push': '$papers'},
+        'experiments': {'$addToSet': '$experiment'},
+        'sample_attributes': {'$push': '$sample_attributes'},
+    })
+
+    lists = ['contacts', 'papers', 'sample_attributes']
+    combine = {k: {'$ifNull': ['$$new.' + k, '$' + k]} for k in list(STRING_FIELDS) + ['sample_title']}
+    combine.update({
+        k: {'$setUnion': [{'$ifNull': ['$' + k, []]}, '$$new.' + k]}
+        for k in lists + ['experiments']
+    })
+
+    return [
+        {'$match': query},
+        {'$match': {'sra.sample.BioSample': {'$gt': ''}}},
+        {'$project': srx},
+        {'$group': group},
+        {'$addFields': {k: _union('$' + k) for k in lists}},
+        {'$merge': {'into': into, 'on': '_id', 'whenMatched': [{'$set': combine}], 'whenNotMatched': 'insert'}},
+    ]
+
+
+def get_title_conflicts(query):
+    """SRX whose sra and biosample titles differ."""
+    return Ncbi._get_collection().aggregate([
+        {'$match': query},
+        {'$project': {'titles': _titles()}},
+        {'$match': {'titles.1': {'$exists': True}}},
+    ], allowDiskUse=True)
+
+
+def aggregate(queryset, metrics=None):
+    """Build Biometa for a queryset on the server.
+
+    Returns:
+    --------
+    biometalib.metrics.Metrics
+        With the number of SRX with conflicting titles and the time spent
+        aggregating.
+
+    """
+    metrics = metrics or Metrics()
+    with metrics.timer('title_conflicts'):
+        for ncbi in get_title_conflicts(queryset._query):
+            logger.warning('{} had different titles from sra and biosample: {}'.format(ncbi['_id'], ncbi['titles']))
+            metrics.counts['title_conflicts'] += 1
+
+    start = time.time()
+    with metrics.timer('aggregate'):
+        queryset._collection.aggregate(get_pipeline(queryset._query, into=Biometa._get_collection_name()),
+                                       allowDiskUse=True)
+    logger.info('Aggregated into {} in {:.3f}s'.format(Biometa._get_collection_name(), time.time() - start))
+    return metrics
+
+
+# Shared SRX counter used to report progress from worker processes.
+_progress = None
+
+
+def _init_worker(progress):
+    global _progress
+    _progress = progress
+
+
+def count_records(records, stats, step=1000):
+    """Count SRX as they are read, dropping documents without a BioSample."""
+    for record in records:
+        stats['srx'] += 1
+        if (_progress is not None) and (stats['srx'] % step == 0):
+            with _progress.get_lock():
+                _progress.value += step
+
+        if record is None:
+            stats['no_biosample'] += 1
+            continue
+        yield record
+
+
+def get_writer(args, callback=None):
+    """Biometa writer for a run, and the writer of shared papers and contacts with --normalize."""
+    shared = None
+    if args.normalize:
+        # Papers and contacts are written before the BioSamples referring to them.
+        shared = SharedWriter(Biometa._get_db(), batch_size=args.batch_size)
+    writer = BiometaWriter(Biometa._get_collection(), batch_size=args.batch_size, ordered=args.ordered,
+                           callback=callback, before_flush=None if shared is None else shared.flush)
+    return writer, shared
+
+
+def write_record(record, label, writer, shared=None):
+    if shared is not None:
+        record, papers, contacts = normalize_record(record)
+        shared.add_all(papers, contacts)
+    writer.add(label, record['biosample'], **get_update(record))
+
+
+def writer_counts(metrics, writer, shared=None):
+    metrics.latencies.extend(writer.latencies)
+    metrics.counts['written'] += writer.written
+    metrics.counts['errors'] += writer.errors
+    metrics.counts['validation_errors'] += writer.invalid
+    metrics.counts['write_errors'] += writer.errors - writer.invalid
+    if shared is not None:
+        metrics.counts['shared_written'] += shared.written
+
+
+def initialize(queryset, args, callback=None, metrics=None, skip=True):
+    """Upsert Biometa records for the Ncbi documents in a queryset.
+
+    If `args.coalesce` is set the queryset must be sorted by BioSample, and
+    all SRX of a BioSample are merged into a single upsert. If skip is True,
+    SRX whose record has the same fingerprint as when it was last written
+    are not written.
+
+    Returns:
+    --------
+    biometalib.metrics.Metrics
+        Number of SRX read, skipped and written, time spent reading,
+        extracting and writing, and the latency of each bulk write.
+
+    """
+    metrics = metrics or Metrics(interval=args.progress_interval)
+    writer, shared = get_writer(args, callback)
+
+    records = count_records(iter_records(queryset, raw=args.raw, metrics=metrics), metrics.counts,
+                            step=args.batch_size)
+    if skip:
+        records = skip_unchanged(records, Biometa._get_collection(), metrics.counts, normalized=args.normalize,
+                                 batch_size=args.batch_size)
+    if args.coalesce:
+        records = (extract.merge_records(group) for _, group in groupby(records, key=lambda r: r['biosample']))
+
+    for record in records:
+        label = record['biosample'] if args.coalesce else record['srx']
+        with metrics.timer('write'):
+            write_record(record, label, writer, shared)
+        metrics.tick()
+
+    with metrics.timer('write'):
+        writer.flush()
+    writer.summary()
+    writer_counts(metrics, writer, shared)
+    return metrics
+
+
+def apply_changes(changes, writer, shared=None, metrics=None):
+    """Upsert Biometa records for a batch of Ncbi change events and flush them."""
+    metrics = metrics or Metrics()
+    with metrics.timer('extract'):
+        records = follow.get_records(changes, metrics.counts)
+    written = writer.written
+    with metrics.timer('write'):
+        for record in records:
+            write_record(record, record['biosample'], writer, shared)
+        writer.flush()
+        if writer.written > written:
+            record_write(writer.collection.database)
+    metrics.counts['changes'] += len(changes)
+    return metrics
+
+
+def follow_ncbi(args, metrics, idle_timeout=None):
+    """Apply changes to the Ncbi collection until interrupted.
+
+    The resume token of each batch is stored after the batch is written, see
+    `biometalib.follow`.
+    """
+    tokens = follow.ResumeTokens(get_checkpoint().collection)
+    if args.follow_reset:
+        tokens.reset()
+    token = tokens.load()
+    if token is None:
+        logger.info('Following changes to the Ncbi collection from now on')
+    else:
+        logger.info('Following changes to the Ncbi collection from the stored position')
+
+    writer, shared = get_writer(args)
+    try:
+        with follow.watch(Ncbi._get_collection(), resume_after=token, max_await=args.follow_window) as stream:
+            if (token is None) and (stream.resume_token is not None):
+                # Store the starting point so a restart does not miss changes.
+                tokens.save(stream.resume_token)
+            batches = follow.iter_batches(stream, batch_size=args.batch_size, window=args.follow_window,
+                                          idle_timeout=idle_timeout)
+            for changes, token in metrics.timed(batches, 'watch'):
+                apply_changes(changes, writer, shared, metrics)
+                tokens.save(token)
+                metrics.tick()
+    except OperationFailure as err:
+        if not follow.is_history_lost(err):
+            raise
+        logger.error('The stored position is no longer in the oplog. Run initialize_biometa --resume to '
+                     'catch up, then --follow --follow-reset.')
+    except KeyboardInterrupt:
+        logger.info('Stopped following, changes since the last batch will be applied on restart')
+
+    writer.summary()
+    writer_counts(metrics, writer, shared)
+    return metrics
+
+
+def initialize_partition(job, metrics=None):
+    """Process a single partition, recording progress in the checkpoint."""
+    args, i, partition, since = job
+    checkpoint = get_checkpoint()
+    queryset = partition_queryset(get_queryset(since), partition, coalesce=args.coalesce)
+    if args.engine == 'aggregate':
+        metrics = aggregate(queryset, metrics)
+    else:
+        metrics = initialize(queryset, args, callback=lambda key, pk: checkpoint.update(i, key, pk),
+                             metrics=metrics, skip=not args.force)
+    # Once per partition instead of per batch, as every bump makes readers
+    # drop their cached lookups.
+    record_write(Biometa._get_db())
+    checkpoint.finish(i)
+    return metrics
+
+
+def _initialize_partition(job):
+    """Worker process entry point for a single BioSample range."""
+    args, i, partition, since = job
+    connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
+    logger.info('Worker {} processing BioSamples [{}, {})'.format(
+        os.getpid(), partition['lower'] or '', partition['upper'] or ''))
+    with profile(None if args.profile is None else '{}.{}'.format(args.profile, i)):
+        return initialize_partition(job)
+
+
+def get_attribute_names(queryset):
+    """Cleaned names of the sample attributes used by Ncbi documents in a queryset."""
+    names = set()
+    for field in ('sra.sample.attributes.name', 'biosample.attributes.name'):
+        names.update(queryset._collection.distinct(field, queryset._query))
+    return sorted(set(x.lower().replace(' ', '_') for x in names if x))
+
+
+def log_stats(stats):
+    logger.info('Processed {:,} SRX: {:,} records written, {:,} unchanged SRX skipped, {:,} without a '
+                'BioSample, {:,} errors, {:,} with conflicting titles'.format(
+        stats['srx'], stats['written'], stats['unchanged'], stats['no_biosample'], stats['errors'],
+        stats['title_conflicts'])
+    )
+
+
+def count_srx(since=None):
+    """Number of SRX to process, for the ETA.
+
+    Without a date filter the count is estimated from collection metadata,
+    since counting every Ncbi document takes as long as a scan.
+    """
+    queryset = get_queryset(since)
+    if since is None:
+        return queryset._collection.estimated_document_count()
+    return queryset._collection.count_documents(queryset._query)
+
+
+def run_workers(args, jobs, metrics):
+    """Run each BioSample range in its own process and merge their metrics."""
+    ctx = multiprocessing.get_context('spawn')
+    progress = ctx.Value('l', 0)
+    with ctx.Pool(args.workers, initializer=_init_worker, initargs=(progress, )) as pool:
+        results = pool.imap_unordered(_initialize_partition, jobs)
+        done = 0
+        while done < len(jobs):
+            try:
+                metrics.merge(results.next(timeout=args.progress_interval))
+                done += 1
+                logger.info('Finished {} of {} partitions'.format(done, len(jobs)))
+            except multiprocessing.TimeoutError:
+                # Worker counts only arrive with their results, so report the shared counter.
+                current = Metrics(total=metrics.total)
+                current.start = metrics.start
+                current.counts['srx'] = progress.value
+                logger.info(current.progress())
+    return metrics
+
+
 def main():
     # Import commandline arguments.
     args = arguments()
@@ -165,49 +978,67 @@ def main():
     logger.info('Connecting to MongoDB at: {}:{}'.format(args.host, args.port))
     client = connect_mongo(args.host, args.port, args.db, args.username, args.password, args.authDB)
 
+    if args.follow:
+        with profile(args.profile):
+            metrics = follow_ncbi(args, Metrics(interval=args.progress_interval))
+        log_stats(metrics.counts)
+        metrics.summary()
+        if args.metrics is not None:
+            metrics.write_json(args.metrics)
+        return
+
+    # Figure out what needs to be processed
+    checkpoint = get_checkpoint()
+    state = checkpoint.load() if args.resume else None
+    since = args.since
+    partitions = None
+    if (state is not None) and (state['completed'] is None):
+        logger.info('Resuming run started at {}'.format(state['started']))
+        since = state['since']
+        partitions = state['partitions']
+        args.coalesce = state.get('coalesce', False)
+    elif (state is not None) and (since is None):
+        since = state['started']
+
+    if since is not None:
+        logger.info('Only processing SRX imported since {}'.format(since))
+
+    if partitions is None:
+        partitions = get_partitions(get_queryset(since), args.workers)
+        checkpoint.start(since, partitions, coalesce=args.coalesce)
+
+    jobs = [(args, i, partition, since) for i, partition in enumerate(partitions) if not partition['done']]
+
+    total = None
+    if args.engine == 'python':
+        total = count_srx(since)
+        logger.info('{:,} SRX to process'.format(total))
+    metrics = Metrics(total=total, interval=args.progress_interval)
+
     # Iterate over SRX and pull out useful information.
     logger.info('Iterating over SRX')
-    for ncbi in Ncbi.objects():
-        biosample = ncbi.sra.sample.BioSample
-
-        # Skip if there is no sample information
-        if (biosample is not None) and (biosample != ''):
-            # General IDs
-            strings = {
-                'srs': ncbi.sra.sample.sample_id,
-                'gsm': ncbi.sra.sample.GEO,
-
-                'srp': ncbi.sra.study.study_id,
-                'bioproject': ncbi.sra.study.BioProject,
-                'study_title': ncbi.sra.study.title,
-                'study_abstract': ncbi.sra.study.abstract,
-                'description': get_descirption(ncbi),
-                'sample_title': get_sample_title(ncbi),
-                'taxon_id': ncbi.sra.sample.taxon_id
-            }
-            strings = {k: v for k, v in strings.items() if (v is not None) and (v != '')}
-
-            contacts = get_contacts(ncbi)
-            experiment = {
-                    'srx': ncbi.srx,
-                    'runs': [x for x in set([r.run_id for r in ncbi.sra.run]) if (x is not None) and (x != '')]
-            }
-            papers = get_papers(ncbi)
-            sample_attributes = get_sample_attributes(ncbi)
+    if (args.workers > 1) and (len(jobs) > 1):
+        logger.info('Processing {} BioSample partitions with {} workers'.format(len(jobs), args.workers))
+        run_workers(args, jobs, metrics)
+    else:
+        with profile(args.profile):
+            for job in jobs:
+                initialize_partition(job, metrics)
 
-            try:
-                Biometa.objects(pk=biosample).update_one(
-                    upsert=True,
-                    biosample=biosample,
-                    add_to_set__contacts=contacts,
-                    add_to_set__papers=papers,
-                    add_to_set__experiments=experiment,
-                    add_to_set__sample_attributes=sample_attributes,
-                    **strings
-                )
-            except ValidationError:
-                logger.error('ValidationError: Skipping {}'.format(ncbi.srx))
+    checkpoint.complete()
+    if args.refresh_stats:
+        with metrics.timer('refresh_stats'):
+            names = None if since is None else get_attribute_names(get_queryset(since))
+            refresh_attribute_stats(Biometa._get_collection(), names)
 
+    if args.engine == 'aggregate':
+        logger.info('{:,} SRX had conflicting titles'.format(metrics.counts['title_conflicts']))
+    else:
+        log_stats(metrics.counts)
+    metrics.summary()
+    if args.metrics is not None:
+        metrics.write_json(args.metrics)
+        logger.info('Wrote metrics to {}'.format(args.metrics))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,132 @@
+"""Fast loading of YAML config files.
+
+Large YAML files are slow to parse, especially with ruamel's round-trip
+loader. `load_yaml` parses a YAML with the C based PyYAML loader when it is
+available and keeps a pickled copy of the result in a cache directory, so
+values and mapping keys keep their types. The copy is used as long as the
+YAML's modification time and size, or else its content hash, are unchanged.
+
+The cache directory is `~/.cache/biometalib` unless the `BIOMETALIB_CACHE`
+environment variable is set.
+"""
+import os
+import pickle
+import hashlib
+import tempfile
+
+from functools import lru_cache
+
+from biometalib.logger import logger
+
+
+# Implicit types of YAML 1.2, as resolved by ruamel's round-trip loader.
+_YAML12_TAGS = ['bool', 'int', 'float', 'null', 'timestamp']
+
+
+def _construct_int(loader, node):
+    # YAML 1.1 octal (010) and sexagesimal (1:30) ints are plain ints or strings in 1.2.
+    value = loader.construct_scalar(node).replace('_', '')
+    sign = -1 if value.startswith('-') else 1
+    value = value.lstrip('+-')
+    for prefix, base in (('0b', 2), ('0o', 8), ('0x', 16)):
+        if value.startswith(prefix):
+            return sign * int(value[2:], base)
+    return sign * int(value)
+
+
+def _construct_float(loader, node):
+    value = loader.construct_scalar(node).replace('_', '').lower()
+    if value.endswith('.inf'):
+        return float('-inf') if value.startswith('-') else float('inf')
+    if value.endswith('.nan'):
+        return float('nan')
+    return float(value)
+
+
+@lru_cache(maxsize=None)
+def _get_loader():
+    """Safe loader resolving plain scalars like YAML 1.2.
+
+    The implicit resolvers are those of ruamel's YAML 1.2 round-trip loader
+    used when writing, so attribute names like `yes`, `on`, `010` or `1:30`
+    load the same as they were written. PyYAML is only imported when a YAML
+    actually has to be parsed.
+    """
+    import yaml
+    from ruamel.yaml.resolver import implicit_resolvers
+    base = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    class _Loader(base):
+        pass
+
+    _Loader.yaml_implicit_resolvers = {}
+    for versions, tag, regexp, first in implicit_resolvers:
+        if ((1, 2) in versions) and (tag.rsplit(':', 1)[-1] in _YAML12_TAGS):
+            _Loader.add_implicit_resolver(tag, regexp, first)
+    _Loader.add_constructor('tag:yaml.org,2002:int', _construct_int)
+    _Loader.add_constructor('tag:yaml.org,2002:float', _construct_float)
+    return _Loader
+
+
+def get_cache_dir():
+    return os.environ.get('BIOMETALIB_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'biometalib'))
+
+
+def _cache_fn(fn, cache_dir):
+    name = hashlib.sha1(os.path.abspath(fn).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.pickle')
+
+
+def _sha1(fn):
+    with open(fn, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+def save_cache(fn, data, cache_dir=None):
+    """Store the parsed content of a YAML in the cache."""
+    cache_dir = cache_dir or get_cache_dir()
+    stat = os.stat(fn)
+    cached = {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'sha1': _sha1(fn),
+        'data': data,
+    }
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=cache_dir, delete=False) as fh:
+            pickle.dump(cached, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fh.name, _cache_fn(fn, cache_dir))
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        logger.debug('Could not cache {}'.format(fn))
+
+
+def load_yaml(fn, cache_dir=None):
+    """Load a YAML file as plain python objects.
+
+    Parameters:
+    -----------
+    fn: str
+        A YAML file.
+    cache_dir: str
+        Directory to cache parsed YAMLs in, see `get_cache_dir`.
+
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    stat = os.stat(fn)
+    try:
+        with open(_cache_fn(fn, cache_dir), 'rb') as fh:
+            cached = pickle.load(fh)
+        if (cached['mtime'] == stat.st_mtime) and (cached['size'] == stat.st_size):
+            return cached['data']
+        if cached['sha1'] == _sha1(fn):
+            save_cache(fn, cached['data'], cache_dir)
+            return cached['data']
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+    import yaml
+    with open(fn, 'r') as fh:
+        data = yaml.load(fh, Loader=_get_loader())
+    save_cache(fn, data, cache_dir)
+    return data
@@ -19,12 +19,18 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={'export': ['pyarrow>=1.0.0', 'scipy>=1.0.0']},
     license="MIT license",
     entry_points={
         'console_scripts':
         [
             'initialize_biometa = biometalib.utils.initialize_biometa:main',
             'attribute_selector = biometalib.utils.attribute_selector:main',
+            'ingest_ncbi_dump = biometalib.utils.ingest_ncbi_dump:main',
+            'apply_attributes = biometalib.utils.apply_attributes:main',
+            'export_biometa = biometalib.utils.export_biometa:main',
+            'attribute_snapshot = biometalib.utils.attribute_snapshot:main',
+            'biometa_indexes = biometalib.utils.biometa_indexes:main',
         ],
     },
     setup_requires=['pytest-runner'],
@@ -0,0 +1,38 @@
+import pytest
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+
+
+@pytest.fixture(autouse=True)
+def yaml_cache(tmp_path, monkeypatch):
+    """Keep parsed YAMLs out of the user's cache directory."""
+    cache_dir = tmp_path / 'biometalib_cache'
+    monkeypatch.setenv('BIOMETALIB_CACHE', str(cache_dir))
+    return cache_dir
+
+
+class FailingCollection(object):
+    """Collection whose bulk writes fail on the given IDs."""
+    def __init__(self, fail):
+        self.fail = set(fail)
+        self.batches = []
+
+    def bulk_write(self, ops, ordered=True):
+        ids = [op._filter['_id'] for op in ops]
+        self.batches.append(ids)
+        failed = [i for i, x in enumerate(ids) if x in self.fail]
+        if not failed:
+            return BulkWriteResult({'nUpserted': len(ids), 'nMatched': 0, 'upserted': []}, True)
+        # An ordered batch stops at its first error.
+        failed = failed[:1] if ordered else failed
+        done = failed[0] if ordered else len(ids) - len(failed)
+        raise BulkWriteError({
+            'writeErrors': [{'index': i, 'code': 2, 'errmsg': 'bad'} for i in failed],
+            'nUpserted': done, 'nMatched': 0,
+        })
+
+
+@pytest.fixture
+def failing_collection():
+    """The FailingCollection class, a stand-in for pymongo collections in writer tests."""
+    return FailingCollection
@@ -0,0 +1,73 @@
+import os
+import uuid
+
+import pytest
+
+from biometalib.utils.initialize_biometa import get_pipeline, STRING_FIELDS
+
+requires_server = pytest.mark.skipif(
+    'BIOMETALIB_TEST_REPLSET' not in os.environ,
+    reason='Set BIOMETALIB_TEST_REPLSET to the URI of a MongoDB 4.4+ server to run aggregation pipelines.')
+
+
+def test_pipeline_stages():
+    pipeline = get_pipeline({'sra.db_imported': {'$gte': 0}}, into='biometa_test')
+    assert [list(x)[0] for x in pipeline] == ['$match', '$match', '$project', '$group', '$addFields', '$merge']
+    assert pipeline[0] == {'$match': {'sra.db_imported': {'$gte': 0}}}
+
+    group = pipeline[3]['$group']
+    assert group['_id'] == '$biosample'
+    # SRX of a BioSample that disagree on a string field keep the largest value.
+    for field in list(STRING_FIELDS) + ['sample_title']:
+        assert group[field] == {'$max': '$' + field}
+    assert group['experiments'] == {'$addToSet': '$experiment'}
+
+    merge = pipeline[-1]['$merge']
+    assert (merge['into'], merge['on'], merge['whenNotMatched']) == ('biometa_test', '_id', 'insert')
+    combine = merge['whenMatched'][0]['$set']
+    # New string values replace stored ones, lists are unioned with the stored lists.
+    assert combine['sample_title'] == {'$ifNull': ['$$new.sample_title', '$sample_title']}
+    assert combine['sample_attributes'] == {
+        '$setUnion': [{'$ifNull': ['$sample_attributes', []]}, '$$new.sample_attributes']}
+    assert set(combine) == set(group) - {'_id'}
+
+
+def _ncbi(srx, biosample, sra_title, bio_title, study_title):
+    return {
+        '_id': srx,
+        'sra': {'sample': {'BioSample': biosample, 'title': sra_title,
+                           'attributes': [{'name': 'Dev stage', 'value': 'adult'}]},
+                'study': {'title': study_title}, 'run': [{'run_id': srx.replace('X', 'R')}]},
+        'biosample': [{'title': bio_title}],
+    }
+
+
+@requires_server
+def test_pipeline_conflicting_titles():
+    from pymongo import MongoClient
+    from biometalib.utils import initialize_biometa
+    client = MongoClient(os.environ['BIOMETALIB_TEST_REPLSET'])
+    db = client['biometalib_test_{}'.format(uuid.uuid4().hex)]
+    try:
+        db['ncbi'].insert_many([
+            _ncbi('SRX1', 'SAMN1', 'head', 'head', 'a study'),
+            _ncbi('SRX2', 'SAMN1', 'head', 'whole fly', 'b study'),
+        ])
+        db['biometa'].insert_one({'_id': 'SAMN1', 'srp': 'SRP1', 'sample_attributes': [{'name': 'sex', 'value': 'm'}]})
+        db['ncbi'].aggregate(get_pipeline({}, into='biometa'))
+
+        doc = db['biometa'].find_one({'_id': 'SAMN1'})
+        assert doc['sample_title'] == 'head|whole fly'
+        assert doc['study_title'] == 'b study'
+        assert doc['srp'] == 'SRP1'
+        assert sorted(x['srx'] for x in doc['experiments']) == ['SRX1', 'SRX2']
+        assert {'name': 'sex', 'value': 'm'} in doc['sample_attributes']
+        assert {'name': 'dev_stage', 'value': 'adult'} in doc['sample_attributes']
+
+        titles = list(db['ncbi'].aggregate([
+            {'$project': {'titles': initialize_biometa._titles()}},
+            {'$match': {'titles.1': {'$exists': True}}},
+        ]))
+        assert [x['_id'] for x in titles] == ['SRX2']
+    finally:
+        client.drop_database(db)
@@ -0,0 +1,136 @@
+import os
+import uuid
+
+import pytest
+
+from biometalib import annotate
+from biometalib.coerce import Coercer
+
+
+def test_get_mapping():
+    bioattr = {'sex': 'sex', 'gender': 'sex', 'tissue': 'ignore', 'foo': 'bar'}
+    mapping, dropped = annotate.get_mapping(bioattr, fields=['sex'])
+    assert mapping == {'sex': 'sex', 'gender': 'sex'}
+    assert dropped == {'bar'}
+
+
+def test_annotate():
+    sample_attributes = [
+        {'name': 'gender', 'value': 'female'},
+        {'name': 'sex', 'value': 'F'},
+        {'name': 'Sex', 'value': 'female'},
+        {'name': 'tissue', 'value': 'head'},
+        {'name': 'age', 'value': ''},
+    ]
+    mapping = {'gender': 'sex', 'sex': 'sex', 'Sex': 'sex', 'age': 'age'}
+    assert annotate.annotate(sample_attributes, mapping) == {'sex': 'female; F'}
+    assert annotate.annotate(None, mapping) == {}
+
+
+def test_changed_attributes():
+    old = {'gender': 'sex', 'age': 'age', 'stage': 'age'}
+    new = {'gender': 'sex', 'age': 'dev_stage', 'tissue': 'tissue'}
+    assert annotate.changed_attributes(old, new) == {'age', 'stage', 'tissue'}
+
+
+def test_get_query():
+    assert annotate.get_query('fear') == {}
+    assert annotate.get_query('fear', {'b', 'a'}) == {'$or': [
+        {'user_annotation.fear': {'$exists': False}},
+        {'sample_attributes.name': {'$in': ['a', 'b']}},
+    ]}
+
+
+def test_check_name():
+    assert annotate.check_name('fear') == 'fear'
+    for name in ['', 'a.b', '$fear']:
+        with pytest.raises(ValueError):
+            annotate.check_name(name)
+
+
+SAMPLE_ATTRIBUTES = {
+    'SAMN1': [{'name': 'gender', 'value': 'female'}, {'name': 'sex.1', 'value': 'F'},
+              {'name': 'Sex', 'value': 'female'}, {'name': 'tissue', 'value': 'head'}],
+    'SAMN2': [{'name': 'tissue', 'value': ' gut '}],
+    'SAMN3': [{'name': 'tissue', 'value': '  '}],
+}
+MAPPING = {'gender': 'sex', 'sex.1': 'sex', 'Sex': 'sex', 'tissue': 'tissue'}
+
+
+def _load(collection):
+    collection.insert_many([{'_id': k, 'sample_attributes': v} for k, v in sorted(SAMPLE_ATTRIBUTES.items())])
+    collection.update_one({'_id': 'SAMN2'}, {'$set': {'user_annotation': {'other': {'sex': 'male'}}}})
+    return collection
+
+
+def test_apply_mapping():
+    mongomock = pytest.importorskip('mongomock')
+    from biometalib.utils.apply_attributes import apply_mapping
+    collection = _load(mongomock.MongoClient()['sra']['biometa'])
+
+    stats = apply_mapping(collection, {}, 'fear', MAPPING, batch_size=2)
+    assert (stats['biosamples'], stats['annotated'], stats['written'], stats['errors']) == (3, 2, 3, 0)
+    docs = {x['_id']: x.get('user_annotation') for x in collection.find()}
+    assert docs == {
+        'SAMN1': {'fear': {'sex': 'female; F', 'tissue': 'head'}},
+        'SAMN2': {'other': {'sex': 'male'}, 'fear': {'tissue': 'gut'}},
+        'SAMN3': {'fear': {}},
+    }
+
+
+def test_apply_mapping_does_not_upsert():
+    mongomock = pytest.importorskip('mongomock')
+    from biometalib.utils.initialize_biometa import BiometaWriter
+    collection = _load(mongomock.MongoClient()['sra']['biometa'])
+
+    # A BioSample deleted while annotations are being written stays deleted.
+    writer = BiometaWriter(collection, upsert=False)
+    writer.add('SAMN1', 'SAMN1', set__user_annotation__fear={'sex': 'female'})
+    writer.add('SAMN9', 'SAMN9', set__user_annotation__fear={'sex': 'male'})
+    writer.flush()
+    assert collection.count_documents({}) == 3
+    assert collection.find_one({'_id': 'SAMN9'}) is None
+
+
+def _walk(value):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield k
+            for x in _walk(v):
+                yield x
+    elif isinstance(value, list):
+        for v in value:
+            for x in _walk(v):
+                yield x
+
+
+def test_annotation_pipeline():
+    pipeline = annotate.annotation_pipeline({'_id': 'SAMN1'}, 'fear', MAPPING, into='biometa')
+    assert [list(x)[0] for x in pipeline] == ['$match', '$project', '$merge']
+    assert pipeline[0] == {'$match': {'_id': 'SAMN1'}}
+    assert pipeline[2]['$merge']['whenNotMatched'] == 'discard'
+
+    # Older servers only accept $getField with a constant field, and attribute
+    # names with dots are not valid document keys, so neither may appear.
+    keys = set(_walk(pipeline))
+    assert '$getField' not in keys
+    assert not keys.intersection(MAPPING)
+
+
+@pytest.mark.skipif('BIOMETALIB_TEST_REPLSET' not in os.environ,
+                    reason='Set BIOMETALIB_TEST_REPLSET to the URI of a MongoDB 4.2+ server to run $merge.')
+def test_annotation_pipeline_server():
+    from pymongo import MongoClient
+    client = MongoClient(os.environ['BIOMETALIB_TEST_REPLSET'])
+    db = client['biometalib_test_{}'.format(uuid.uuid4().hex)]
+    try:
+        collection = _load(db['biometa'])
+        collection.aggregate(annotate.annotation_pipeline({}, 'fear', MAPPING, into='biometa'))
+        # The same values as the python engine, which trims string fields.
+        coercer = Coercer({})
+        for doc in collection.find():
+            expected = coercer.coerce_records([annotate.annotate(doc['sample_attributes'], MAPPING)])[0]
+            assert doc['user_annotation']['fear'] == expected
+        assert collection.find_one({'_id': 'SAMN2'})['user_annotation']['other'] == {'sex': 'male'}
+    finally:
+        client.drop_database(db.name)
@@ -1,7 +1,8 @@
 import pytest
 import os
 
-from biometalib.utils.attribute_selector import BioAttribute, connect_mongo
+from biometalib.utils.attribute_selector import BioAttribute, Prefetcher, connect_mongo, \
+    get_list_sample_attrs, get_novel_attrs, check_indexes
 
 @pytest.fixture()
 def yaml(tmpdir):
@@ -45,3 +46,124 @@ def test_BioAttribute(bioAttr):
     bio2 = BioAttribute(bioAttr.fn)
     assert len(bio2._storage['three']) == 1
 
+
+
+def test_BioAttribute_journal(bioAttr):
+    bioAttr['gender'] = 'sex'
+    bioAttr['new'] = 'new'
+    del bioAttr['two']
+    assert os.path.exists(bioAttr.journal)
+
+    # Decisions are recovered without writing the YAML
+    bio2 = BioAttribute(bioAttr.fn)
+    assert bio2['gender'] == 'sex'
+    assert 'two' not in bio2.keys()
+    assert 'new' in bio2.current_attrs
+
+    # Writing the YAML removes the journal
+    bio2.write_attributes()
+    assert not os.path.exists(bio2.journal)
+    bio3 = BioAttribute(bio2.fn)
+    assert 'gender' in bio3._storage['sex']
+
+
+def test_BioAttribute_torn_journal(bioAttr):
+    bioAttr['gender'] = 'sex'
+    bioAttr._journal.close()
+    # A crash while writing the next decision.
+    with open(bioAttr.journal, 'a') as fh:
+        fh.write('{"attr": "tiss')
+
+    bio2 = BioAttribute(bioAttr.fn)
+    assert bio2['gender'] == 'sex'
+    bio2['tissue'] = 'tissue'
+    bio2['age'] = 'ignore'
+
+    # Decisions made after the crash survive the next replay.
+    bio3 = BioAttribute(bioAttr.fn)
+    assert bio3['gender'] == 'sex'
+    assert bio3['tissue'] == 'tissue'
+    assert bio3['age'] == 'ignore'
+    with open(bioAttr.journal) as fh:
+        assert len(fh.readlines()) == 3
+
+
+def test_Prefetcher():
+    calls = []
+
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    prefetcher = Prefetcher(size=2)
+    prefetcher.prefetch(('square', 2), square, 2)
+    assert prefetcher.get(('square', 2), square, 2) == 4
+    assert calls == [2]
+
+    # Oldest results are dropped
+    prefetcher.get(('square', 3), square, 3)
+    prefetcher.get(('square', 4), square, 4)
+    prefetcher.get(('square', 2), square, 2)
+    assert calls == [2, 3, 4, 2]
+
+    prefetcher.clear('square')
+    prefetcher.get(('square', 4), square, 4)
+    assert calls == [2, 3, 4, 2, 4]
+    prefetcher.shutdown()
+
+
+def test_Prefetcher_retries_failed():
+    calls = []
+
+    def flaky(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise OSError('timed out')
+        return x
+
+    prefetcher = Prefetcher()
+    prefetcher.prefetch(('flaky', 1), flaky, 1)
+    with pytest.raises(OSError):
+        prefetcher.get(('flaky', 1), flaky, 1)
+    assert prefetcher.get(('flaky', 1), flaky, 1) == 1
+    assert prefetcher.get(('flaky', 1), flaky, 1) == 1
+    assert calls == [1, 1]
+    prefetcher.shutdown()
+
+
+@pytest.fixture()
+def biometa():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient()['sra']['biometa']
+    collection.insert_many([
+        {'_id': 'SAMN1', 'sample_attributes': [{'name': 'sex', 'value': 'f'}, {'name': 'tissue', 'value': 'head'}]},
+        {'_id': 'SAMN2', 'sample_attributes': [{'name': 'sex', 'value': 'm'}, {'name': 'age', 'value': '3'}]},
+        {'_id': 'SAMN3', 'sample_attributes': [{'name': 'sex', 'value': 'f'}, {'name': 'tissue', 'value': 'gut'}]},
+    ])
+    return collection
+
+
+def test_get_list_sample_attrs(biometa):
+    assert get_list_sample_attrs(biometa) == {'sex', 'tissue', 'age'}
+
+    # Without attribute_stats counts are computed from the samples.
+    assert get_list_sample_attrs(biometa, counts=True) == {'sex': 3, 'tissue': 2, 'age': 1}
+
+    biometa.database['attribute_stats'].insert_many([{'_id': 'sex', 'samples': 30}, {'_id': 'age', 'samples': 40}])
+    assert get_list_sample_attrs(biometa, counts=True) == {'sex': 30, 'age': 40}
+
+
+def test_get_novel_attrs(bioAttr, biometa):
+    counts = get_list_sample_attrs(biometa, counts=True)
+    counts['zygosity'] = 2
+    assert get_novel_attrs(counts, bioAttr) == ['age', 'tissue', 'zygosity']
+    assert get_novel_attrs(counts, bioAttr, sort_by_count=True) == ['tissue', 'zygosity', 'age']
+
+
+def test_check_indexes(biometa, caplog):
+    assert not check_indexes(biometa)
+    assert 'biometa_indexes --db sra' in caplog.text
+    assert list(biometa.index_information()) == ['_id_']
+
+    biometa.create_index([('sample_attributes.name', 1), ('sample_attributes.value', 1)])
+    assert check_indexes(biometa)
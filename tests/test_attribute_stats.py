@@ -0,0 +1,70 @@
+import os
+import uuid
+
+import pytest
+
+from biometalib.attribute_stats import (STATS_COLLECTION, values_pipeline, get_attribute_stats,
+                                        refresh_attribute_stats)
+
+BIOSAMPLES = [
+    ('SAMN1', 'PRJ1', [('sex', 'female'), ('tissue', 'head')]),
+    ('SAMN2', 'PRJ1', [('sex', 'female')]),
+    ('SAMN3', 'PRJ2', [('sex', 'male')]),
+    ('SAMN4', 'PRJ3', [('sex', 'female'), ('tissue', 'gut')]),
+]
+
+
+def _load(collection):
+    collection.insert_many([
+        {'_id': pk, 'bioproject': project, 'sample_attributes': [{'name': n, 'value': v} for n, v in attrs]}
+        for pk, project, attrs in BIOSAMPLES
+    ])
+    return collection
+
+
+@pytest.fixture
+def biometa():
+    mongomock = pytest.importorskip('mongomock')
+    return _load(mongomock.MongoClient()['sra']['biometa'])
+
+
+def test_values_pipeline(biometa):
+    stats = {x['_id']: x for x in biometa.aggregate(values_pipeline(top=1))}
+    assert stats['sex'] == {'_id': 'sex', 'samples': 4, 'distinct_values': 2,
+                            'values': [{'value': 'female', 'count': 3}]}
+    assert stats['tissue']['values'] == [{'value': 'gut', 'count': 1}]
+
+
+def test_get_attribute_stats_on_the_fly(biometa):
+    assert get_attribute_stats(biometa, 'sex', top=5) == {
+        '_id': 'sex', 'samples': 4, 'projects': 3, 'distinct_values': 2,
+        'values': [{'value': 'female', 'count': 3}, {'value': 'male', 'count': 1}],
+    }
+    assert get_attribute_stats(biometa, 'age')['samples'] == 0
+
+    # Precomputed statistics are used when they exist.
+    biometa.database[STATS_COLLECTION].insert_one({'_id': 'sex', 'samples': 10})
+    assert get_attribute_stats(biometa, 'sex') == {'_id': 'sex', 'samples': 10}
+
+
+@pytest.mark.skipif('BIOMETALIB_TEST_REPLSET' not in os.environ,
+                    reason='Set BIOMETALIB_TEST_REPLSET to the URI of a MongoDB 4.2+ server to run $merge.')
+def test_refresh_attribute_stats():
+    from pymongo import MongoClient
+    client = MongoClient(os.environ['BIOMETALIB_TEST_REPLSET'])
+    db = client['biometalib_test_{}'.format(uuid.uuid4().hex)]
+    try:
+        biometa = _load(db['biometa'])
+        refresh_attribute_stats(biometa)
+        assert db[STATS_COLLECTION].find_one({'_id': 'sex'})['projects'] == 3
+
+        biometa.delete_one({'_id': 'SAMN4'})
+        db[STATS_COLLECTION].insert_one({'_id': 'gone'})
+        refresh_attribute_stats(biometa, names=['tissue', 'gone'])
+        assert db[STATS_COLLECTION].find_one({'_id': 'tissue'})['samples'] == 1
+        assert db[STATS_COLLECTION].find_one({'_id': 'gone'}) is None
+        # Names that were not refreshed are untouched.
+        assert db[STATS_COLLECTION].find_one({'_id': 'sex'})['samples'] == 4
+        assert [x for x in db.list_collection_names() if x.startswith(STATS_COLLECTION)] == [STATS_COLLECTION]
+    finally:
+        client.drop_database(db)
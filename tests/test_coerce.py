@@ -0,0 +1,38 @@
+from biometalib.coerce import Coercer
+from biometalib.annotate import annotate, SEPARATOR
+
+SCHEMA = {
+    'sex': {'type': 'string'},
+    'age': {'type': 'int'},
+    'temperature': {'type': 'float'},
+    'checked': {'type': 'bool'},
+}
+
+
+def test_coerce_column():
+    coercer = Coercer(SCHEMA)
+    assert coercer.coerce_column('age', ['3 days', '3', 'N/A', '2.5', '4; 4', '1e20']).tolist() == [
+        3, 3, None, None, 4, None]
+    assert coercer.coerce_column('temperature', ['25C', '-1.5e2', ' 37 ']).tolist() == [25.0, -150.0, 37.0]
+    assert coercer.coerce_column('checked', ['Yes', 'no', 'Male']).tolist() == [True, False, None]
+    assert coercer.coerce_column('sex', [' Male ', 'unknown', ' ']).tolist() == ['Male', 'unknown', None]
+    assert coercer.unparsed == {'age': 2, 'checked': 1}
+    assert coercer.examples['age'] == ['1e20', '2.5']
+
+
+def test_coerce_records():
+    coercer = Coercer(SCHEMA)
+    records = [{'sex': 'female', 'age': 'N/A'}, {'age': '7d', 'checked': 'maybe', 'sex': 'none'}, {}]
+    assert coercer.coerce_records(records) == [{'sex': 'female'}, {'age': 7, 'sex': 'none'}, {}]
+    assert coercer.summary() == [('checked', 1, ['maybe'])]
+
+
+def test_string_na_matches_aggregate():
+    # The aggregate engine stores string values as annotate() builds them.
+    mapping = {'sex': 'sex', 'gender': 'sex', 'strain': 'strain'}
+    sample_attributes = [{'name': 'sex', 'value': 'none'}, {'name': 'gender', 'value': 'N/A'},
+                         {'name': 'strain', 'value': 'none'}]
+    expected = annotate(sample_attributes, mapping)
+    coercer = Coercer({'sex': {'type': 'string'}, 'strain': {'type': 'string'}}, separator=SEPARATOR)
+    assert coercer.coerce_records([annotate(sample_attributes, mapping)]) == [expected]
+    assert expected == {'sex': 'none; N/A', 'strain': 'none'}
@@ -0,0 +1,51 @@
+import os
+import gzip
+from datetime import datetime
+
+import bson
+from bson import json_util
+
+from biometalib.dump import read_dump, read_records, write_records
+
+
+def ncbi(srx, biosample):
+    return {
+        '_id': srx,
+        'sra': {'sample': {'BioSample': biosample, 'attributes': [{'name': 'Sex', 'value': 'male'}]}},
+        'pubmed': [{'pubmed_id': '1', 'date_created': datetime(2017, 1, 1)}],
+    }
+
+
+def test_read_json(tmpdir):
+    fn = os.path.join(str(tmpdir), 'ncbi.json.gz')
+    with gzip.open(fn, 'wt') as fh:
+        fh.write(json_util.dumps(ncbi('SRX1', 'SAMN1')) + '\n\n')
+        fh.write(json_util.dumps(ncbi('SRX2', None)) + '\n')
+
+    docs = list(read_dump(fn))
+    assert len(docs) == 2
+    assert docs[0]['pubmed'][0]['date_created'].year == 2017
+
+
+def test_read_bson(tmpdir):
+    fn = os.path.join(str(tmpdir), 'ncbi.bson')
+    with open(fn, 'wb') as fh:
+        fh.write(bson.encode(ncbi('SRX1', 'SAMN1')))
+        fh.write(bson.encode(ncbi('SRX2', 'SAMN2')))
+
+    assert [x['_id'] for x in read_dump(fn)] == ['SRX1', 'SRX2']
+
+
+def test_write_records(tmpdir):
+    fn = os.path.join(str(tmpdir), 'ncbi.bson')
+    with open(fn, 'wb') as fh:
+        fh.write(bson.encode(ncbi('SRX1', 'SAMN1')))
+        fh.write(bson.encode(ncbi('SRX2', '')))
+
+    records = [x for x in read_records([fn]) if x is not None]
+    out = os.path.join(str(tmpdir), 'biometa.json.gz')
+    assert write_records(records, out) == 1
+
+    record = list(read_dump(out))[0]
+    assert record['biosample'] == 'SAMN1'
+    assert record['sample_attributes'] == [{'name': 'sex', 'value': 'male'}]
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from biometalib.export import META_FIELDS, get_columns, TableWriter, MatrixWriter
+
+META = {x: [None, None] for x in META_FIELDS}
+META['biosample'] = ['SAMN1', 'SAMN2']
+
+
+def test_MatrixWriter(tmpdir):
+    sparse = pytest.importorskip('scipy.sparse')
+    prefix = os.path.join(str(tmpdir), 'matrix')
+    writer = MatrixWriter(prefix, ['age', 'sex', 'tissue'])
+    writer.write(META, [{'tissue': 'head', 'sex': 'female'}, {}])
+    writer.close()
+
+    matrix = sparse.load_npz(prefix + '.npz')
+    assert matrix.toarray().tolist() == [[0, 1, 1], [0, 0, 0]]
+    with open(prefix + '.rows.txt') as fh:
+        assert fh.read().split() == ['SAMN1', 'SAMN2']
+    with open(prefix + '.cols.txt') as fh:
+        assert fh.read().split() == ['age', 'sex', 'tissue']
+
+
+def test_TableWriter(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    fn = os.path.join(str(tmpdir), 'biometa.parquet')
+    writer = TableWriter(fn, ['age', 'sex'], schema={'age': {'type': 'int'}})
+    writer.write(META, [{'age': '3 days', 'sex': 'female'}, {'age': 'old'}])
+    writer.write(META, [{}, {'sex': 'male'}])
+    writer.close()
+
+    table = pq.read_table(fn)
+    assert str(table.schema.field('age').type) == 'int64'
+    assert table.column('age').to_pylist() == [3, None, None, None]
+    assert table.column('sex').to_pylist() == ['female', None, None, 'male']
+    assert writer.coercer.unparsed == {'age': 1}
+
+
+def test_TableWriter_max_columns(tmpdir):
+    fn = os.path.join(str(tmpdir), 'biometa.parquet')
+    with pytest.raises(ValueError):
+        TableWriter(fn, ['a', 'b', 'c'], max_columns=2)
+    assert not os.path.exists(fn)
+
+
+def test_get_columns():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient()['sra']['biometa']
+    collection.insert_one({'_id': 'SAMN1', 'sample_attributes': [
+        {'name': 'sex', 'value': 'female'}, {'name': 'srp', 'value': 'SRP1'}, {'name': 'tissue', 'value': 'head'}]})
+
+    assert get_columns(collection)[1] == ['sex', 'srp_attr', 'tissue']
+    assert get_columns(collection, names=['sex']) == ({'sex': 'sex'}, ['sex'])
+    mapping = {'gender': 'sex', 'organ': 'tissue'}
+    assert get_columns(collection, mapping, names=['tissue']) == ({'organ': 'tissue'}, ['tissue'])
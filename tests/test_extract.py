@@ -0,0 +1,77 @@
+import pytest
+
+from biometalib.extract import get_record, get_sample_attributes, get_papers, merge_records
+
+
+@pytest.fixture()
+def ncbi():
+    return {
+        '_id': 'SRX000001',
+        'sra': {
+            'sample': {
+                'BioSample': 'SAMN00000001',
+                'sample_id': 'SRS000001',
+                'title': 'head',
+                'taxon_id': '7227',
+                'attributes': [
+                    {'name': 'Sex', 'value': 'male'},
+                    {'name': 'dev stage', 'value': 'adult'},
+                ],
+            },
+            'study': {'study_id': 'SRP000001', 'BioProject': 'PRJNA000001', 'title': ''},
+            'run': [{'run_id': 'SRR000001'}, {'run_id': 'SRR000001'}, {'run_id': ''}],
+        },
+        'biosample': [{
+            'title': 'head',
+            'description': 'adult head',
+            'contacts': [{'first_name': 'Justin', 'last_name': 'Fear'}],
+            'attributes': [{'name': 'sex', 'value': 'male'}, {'name': 'tissue'}],
+        }],
+        'pubmed': [{'pubmed_id': '1'}, {'pubmed_id': '1'}, {'pubmed_id': '2'}],
+    }
+
+
+def test_get_sample_attributes(ncbi):
+    attrs = get_sample_attributes(ncbi)
+    assert sorted(x['name'] for x in attrs) == ['dev_stage', 'sex', 'tissue']
+
+
+def test_get_papers(ncbi):
+    assert [x['pubmed_id'] for x in get_papers(ncbi)] == ['1', '2']
+
+
+def test_get_record(ncbi):
+    record = get_record(ncbi)
+    assert record['biosample'] == 'SAMN00000001'
+    assert record['strings'] == {
+        'srs': 'SRS000001',
+        'srp': 'SRP000001',
+        'bioproject': 'PRJNA000001',
+        'description': 'adult head',
+        'sample_title': 'head',
+        'taxon_id': '7227',
+    }
+    assert record['contacts'] == [{'first_name': 'Justin', 'last_name': 'Fear', 'email': None}]
+    assert record['experiments'] == [{'srx': 'SRX000001', 'runs': ['SRR000001']}]
+
+    # Skip documents without a BioSample
+    ncbi['sra']['sample']['BioSample'] = ''
+    assert get_record(ncbi) is None
+
+
+def test_merge_records(ncbi):
+    first = get_record(ncbi)
+
+    ncbi['_id'] = 'SRX000002'
+    ncbi['sra']['sample']['sample_id'] = 'SRS000002'
+    ncbi['sra']['sample']['attributes'].append({'name': 'Age', 'value': '3 days'})
+    ncbi['pubmed'].append({'pubmed_id': '3'})
+    second = get_record(ncbi)
+
+    merged = merge_records([first, second])
+    assert merged['srx'] == ['SRX000001', 'SRX000002']
+    assert merged['strings']['srs'] == 'SRS000002'
+    assert len(merged['contacts']) == 1
+    assert [x['srx'] for x in merged['experiments']] == ['SRX000001', 'SRX000002']
+    assert [x['pubmed_id'] for x in merged['papers']] == ['1', '2', '3']
+    assert sorted(x['name'] for x in merged['sample_attributes']) == ['age', 'dev_stage', 'sex', 'tissue']
@@ -0,0 +1,96 @@
+from collections import Counter
+
+import pytest
+
+from sramongo.mongo_schema import Pubmed
+
+from biometalib.extract import get_record, merge_records
+from biometalib.fingerprint import fingerprint, skip_unchanged, load_fingerprints
+from biometalib.utils.initialize_biometa import get_update
+
+
+def _record(srx, title='head'):
+    return get_record({
+        '_id': srx,
+        'sra': {'sample': {'BioSample': 'SAMN1', 'title': title, 'attributes': [{'name': 'sex', 'value': 'male'}]}},
+    })
+
+
+def test_fingerprint():
+    assert fingerprint(_record('SRX1')) == fingerprint(_record('SRX1'))
+    assert fingerprint(_record('SRX1')) != fingerprint(_record('SRX1', title='body'))
+    assert fingerprint(_record('SRX1')) != fingerprint(_record('SRX1'), normalized=True)
+    assert -2 ** 63 <= fingerprint(_record('SRX1')) < 2 ** 63
+
+
+def test_fingerprint_order():
+    record = _record('SRX1')
+    record['strings']['sample_title'] = 'head|body'
+    record['sample_attributes'].append({'name': 'tissue', 'value': 'head'})
+    record['experiments'][0]['runs'] = ['SRR1', 'SRR2']
+
+    shuffled = _record('SRX1')
+    shuffled['strings']['sample_title'] = 'body|head'
+    shuffled['sample_attributes'].insert(0, {'name': 'tissue', 'value': 'head'})
+    shuffled['experiments'][0]['runs'] = ['SRR2', 'SRR1']
+    assert fingerprint(record) == fingerprint(shuffled)
+
+
+class FindSpy(object):
+    """Collection recording the queries it was sent."""
+    def __init__(self, collection):
+        self.collection = collection
+        self.queries = []
+
+    def find(self, query, **kwargs):
+        self.queries.append(query)
+        return self.collection.find(query, **kwargs)
+
+
+def test_skip_unchanged():
+    mongomock = pytest.importorskip('mongomock')
+    collection = FindSpy(mongomock.MongoClient()['sra']['biometa'])
+    collection.collection.insert_many([
+        {'_id': 'SAMN1', 'fingerprints': {'SRX1': fingerprint(_record('SRX1')),
+                                          'SRX2': fingerprint(_record('SRX2', title='old'))}},
+        {'_id': 'SAMN9', 'fingerprints': {'SRX9': 9}},
+    ])
+
+    stats = Counter()
+    records = [_record('SRX1'), _record('SRX2'), _record('SRX3')]
+    records = list(skip_unchanged(records, collection, stats, batch_size=2))
+
+    assert [r['srx'] for r in records] == ['SRX2', 'SRX3']
+    assert stats['unchanged'] == 1
+    # A query per batch, only for the BioSamples of the batch.
+    assert collection.queries == [
+        {'_id': {'$in': ['SAMN1']}, 'fingerprints': {'$exists': True}},
+        {'_id': {'$in': ['SAMN1']}, 'fingerprints': {'$exists': True}},
+    ]
+
+    merged = merge_records(records)
+    assert sorted(merged['fingerprints']) == ['SRX2', 'SRX3']
+    update = get_update(merged)
+    assert update['set__fingerprints__SRX3'] == fingerprint(_record('SRX3'))
+
+
+def test_fingerprint_raw():
+    # Raw documents leave out empty fields that sramongo documents have.
+    record = _record('SRX1')
+    record['papers'] = [{'pubmed_id': '1', 'title': 'A paper'}]
+    hydrated = _record('SRX1')
+    hydrated['papers'] = [Pubmed(pubmed_id='1', title='A paper')]
+    assert hydrated['papers'][0].to_mongo().to_dict()['authors'] == []
+    assert fingerprint(record) == fingerprint(hydrated)
+
+
+def test_load_fingerprints():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient()['sra']['biometa']
+    collection.insert_many([
+        {'_id': 'SAMN1', 'fingerprints': {'SRX1': 1, 'SRX2': 2}},
+        {'_id': 'SAMN2', 'fingerprints': {'SRX3': 3}},
+        {'_id': 'SAMN3'},
+    ])
+    assert load_fingerprints(collection) == {'SRX1': 1, 'SRX2': 2, 'SRX3': 3}
+    assert load_fingerprints(collection, {'_id': {'$gte': 'SAMN2'}}) == {'SRX3': 3}
@@ -0,0 +1,101 @@
+import os
+import uuid
+from collections import Counter
+
+import pytest
+
+from biometalib.follow import iter_batches, get_records, ResumeTokens, watch
+from biometalib.utils.initialize_biometa import BiometaWriter, apply_changes
+
+
+class Stream(object):
+    """Change stream returning the given changes, None when idle."""
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.alive = True
+        self.resume_token = None
+
+    def try_next(self):
+        change = self.changes.pop(0) if self.changes else None
+        if change is not None:
+            self.resume_token = change['_id']
+        return change
+
+
+def _change(i, biosample='SAMN1', op='insert', full=True):
+    change = {'_id': {'_data': str(i)}, 'operationType': op, 'documentKey': {'_id': 'SRX{}'.format(i)}}
+    if full:
+        change['fullDocument'] = {
+            'sra': {'sample': {'BioSample': biosample, 'attributes': [{'name': 'sex', 'value': 'female'}]}},
+        }
+    return change
+
+
+def test_iter_batches():
+    # Two bursts separated by an idle read.
+    changes = [_change(1), _change(2), _change(3), None, _change(4)]
+    batches = list(iter_batches(Stream(changes), batch_size=2, window=60, idle_timeout=0))
+    assert [([x['_id']['_data'] for x in b], t['_data']) for b, t in batches] == [
+        (['1', '2'], '2'), (['3'], '3'), (['4'], '4'),
+    ]
+
+
+def test_get_records():
+    stats = Counter()
+    changes = [_change(1), _change(2), _change(1, op='update'), _change(3, biosample='SAMN2'),
+               _change(4, op='update', full=False), _change(5, biosample=None)]
+    records = get_records(changes, stats)
+
+    assert [r['biosample'] for r in records] == ['SAMN1', 'SAMN2']
+    assert sorted(records[0]['srx']) == ['SRX1', 'SRX2']
+    assert stats == Counter(srx=4, deleted=1, no_biosample=1)
+
+
+def test_apply_changes():
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient()['sra']
+
+    tokens = ResumeTokens(db['biometa_checkpoint'])
+    assert tokens.load() is None
+    tokens.save({'_data': '1'})
+    assert tokens.load() == {'_data': '1'}
+
+    writer = BiometaWriter(db['biometa'])
+    metrics = apply_changes([_change(1), _change(2)], writer)
+    apply_changes([_change(2)], writer, metrics=metrics)
+
+    doc = db['biometa'].find_one({'_id': 'SAMN1'})
+    assert sorted(x['srx'] for x in doc['experiments']) == ['SRX1', 'SRX2']
+    assert metrics.counts['changes'] == 3
+
+
+@pytest.mark.skipif('BIOMETALIB_TEST_REPLSET' not in os.environ,
+                    reason='Set BIOMETALIB_TEST_REPLSET to the URI of a replica set to test change streams.')
+def test_follow_replica_set():
+    from pymongo import MongoClient
+    client = MongoClient(os.environ['BIOMETALIB_TEST_REPLSET'])
+    db = client['biometalib_test_{}'.format(uuid.uuid4().hex)]
+    try:
+        ncbi = db['ncbi']
+        ncbi.insert_one({'_id': 'SRX0'})
+        tokens = ResumeTokens(db['biometa_checkpoint'])
+        writer = BiometaWriter(db['biometa'])
+
+        with watch(ncbi, max_await=0.1) as stream:
+            tokens.save(stream.resume_token)
+            ncbi.insert_one({'_id': 'SRX1', 'sra': {'sample': {'BioSample': 'SAMN1'}}})
+            ncbi.update_one({'_id': 'SRX1'}, {'$set': {'sra.sample.attributes': [{'name': 'sex', 'value': 'male'}]}})
+            for changes, token in iter_batches(stream, window=0.5, idle_timeout=1):
+                apply_changes(changes, writer)
+                tokens.save(token)
+
+        doc = db['biometa'].find_one({'_id': 'SAMN1'})
+        assert doc['sample_attributes'] == [{'name': 'sex', 'value': 'male'}]
+
+        # A restarted follower continues after the stored token.
+        ncbi.insert_one({'_id': 'SRX2', 'sra': {'sample': {'BioSample': 'SAMN2'}}})
+        with watch(ncbi, resume_after=tokens.load(), max_await=0.1) as stream:
+            ids = [c['documentKey']['_id'] for b, _ in iter_batches(stream, idle_timeout=1) for c in b]
+        assert ids == ['SRX2']
+    finally:
+        client.drop_database(db)
@@ -0,0 +1,16 @@
+from biometalib.indexes import _plan_indexes
+from biometalib.models import Biometa
+
+
+def test_Biometa_indexes():
+    specs = [x['fields'] for x in Biometa._meta['index_specs']]
+    assert [('bioproject', 1)] in specs
+    assert [('sample_attributes.name', 1), ('sample_attributes.value', 1)] in specs
+    assert Biometa._meta['auto_create_index'] is False
+
+
+def test_plan_indexes():
+    plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'bioproject_1'}}
+    assert _plan_indexes(plan) == ['bioproject_1']
+    plan = {'stage': 'OR', 'inputStages': [{'stage': 'COLLSCAN'}, {'stage': 'IXSCAN', 'indexName': 'gsm_1'}]}
+    assert sorted(_plan_indexes(plan)) == ['COLLSCAN', 'gsm_1']
@@ -0,0 +1,154 @@
+import argparse
+from datetime import datetime
+
+import pytest
+
+from pymongo.errors import BulkWriteError
+
+from biometalib.utils.initialize_biometa import (partition_query, partition_queryset, parse_date, BiometaWriter,
+                                                 count_srx, get_partitions)
+
+
+def test_partition_query():
+    assert partition_query(None, None) == {'sra.sample.BioSample': {'$gt': ''}}
+    assert partition_query(None, 'SAMN2') == {'sra.sample.BioSample': {'$gt': '', '$lt': 'SAMN2'}}
+    assert partition_query('SAMN2', None) == {'sra.sample.BioSample': {'$gte': 'SAMN2'}}
+    assert partition_query('SAMN2', 'SAMN5') == {'sra.sample.BioSample': {'$gte': 'SAMN2', '$lt': 'SAMN5'}}
+
+
+def test_parse_date():
+    assert parse_date('2017-03-01') == datetime(2017, 3, 1)
+    assert parse_date('2017-03-01T12:30:00') == datetime(2017, 3, 1, 12, 30)
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_date('March 1st')
+
+
+def test_writer_retries_ordered_batch(failing_collection):
+    collection = failing_collection(['SAMN2'])
+    writer = BiometaWriter(collection, batch_size=4)
+    for i in range(1, 5):
+        writer.add('SRX{}'.format(i), 'SAMN{}'.format(i), biosample='SAMN{}'.format(i))
+    writer.flush()
+
+    # The rest of the batch after the failed upsert is sent again.
+    assert collection.batches == [['SAMN1', 'SAMN2', 'SAMN3', 'SAMN4'], ['SAMN3', 'SAMN4']]
+    assert (writer.written, writer.errors) == (3, 1)
+
+
+def test_writer_unordered_batch(failing_collection):
+    collection = failing_collection(['SAMN2'])
+    writer = BiometaWriter(collection, batch_size=4, ordered=False)
+    for i in range(1, 5):
+        writer.add('SRX{}'.format(i), 'SAMN{}'.format(i), biosample='SAMN{}'.format(i))
+    writer.flush()
+    assert len(collection.batches) == 1
+    assert (writer.written, writer.errors) == (3, 1)
+
+
+def test_writer_write_concern_error(caplog, failing_collection):
+    class ConcernCollection(failing_collection):
+        def bulk_write(self, ops, ordered=True):
+            self.batches.append([op._filter['_id'] for op in ops])
+            raise BulkWriteError({
+                'writeErrors': [], 'writeConcernErrors': [{'code': 64, 'errmsg': 'waiting for replication'}],
+                'nUpserted': len(ops), 'nMatched': 0,
+            })
+
+    collection = ConcernCollection([])
+    writer = BiometaWriter(collection, batch_size=2)
+    for i in range(1, 3):
+        writer.add('SRX{}'.format(i), 'SAMN{}'.format(i), biosample='SAMN{}'.format(i))
+    writer.flush()
+    assert collection.batches == [['SAMN1', 'SAMN2']]
+    assert (writer.written, writer.errors) == (2, 0)
+    assert 'WriteConcernError: waiting for replication' in caplog.text
+
+
+def test_writer_skips_invalid(caplog, failing_collection):
+    collection = failing_collection([])
+    writer = BiometaWriter(collection)
+    writer.add('SRX1', 'SAMN1', add_to_set__sample_attributes=[{'name': 'sex', 'value': 'male', 'extra': 1}])
+    writer.add('SRX2', 'SAMN2', add_to_set__papers=[{'pubmed_id': '1', 'bogus': 1}])
+    writer.add('SRX3', 'SAMN3', taxon_id=7227)
+    writer.add('SRX4', 'SAMN4', add_to_set__sample_attributes=[{'name': 'sex', 'value': 'male'}])
+    writer.flush()
+
+    assert collection.batches == [['SAMN4']]
+    assert (writer.errors, writer.invalid) == (3, 3)
+    assert 'FieldDoesNotExist: Skipping SRX1' in caplog.text
+
+
+@pytest.fixture
+def ncbi():
+    mongomock = pytest.importorskip('mongomock')
+    import mongoengine as me
+    from sramongo.mongo_schema import Ncbi
+    me.connect('test_partitions', mongo_client_class=mongomock.MongoClient)
+    Ncbi._collection = None
+    Ncbi._get_collection().insert_many([
+        {'_id': 'SRX3', '_cls': 'Ncbi', 'sra': {'sample': {'BioSample': 'SAMN1'}}},
+        {'_id': 'SRX1', '_cls': 'Ncbi', 'sra': {'sample': {'BioSample': 'SAMN2'}}},
+        {'_id': 'SRX2', '_cls': 'Ncbi', 'sra': {'sample': {'BioSample': 'SAMN2'}}},
+        {'_id': 'SRX0', '_cls': 'Ncbi', 'sra': {'sample': {'BioSample': 'SAMN3'}}},
+    ])
+    yield Ncbi
+    me.disconnect()
+    Ncbi._collection = None
+
+
+def test_partition_queryset(ncbi):
+    partition = {'lower': 'SAMN1', 'upper': 'SAMN3', 'last_id': None, 'last_biosample': None}
+    queryset = partition_queryset(ncbi.objects, partition)
+    assert queryset._ordering == [('sra.sample.BioSample', 1), ('_id', 1)]
+    assert [x.srx for x in queryset] == ['SRX3', 'SRX1', 'SRX2']
+
+    # Resume after the last SRX written, in the middle of a BioSample.
+    partition.update(last_id='SRX1', last_biosample='SAMN2')
+    assert [x.srx for x in partition_queryset(ncbi.objects, partition)] == ['SRX2']
+
+    partition.update(last_id='SAMN1', last_biosample='SAMN1')
+    assert [x.srx for x in partition_queryset(ncbi.objects, partition, coalesce=True)] == ['SRX1', 'SRX2']
+
+
+def test_count_srx(ncbi, monkeypatch):
+    collection = type(ncbi._get_collection())
+    calls = []
+    count_documents = collection.count_documents
+    monkeypatch.setattr(collection, 'count_documents', lambda self, *args, **kwargs: calls.append(args) or
+                        count_documents(self, *args, **kwargs))
+    monkeypatch.setattr(collection, 'estimated_document_count', lambda self, **kwargs: 42)
+
+    # A full run uses the estimate instead of counting every document.
+    assert count_srx() == 42
+    assert calls == []
+
+    assert count_srx(datetime(2017, 1, 1)) == 0
+    assert len(calls) == 1
+
+
+class AggregateSpy(object):
+    """Queryset stand-in recording the aggregation pipeline sent to its collection."""
+    def __init__(self, query):
+        self._query = query
+        self._collection = self
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return iter([{'_id': {'min': 'SAMN1'}}, {'_id': {'min': 'SAMN5'}}])
+
+
+def test_get_partitions():
+    # $sample must come first for the server to pick random documents.
+    queryset = AggregateSpy({'_cls': 'Ncbi'})
+    partitions = get_partitions(queryset, 2, sample_size=100)
+    assert [(x['lower'], x['upper']) for x in partitions] == [(None, 'SAMN5'), ('SAMN5', None)]
+    assert [list(x)[0] for x in queryset.pipelines[0]] == ['$sample', '$match', '$match', '$bucketAuto']
+    assert queryset.pipelines[0][0] == {'$sample': {'size': 200}}
+
+    # A date filter selects few documents, so it runs first.
+    queryset = AggregateSpy({'_cls': 'Ncbi', 'sra.db_imported': {'$gte': datetime(2017, 1, 1)}})
+    get_partitions(queryset, 2, sample_size=100)
+    assert [list(x)[0] for x in queryset.pipelines[0]] == ['$match', '$match', '$sample', '$bucketAuto']
+
+    assert len(get_partitions(AggregateSpy({}), 1)) == 1
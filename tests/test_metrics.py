@@ -0,0 +1,32 @@
+import os
+import json
+import pickle
+
+from biometalib.metrics import Metrics
+
+
+def test_Metrics(tmpdir):
+    metrics = Metrics(total=10)
+    for x in metrics.timed(range(4), 'read'):
+        with metrics.timer('write'):
+            metrics.counts['srx'] += 1
+    metrics.latencies.extend([0.1, 0.2, 0.3, 0.4])
+
+    assert metrics.counts['srx'] == 4
+    assert set(metrics.times) == {'read', 'write'}
+    assert abs(sum(metrics.split().values()) - 1) < 1e-9
+    assert metrics.percentiles()['max'] == 0.4
+    assert metrics.progress().startswith('Processed 4 of 10 SRX')
+
+    # Metrics sent back from a worker are merged
+    worker = pickle.loads(pickle.dumps(metrics))
+    metrics.merge(worker)
+    assert metrics.counts['srx'] == 8
+    assert len(metrics.latencies) == 8
+
+    fn = os.path.join(str(tmpdir), 'metrics.json')
+    metrics.write_json(fn)
+    with open(fn) as fh:
+        data = json.load(fh)
+    assert data['counts'] == {'srx': 8}
+    assert data['batches'] == 8
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_IMPORT = """\
+import sys, json
+import biometalib.models
+lazy = {
+    'yaml': 'yaml' in sys.modules,
+    'pkg_resources': 'pkg_resources' in sys.modules,
+    'parsed': biometalib.models.get_cleaned_attributes.cache_info().misses,
+    'built': biometalib.models.get_cleaned_attributes_model.cache_info().currsize,
+}
+biometalib.models.Biometa(biosample='SAMN0', srs='SRS0')
+lazy['parsed_after_use'] = biometalib.models.get_cleaned_attributes.cache_info().misses
+print(json.dumps(lazy))
+"""
+
+
+def _import_models():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.check_output([sys.executable, '-c', _IMPORT], env=env, cwd=ROOT)
+    return json.loads(out.decode('utf-8'))
+
+
+def test_import_is_lazy():
+    res = _import_models()
+    assert not res['yaml']
+    assert not res['pkg_resources']
+    assert res['parsed'] == 0
+    assert res['built'] == 0
+    assert res['parsed_after_use'] == 0
+
+
+# The own import time of biometalib.models, measured after mongoengine and
+# sramongo are loaded, is compared to the time those take. Importing
+# pkg_resources and parsing cleaned_fields.yaml at import cost more than
+# this, while the lazy module takes a few milliseconds, so machine speed
+# does not make the check flaky.
+IMPORT_BUDGET = 0.5
+
+_IMPORT_TIME = """\
+import json, time
+start = time.perf_counter()
+import mongoengine, sramongo.mongo_schema
+deps = time.perf_counter()
+import biometalib.models
+print(json.dumps({'deps': deps - start, 'models': time.perf_counter() - deps}))
+"""
+
+
+def test_import_time():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    runs = [json.loads(subprocess.check_output([sys.executable, '-c', _IMPORT_TIME], env=env, cwd=ROOT).decode('utf-8'))
+            for _ in range(3)]
+    models = min(x['models'] for x in runs)
+    deps = min(x['deps'] for x in runs)
+    print('import biometalib.models: {:.0f} ms (mongoengine and sramongo {:.0f} ms)'.format(models * 1000, deps * 1000))
+    assert models < IMPORT_BUDGET * deps
+
+
+def test_lazy_attributes(monkeypatch):
+    from biometalib import models
+    calls = []
+    monkeypatch.setattr(models, 'get_cleaned_attributes_model', lambda: calls.append(1) or 'model')
+    assert models.CleanedAttributes == 'model'
+    assert calls == [1]
+    assert 'CleanedAttributes' not in vars(models)
+
+
+def test_CleanedAttributes():
+    from biometalib import models
+    CleanedAttributes = models.get_cleaned_attributes_model()
+    assert models.CleanedAttributes is CleanedAttributes
+    assert set(CleanedAttributes._fields) >= set(models.CLEANED_ATTRIBUTES)
+    assert models.Biometa._fields['user_annotation'].field.document_type is CleanedAttributes
@@ -0,0 +1,78 @@
+import pytest
+
+from sramongo.mongo_schema import Pubmed
+
+from biometalib.normalize import normalize_record, contact_id, dereference, SharedWriter
+from biometalib.utils.initialize_biometa import get_update
+
+
+def _record():
+    return {
+        'srx': 'SRX1',
+        'biosample': 'SAMN1',
+        'contacts': [{'first_name': 'Jane', 'last_name': 'Doe', 'email': 'jane@example.org'}],
+        'papers': [Pubmed(pubmed_id='123', title='A paper')],
+        'experiments': [],
+        'sample_attributes': [],
+        'strings': {},
+    }
+
+
+def test_contact_id():
+    contact = {'first_name': 'Jane', 'last_name': 'Doe', 'email': 'jane@example.org'}
+    assert contact_id(contact) == contact_id(dict(contact))
+    assert contact_id(contact) != contact_id(dict(contact, email='doe@example.org'))
+
+
+def test_normalize_record():
+    record, papers, contacts = normalize_record(_record())
+    assert 'papers' not in record
+    assert record['paper_ids'] == ['123']
+    assert papers == [{'_id': '123', 'pubmed_id': '123', 'title': 'A paper', 'authors': []}]
+    assert record['contact_ids'] == [contacts[0]['_id']]
+
+    update = get_update(record)
+    assert update['add_to_set__paper_ids'] == ['123']
+    assert 'add_to_set__papers' not in update
+
+
+def test_dereference():
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient()['sra']
+
+    writer = SharedWriter(db, batch_size=10)
+    docs = []
+    for biosample in ['SAMN1', 'SAMN2']:
+        record, papers, contacts = normalize_record(dict(_record(), biosample=biosample))
+        writer.add_all(papers, contacts)
+        docs.append({'_id': biosample, 'paper_ids': record['paper_ids'], 'contact_ids': record['contact_ids']})
+    writer.flush()
+
+    # The shared paper and contact are only stored once.
+    assert writer.written == 2
+    assert db['papers'].count_documents({}) == 1
+
+    docs.append({'_id': 'SAMN3'})
+    dereference(docs, db)
+    assert [x['title'] for x in docs[0]['papers']] == ['A paper']
+    assert docs[1]['contacts'][0]['last_name'] == 'Doe'
+    assert docs[2]['papers'] == []
+
+
+def test_SharedWriter_retries_failed(failing_collection):
+    writer = SharedWriter({'papers': None, 'contacts': None}, batch_size=10)
+    papers = failing_collection(['2'])
+    writer.collections['papers'] = papers
+
+    for pk in ['1', '2', '1']:
+        writer.add('papers', {'_id': pk, 'title': pk})
+    writer.flush()
+    assert papers.batches == [['1', '2']]
+    assert writer.written == 1
+
+    # Only the paper that was written is remembered.
+    papers.fail.clear()
+    for pk in ['1', '2']:
+        writer.add('papers', {'_id': pk, 'title': pk})
+    writer.flush()
+    assert papers.batches == [['1', '2'], ['2']]
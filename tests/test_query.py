@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from biometalib.query import IdCache, BiometaQuery, to_ids, intersect, filter_query, record_write
+
+
+def test_intersect():
+    a = to_ids(['SAMN3', 'SAMN1', 'SAMN2', 'SAMN1'])
+    assert a.tolist() == ['SAMN1', 'SAMN2', 'SAMN3']
+    assert intersect([a, to_ids(['SAMN2', 'SAMN3', 'SAMN4']), to_ids(['SAMN3'])]).tolist() == ['SAMN3']
+    assert intersect([a, to_ids([])]).tolist() == []
+
+
+def test_filter_query():
+    assert filter_query('sample_attributes.sex', 'female') == {
+        'sample_attributes': {'$elemMatch': {'name': 'sex', 'value': 'female'}}}
+    assert filter_query('bioproject', 'PRJNA1') == {'bioproject': 'PRJNA1'}
+    with pytest.raises(ValueError):
+        filter_query('study_abstract', 'flies')
+
+
+def test_id_cache():
+    cache = IdCache(max_bytes=to_ids(['SAMN1', 'SAMN2']).nbytes, ttl=60)
+    cache.put('a', to_ids(['SAMN1']))
+    cache.put('b', to_ids(['SAMN2']))
+    assert cache.get('a') is not None
+    # Least recently used goes first.
+    cache.put('c', to_ids(['SAMN3']))
+    assert cache.get('b') is None
+    assert sorted(cache._data) == ['a', 'c']
+
+    cache.ttl = -1
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_id_cache_threads():
+    arrays = [to_ids(['SAMN{}'.format(i)]) for i in range(20)]
+    cache = IdCache(max_bytes=sum(x.nbytes for x in arrays[:5]), ttl=60)
+
+    def work(n):
+        for i in range(500):
+            key = (n + i) % len(arrays)
+            if cache.get(key) is None:
+                cache.put(key, arrays[key])
+            if i % 97 == 0:
+                cache.clear()
+
+    threads = [threading.Thread(target=work, args=(n, )) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.nbytes == sum(x[1].nbytes for x in cache._data.values())
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_biometa_query():
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient()['sra']
+    biometa = db['biometa']
+    biometa.insert_many([
+        {'_id': 'SAMN1', 'bioproject': 'PRJNA1', 'srp': 'SRP1',
+         'sample_attributes': [{'name': 'sex', 'value': 'female'}, {'name': 'tissue', 'value': 'head'}]},
+        {'_id': 'SAMN2', 'bioproject': 'PRJNA1', 'srp': 'SRP1',
+         'sample_attributes': [{'name': 'sex', 'value': 'male'}, {'name': 'tissue', 'value': 'female'}]},
+        {'_id': 'SAMN3', 'bioproject': 'PRJNA2', 'srp': 'SRP2',
+         'sample_attributes': [{'name': 'sex', 'value': 'female'}]},
+    ])
+
+    query = BiometaQuery(biometa, check_interval=0)
+    assert query.ids(attributes={'sex': 'female'}).tolist() == ['SAMN1', 'SAMN3']
+    assert query.ids(attributes={'sex': 'female'}, bioproject='PRJNA1').tolist() == ['SAMN1']
+    assert query.cache.hits == 1
+
+    cursor = query.find(attributes={'sex': 'female'}, fields=['srp'], page_size=1)
+    assert (len(cursor), cursor.pages) == (2, 2)
+    assert list(cursor) == [{'_id': 'SAMN1', 'srp': 'SRP1'}, {'_id': 'SAMN3', 'srp': 'SRP2'}]
+
+    # A write by another process is seen on the next lookup.
+    biometa.update_one({'_id': 'SAMN2'}, {'$set': {'sample_attributes.0.value': 'female'}})
+    query.cache.clear()
+    query.lookup('sample_attributes.sex', 'female')
+    biometa.update_one({'_id': 'SAMN2'}, {'$set': {'sample_attributes.0.value': 'male'}})
+    other = BiometaQuery(biometa)
+    db['biometa_version'].update_one({'_id': 'biometa'}, {'$inc': {'version': 1}}, upsert=True)
+    assert query.ids(attributes={'sex': 'female'}).tolist() == ['SAMN1', 'SAMN3']
+
+    # Writes in this process clear the cache straight away.
+    other.lookup('bioproject', 'PRJNA1')
+    record_write(db)
+    assert len(other.cache) == 0
+
+    with pytest.raises(ValueError):
+        query.ids()
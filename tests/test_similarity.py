@@ -0,0 +1,39 @@
+from biometalib.similarity import SimilarityIndex, ngrams, normalize, suggest
+
+
+def test_ngrams():
+    assert ngrams('Sex') == {' se', 'sex', 'ex '}
+    assert ngrams('a') == {' a '}
+
+
+def test_SimilarityIndex():
+    index = SimilarityIndex(['sex', 'Sex', 'gender', 'dev_stage', 'developmental_stage', 'tissue'])
+    assert len(index) == 6
+
+    similar = index.similar('sex', limit=2)
+    assert set(similar) == {'sex', 'Sex'}
+    assert set(index.similar('develop_stage', limit=2)) == {'developmental_stage', 'dev_stage'}
+
+    # New names can be found once added
+    assert 'tissue_type' not in index.similar('tissue_type')
+    index.add('tissue_type')
+    assert index.similar('tissue_type', limit=1) == ['tissue_type']
+
+
+def test_normalize():
+    assert normalize('Dev Stage') == 'dev_stage'
+    assert normalize('dev-stage') == 'dev_stage'
+    assert normalize('devStage') == 'dev_stage'
+    assert normalize('age (days)') == 'age_days'
+
+
+def test_suggest():
+    mapping = {'sex': 'sex', 'gender': 'sex', 'tissue': 'tissue', 'barcode': 'ignore'}
+    proposals = suggest(['Gender', 'tissu', 'Barcode', 'cell line', 'cellLine', 'zzz'], mapping)
+
+    assert proposals['Gender'] == ('sex', 100)
+    assert proposals['tissu'][0] == 'tissue'
+    assert proposals['Barcode'] == ('ignore', 100)
+    assert proposals['cell line'] == ('cell_line', 100)
+    assert proposals['cellLine'] == ('cell_line', 100)
+    assert 'zzz' not in proposals
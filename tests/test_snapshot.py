@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from biometalib.snapshot import create_snapshot, Snapshot
+
+
+def test_snapshot(tmpdir):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient()['sra']
+    db['attribute_stats'].insert_many([
+        {'_id': 'sex', 'samples': 3, 'projects': 2, 'distinct_values': 2,
+         'values': [{'value': 'female', 'count': 2}, {'value': 'male', 'count': 1}]},
+        {'_id': 'tissue', 'samples': 1, 'projects': 1, 'distinct_values': 1,
+         'values': [{'value': 'head', 'count': 1}]},
+    ])
+
+    fn = os.path.join(str(tmpdir), 'snapshot.sqlite')
+    assert create_snapshot(db['biometa'], fn, top=1) == 2
+
+    snapshot = Snapshot(fn)
+    assert snapshot.meta['database'] == 'sra'
+    assert snapshot.get_list_sample_attrs() == {'sex', 'tissue'}
+    assert snapshot.get_list_sample_attrs(counts=True) == {'sex': 3, 'tissue': 1}
+    assert snapshot.get_attribute_stats('sex') == {
+        '_id': 'sex', 'samples': 3, 'projects': 2, 'distinct_values': 2,
+        'values': [{'value': 'female', 'count': 2}],
+    }
+    assert snapshot.get_attribute_stats('age')['values'] == []
+    snapshot.close()
+
+
+def test_snapshot_computed(tmpdir):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient()['sra']
+    db['biometa'].insert_many([
+        {'_id': 'SAMN1', 'bioproject': 'PRJ1', 'sample_attributes': [{'name': 'sex', 'value': 'female'}]},
+        {'_id': 'SAMN2', 'bioproject': 'PRJ2', 'sample_attributes': [{'name': 'sex', 'value': 'male'}]},
+        {'_id': 'SAMN3', 'bioproject': 'PRJ2', 'sample_attributes': [{'name': 'sex', 'value': 'male'}]},
+    ])
+
+    # Names come from two pipelines, the counts of both end up in one row.
+    fn = os.path.join(str(tmpdir), 'snapshot.sqlite')
+    assert create_snapshot(db['biometa'], fn, batch_size=1) == 1
+    snapshot = Snapshot(fn)
+    stats = snapshot.get_attribute_stats('sex')
+    assert (stats['samples'], stats['projects'], stats['distinct_values']) == (3, 2, 2)
+    assert stats['values'] == [{'value': 'male', 'count': 2}, {'value': 'female', 'count': 1}]
+    snapshot.close()
@@ -0,0 +1,41 @@
+import os
+
+from biometalib.yaml_cache import load_yaml, get_cache_dir, _cache_fn
+
+
+def test_load_yaml(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    fn = os.path.join(str(tmpdir), 'test.yaml')
+    with open(fn, 'w') as fh:
+        fh.write('sex:\n  - sex\n  - Sex\nno:\n  - on\n')
+
+    data = load_yaml(fn, cache_dir=cache_dir)
+    assert data == {'sex': ['sex', 'Sex'], 'no': ['on']}
+    assert os.path.exists(_cache_fn(fn, cache_dir))
+
+    # Cached copy is used
+    assert load_yaml(fn, cache_dir=cache_dir) == data
+
+    # Changes to the YAML are picked up
+    with open(fn, 'w') as fh:
+        fh.write('sex:\n  - sex\n  - Sex\n  - gender\n')
+    assert load_yaml(fn, cache_dir=cache_dir) == {'sex': ['sex', 'Sex', 'gender']}
+
+
+def test_load_yaml_12(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    fn = os.path.join(str(tmpdir), 'test.yaml')
+    with open(fn, 'w') as fh:
+        fh.write('time:\n  - 1:30\n  - 010\n  - 0o17\n  - yes\n  - 1e3\n  - ~\n1: [one]\n')
+
+    expected = {'time': ['1:30', 10, 15, 'yes', 1000.0, None], 1: ['one']}
+    assert load_yaml(fn, cache_dir=cache_dir) == expected
+
+    # The cached copy keeps value and key types.
+    cached = load_yaml(fn, cache_dir=cache_dir)
+    assert cached == expected
+    assert list(cached) == ['time', 1]
+
+
+def test_cache_dir_fixture(yaml_cache):
+    assert get_cache_dir() == str(yaml_cache)